@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Microbenchmark for the base64 armor codec.
+
+Compares the ArmorWriter and ArmorReader classes with the original
+approach of encoding everything and writing one line at a time. The
+data is written to and read from a temporary file so the per write
+overhead of a real file is included.
+
+   $ python bench/armor.py
+   $ python bench/armor.py -s 64 -w 76
+'''
+import argparse
+import base64
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lock_files  # pylint: disable=wrong-import-position
+
+
+def write_lines(data, width, path):
+    '''
+    The original write_file() loop.
+    '''
+    with open(path, 'wb') as ofp:
+        content = base64.b64encode(data)
+        i = 0
+        while i < len(content):
+            ofp.write(content[i:i+width] + b'\n')
+            i += width
+
+
+def write_armor(data, width, path, chunk_size):
+    '''
+    Write using ArmorWriter in chunks.
+    '''
+    with open(path, 'wb') as ofp:
+        armor = lock_files.ArmorWriter(ofp, width)
+        for i in range(0, len(data), chunk_size):
+            armor.write(data[i:i+chunk_size])
+        armor.close()
+
+
+def read_all(path):
+    '''
+    The original read of the whole file followed by a decode.
+    '''
+    with open(path, 'rb') as ifp:
+        return base64.b64decode(ifp.read())
+
+
+def read_armor(path, chunk_size):
+    '''
+    Read using ArmorReader in chunks.
+    '''
+    parts = []
+    with open(path, 'rb') as ifp:
+        armor = lock_files.ArmorReader(ifp, chunk_size)
+        while True:
+            data = armor.read()
+            if not data:
+                break
+            parts.append(data)
+    return b''.join(parts)
+
+
+def timeit(fct, *args):
+    '''
+    Run the function three times, return the best time and the result.
+    '''
+    best = None
+    for _ in range(3):
+        start = time.time()
+        result = fct(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    '''
+    main
+    '''
+    parser = argparse.ArgumentParser(description='armor codec microbenchmark')
+    parser.add_argument('-c', '--chunk-size', type=int, default=lock_files.CHUNK_SIZE,
+                        help='chunk size in bytes (default: %(default)s)')
+    parser.add_argument('-s', '--size', type=int, default=32,
+                        help='data size in MB (default: %(default)s)')
+    parser.add_argument('-w', '--wll', type=int, default=72,
+                        help='line width (default: %(default)s)')
+    opts = parser.parse_args()
+
+    data = os.urandom(opts.size * 1024 * 1024)
+    mbytes = float(len(data)) / (1024 * 1024)
+    fd, path = tempfile.mkstemp(suffix='.locked')
+    os.close(fd)
+    try:
+        t0, _ = timeit(write_lines, data, opts.wll, path)
+        with open(path, 'rb') as ifp:
+            expected = ifp.read()
+        t1, _ = timeit(write_armor, data, opts.wll, path, opts.chunk_size)
+        with open(path, 'rb') as ifp:
+            assert ifp.read() == expected
+        t2, decoded = timeit(read_all, path)
+        t3, result = timeit(read_armor, path, opts.chunk_size)
+        assert decoded == data and result == data
+    finally:
+        os.remove(path)
+
+    print('{:<24} {:>10} {:>10}'.format('operation', 'seconds', 'MB/s'))
+    for name, sec in (('encode line loop', t0),
+                      ('encode ArmorWriter', t1),
+                      ('decode b64decode', t2),
+                      ('decode ArmorReader', t3)):
+        print('{:<24} {:>10.3f} {:>10.1f}'.format(name, sec, mbytes / sec))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmark suite for lock and unlock throughput.
+
+Generates synthetic trees of files in a temporary directory and times
+lock_files.py locking and then unlocking each tree for every
+combination of the selected jobs, formats and line widths. Each run
+is a separate process so the wall time includes the start up and the
+KDF and the peak RSS is the RSS of that run.
+
+The data is generated from a seed so the trees are the same for every
+run. The results are written as JSON so that the results of two
+versions can be compared.
+
+   $ python bench/throughput.py -o base.json
+   $ python bench/throughput.py -s small,large -j 1,4 -f classic,segmented
+   $ python bench/throughput.py -p /tmp/old/lock_files.py -o old.json
+   $ python bench/throughput.py --compare old.json -o new.json
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROGRAM = os.path.join(BENCH_DIR, '..', 'lock_files.py')
+PASSWORD = 'benchmark'
+BLOCK_SIZE = 1024 * 1024
+
+# The size classes: name: (number of files, file size, files per directory).
+SIZES = {
+    'tiny': (2000, 1024, 100),
+    'small': (500, 64 * 1024, 100),
+    'medium': (20, 8 * 1024 * 1024, 0),
+    'large': (1, 256 * 1024 * 1024, 0),
+    'huge': (1, 4 * 1024 * 1024 * 1024, 0),
+}
+
+# The formats: name: (lock_files.py lock options, unlock options).
+FORMATS = {
+    'classic': ([], []),
+    'openssl': (['--format', 'openssl'], ['--format', 'openssl']),
+    'kdf': (['--format', 'kdf'], []),
+    'binary': (['--format', 'kdf', '-b'], []),
+    'segmented': (['--format', 'segmented'], []),
+}
+
+
+def get_list(value, choices=None, convert=str):
+    '''
+    Parse a comma separated option value.
+    '''
+    items = [convert(item) for item in value.split(',') if item]
+    for item in items:
+        if choices is not None and item not in choices:
+            raise argparse.ArgumentTypeError('invalid choice "{}", choose from {}'.format(item, ', '.join(choices)))
+    return items
+
+
+def make_tree(path, size_class, seed):
+    '''
+    Create the files for a size class.
+
+    The contents come from a seeded 1MiB block that is rotated by a
+    different amount for each file so that no two files are the same.
+
+    @returns the number of files and bytes.
+    '''
+    num, size, per_dir = SIZES[size_class]
+    block = random.Random(seed).getrandbits(8 * BLOCK_SIZE).to_bytes(BLOCK_SIZE, 'little')
+    for i in range(num):
+        subdir = path if per_dir == 0 else os.path.join(path, 'd{:04d}'.format(i // per_dir))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        shift = (i * 7919) % BLOCK_SIZE
+        data = block[shift:] + block[:shift]
+        with open(os.path.join(subdir, 'f{:06d}.dat'.format(i)), 'wb') as ofp:
+            left = size
+            while left > 0:
+                ofp.write(data[:left])
+                left -= min(left, len(data))
+    return num, num * size
+
+
+def tree_size(path):
+    '''
+    Get the number of files and bytes in a tree.
+    '''
+    num = 0
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            num += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return num, size
+
+
+def run(cmd):
+    '''
+    Run a command and measure it.
+
+    @returns the wall time in seconds and the peak RSS in KiB.
+    '''
+    with tempfile.TemporaryFile() as efp:
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=efp)
+        _, status, usage = os.wait4(proc.pid, 0)  # the rusage of this child only
+        elapsed = time.time() - start
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+        if proc.returncode != 0:
+            efp.seek(0)
+            raise RuntimeError('command failed ({}): {}\n{}'.format(proc.returncode, ' '.join(cmd),
+                                                                    efp.read().decode('utf-8', 'replace')))
+    maxrss = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss //= 1024  # bytes on macOS, KiB elsewhere
+    return elapsed, maxrss
+
+
+def bench(opts, path, size_class, num, size, jobs, fmt, wll):
+    '''
+    Lock and unlock a tree, the best of --repeat round trips.
+
+    @returns the lock and unlock result records.
+    '''
+    common = [sys.executable, opts.program, '-P', PASSWORD, '-r', '-j', str(jobs), '-w', str(wll)]
+    results = {}
+    for _ in range(opts.repeat):
+        for op in ('lock', 'unlock'):
+            lock_opts, unlock_opts = FORMATS[fmt]
+            cmd = common + (['--lock'] + lock_opts if op == 'lock' else ['--unlock'] + unlock_opts) + [path]
+            elapsed, maxrss = run(cmd)
+            best = results.get(op)
+            if best is None or elapsed < best['seconds']:
+                results[op] = {
+                    'size': size_class,
+                    'op': op,
+                    'format': fmt,
+                    'jobs': jobs,
+                    'wll': wll,
+                    'files': num,
+                    'bytes': size,
+                    'seconds': round(elapsed, 4),
+                    'mb_s': round(size / (1024.0 * 1024) / elapsed, 2),
+                    'files_s': round(num / elapsed, 2),
+                    'max_rss_kb': maxrss,
+                }
+        if tree_size(path) != (num, size):
+            raise RuntimeError('the unlocked tree does not match the original: {}'.format(path))
+    return [results['lock'], results['unlock']]
+
+
+def get_key(record):
+    '''
+    Get the key that identifies the same measurement in two results.
+    '''
+    return tuple(record[name] for name in ('size', 'op', 'format', 'jobs', 'wll'))
+
+
+def compare(base, records, threshold):
+    '''
+    Compare the throughput with the results of another version.
+
+    @returns the number of regressions.
+    '''
+    old = {get_key(record): record for record in base['results']}
+    regressions = 0
+    print('')
+    print('{:<8} {:<7} {:<10} {:>4} {:>4} {:>10} {:>10} {:>8}'.format(
+        'size', 'op', 'format', 'jobs', 'wll', 'base MB/s', 'MB/s', 'change'))
+    for record in records:
+        prev = old.get(get_key(record))
+        if prev is None:
+            continue
+        change = (record['mb_s'] - prev['mb_s']) * 100.0 / prev['mb_s'] if prev['mb_s'] else 0.0
+        flag = ''
+        if change < -threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        print('{:<8} {:<7} {:<10} {:>4} {:>4} {:>10.1f} {:>10.1f} {:>7.1f}%{}'.format(
+            record['size'], record['op'], record['format'], record['jobs'], record['wll'],
+            prev['mb_s'], record['mb_s'], change, flag))
+    return regressions
+
+
+def get_revision(program):
+    '''
+    Get the git revision of the program, if it is in a git tree.
+    '''
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=os.path.dirname(os.path.abspath(program)),
+                                      stderr=subprocess.DEVNULL)
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    '''
+    main
+    '''
+    parser = argparse.ArgumentParser(description='lock and unlock throughput benchmark suite')
+    parser.add_argument('--compare', type=str, metavar='FILE',
+                        help='compare with the results of another version in FILE')
+    parser.add_argument('-d', '--dir', type=str,
+                        help='create the trees below this directory (default: the temporary directory)')
+    parser.add_argument('-f', '--formats', type=lambda v: get_list(v, FORMATS), default=['classic', 'segmented'],
+                        help='comma separated formats from {} (default: classic,segmented)'.format(
+                            ','.join(FORMATS)))
+    parser.add_argument('-j', '--jobs', type=lambda v: get_list(v, convert=int), default=[1, 4],
+                        help='comma separated --jobs values (default: 1,4)')
+    parser.add_argument('-o', '--output', type=str, metavar='FILE',
+                        help='write the JSON results to FILE')
+    parser.add_argument('-p', '--program', type=str, default=PROGRAM,
+                        help='the lock_files.py to benchmark (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='round trips for each combination, the best is kept (default: %(default)s)')
+    parser.add_argument('-s', '--sizes', type=lambda v: get_list(v, SIZES), default=['tiny', 'small', 'medium'],
+                        help='comma separated size classes from {} (default: tiny,small,medium)'.format(
+                            ','.join(SIZES)))
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed for the file contents (default: %(default)s)')
+    parser.add_argument('-t', '--threshold', type=float, default=10.0,
+                        help='throughput drop in percent that --compare reports (default: %(default)s)')
+    parser.add_argument('-w', '--wll', type=lambda v: get_list(v, convert=int), default=[72],
+                        help='comma separated line widths (default: 72)')
+    opts = parser.parse_args()
+
+    records = []
+    print('{:<8} {:<7} {:<10} {:>4} {:>4} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'size', 'op', 'format', 'jobs', 'wll', 'files', 'seconds', 'MB/s', 'files/s', 'RSS KiB'))
+    for size_class in opts.sizes:
+        tmp = tempfile.mkdtemp(prefix='lock_files_bench_', dir=opts.dir)
+        try:
+            path = os.path.join(tmp, size_class)
+            num, size = make_tree(path, size_class, opts.seed)
+            for fmt in opts.formats:
+                for jobs in opts.jobs:
+                    for wll in opts.wll:
+                        for record in bench(opts, path, size_class, num, size, jobs, fmt, wll):
+                            records.append(record)
+                            print('{size:<8} {op:<7} {format:<10} {jobs:>4} {wll:>4} {files:>8} {seconds:>10.3f} '
+                                  '{mb_s:>10.1f} {files_s:>10.1f} {max_rss_kb:>10}'.format(**record))
+                            sys.stdout.flush()
+        finally:
+            shutil.rmtree(tmp)
+
+    result = {
+        'date': datetime.datetime.now().isoformat(),
+        'program': os.path.abspath(opts.program),
+        'revision': get_revision(opts.program),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'seed': opts.seed,
+        'results': records,
+    }
+    if opts.output:
+        with open(opts.output, 'w') as ofp:
+            json.dump(result, ofp, indent=2)
+            ofp.write('\n')
+
+    if opts.compare:
+        with open(opts.compare) as ifp:
+            regressions = compare(json.load(ifp), records, opts.threshold)
+        if regressions > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
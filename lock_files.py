@@ -83,29 +83,42 @@ decrypt it using lock_files.py.
 Note that you have to use the -W option to change errors to
 warning because the file1.txt output file already exists.
 '''
-import argparse
+import sys
+
+if sys.version_info < (3, 7):
+    print('ERROR: Python 3.7 or later is required, this is {}.{}.'.format(*sys.version_info[:2]))
+    sys.exit(1)
+
 import base64
-import getpass
+import binascii
+import collections
+import errno
 import hashlib
-import inspect
+import hmac
+import io
+import math
+import mmap
 import os
-import subprocess
-import sys
+import queue
+import signal
+import stat
+import struct
 import threading
+import time
 
-from threading import Thread, Lock, Semaphore
-
-try:
-    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-    from cryptography.hazmat.backends import default_backend
-except ImportError as exc:
-    print('ERROR: Import failed, you may need to run "pip install cryptography".\n{:>7}{}'.format('', exc))
-    sys.exit(1)
+from threading import Thread, Lock
 
-try:
-    import Queue as queue  # python 2
-except ImportError:
-    import queue   # python3
+# The cryptography classes are imported by load_crypto() when the
+# first cipher is created, see AESCipher. The modules that are only
+# needed by some of the options (argparse, getpass, json, subprocess,
+# tarfile, ...) are imported where they are used. This keeps the
+# import of lock_files as a library cheap.
+InvalidTag = None
+hashes = None
+Cipher = algorithms = modes = None
+AESGCM = None
+HKDF = None
+default_backend = None
 
 
 # ================================================================
@@ -115,8 +128,95 @@ except ImportError:
 # ================================================================
 VERSION = '1.1.1'
 th_mutex = Lock()  # mutex for thread IO
-th_semaphore = None  # semapthore to limit max active threads
+th_queue = None  # bounded queue of files waiting for a worker
+th_workers = []  # worker threads, one per job
+th_pool = None  # process pool used by --executor process
 th_abort = False  # If true, abort all threads
+th_kdf_mutex = Lock()  # mutex for the master key cache
+th_master_keys = {}  # master keys that have already been derived
+th_kdf_locks = {}  # locks of the master keys that are being derived
+th_run_salt = None  # master key salt for files locked by this run
+th_cipher_pool = None  # thread pool for segments and parallel CBC decryption
+th_cipher_jobs = 1  # number of threads in th_cipher_pool
+th_index = {}  # --incremental state of the files that were locked
+th_index_pending = {}  # state of the queued files, added to th_index when they are locked
+th_index_seen = set()  # the files of th_index that this run found, the others may have been deleted
+th_timing = False  # If true, collect the time spent in each stage
+th_local = threading.local()  # the stage times of the file that each thread is processing
+th_times = collections.defaultdict(float)  # the stage times of the run
+th_file_times = None  # the stage times of each file if --stats-per-file was specified
+th_stats_hooks = []  # functions that receive the stage times, see add_stats_hook()
+th_log = None  # the LogWriter for the messages and events
+th_log_mutex = Lock()  # mutex for starting the log writer
+th_event_log = None  # the --log-json stream, a list in worker processes and sessions
+th_quiet = False  # If true, discard the messages, see LockSession
+th_tuner = None  # the JobTuner that limits the active workers for --jobs auto
+th_session = None  # the open LockSession, there can only be one
+CHUNK_SIZE = 1024 * 1024  # default number of bytes to read at a time
+MMAP_THRESHOLD = 64 * 1024 * 1024  # default size of the smallest memory mapped file
+QUEUE_DEPTH = 4  # queued files per worker before the producer blocks
+PIPELINE_BYTES = 8 * 1024 * 1024  # default bytes buffered by each pipeline stage
+LOG_QUEUE_DEPTH = 4096  # messages queued for the log writer before the callers block
+PROGRESS_INTERVAL = 1.0  # seconds between --progress reports
+AUTO_JOBS_FACTOR = 4  # --jobs auto admits up to this many workers per core while they wait for I/O
+AUTO_JOBS_INTERVAL = 0.5  # seconds between --jobs auto adjustments
+AUTO_JOBS_BUSY = 0.9  # fraction of the cores in use at which --jobs auto stops adding workers
+CGROUP_ROOT = '/sys/fs/cgroup'  # where the cgroup v1 and v2 hierarchies are mounted
+CGROUP_PROC = '/proc/self/cgroup'  # the cgroups of this process
+DAEMON_TIMEOUT = 10.0  # seconds that --daemon waits for the request of a client
+FILES_FROM_CHUNK = 64 * 1024  # bytes of a --files-from list read at a time
+INDEX_VERSION = 1  # --incremental index file format version
+STATS_VERSION = 1  # --stats-json file format version
+STATS_STAGES = ('queue_wait', 'enqueue_wait', 'kdf', 'read', 'aes', 'base64', 'wrap', 'write', 'remove')
+
+# The kdf format header: magic, version, KDF id, KDF cost, scrypt r,
+# scrypt p, master key salt, file key salt, IV and, from version 3,
+# the key check value.
+CONTAINER_MAGIC = b'Locked__'
+CONTAINER_VERSION = 3
+CONTAINER_HEADERS = {  # version: header
+    1: struct.Struct('>8sBBIHH16s16s16s'),
+    3: struct.Struct('>8sBBIHH16s16s16s8s'),
+}
+CONTAINER_HEADER = CONTAINER_HEADERS[CONTAINER_VERSION]
+SALT_LEN = 16
+KEY_CHECK_LEN = 8
+SCRYPT_MAXMEM = 256 * 1024 * 1024
+# The segmented format header: magic, version, KDF id, KDF cost,
+# scrypt r, scrypt p, master key salt, file key salt, nonce prefix,
+# segment size and, from version 4, the key check value. It is
+# followed by the segments, each is the AES-GCM ciphertext of segment
+# size bytes followed by the tag, only the last segment can be
+# shorter.
+SEGMENT_VERSION = 4
+SEGMENT_HEADERS = {  # version: header
+    2: struct.Struct('>8sBBIHH16s16s7sI'),
+    4: struct.Struct('>8sBBIHH16s16s7sI8s'),
+}
+SEGMENT_HEADER = SEGMENT_HEADERS[SEGMENT_VERSION]
+SEGMENT_NONCE = struct.Struct('>7sIB')  # nonce prefix, segment number, last segment flag
+SEGMENT_SIZE = 1024 * 1024
+SEGMENT_MAX_SIZE = 16 * 1024 * 1024  # largest segment that is written or accepted from a header
+SEGMENT_TAG_LEN = 16
+CBC_RANGE_MIN = 64 * 1024  # smallest CBC range that is decrypted in its own thread
+
+KDF_PARAMS = {  # name: (id, cost, r, p)
+    'pbkdf2': (1, 600000, 0, 0),
+    'scrypt': (2, 1 << 15, 8, 1),
+}
+# The largest KDF parameters accepted from a file header so that a
+# corrupted or hostile header cannot stall the run: 10 times the PBKDF2
+# iterations that are written and the largest scrypt N that fits in
+# SCRYPT_MAXMEM. scrypt needs 128 * r * (N + p + 2) bytes and N is a
+# power of two, with r=8 and p=1 that is N=2^17, 4 times the N that is
+# written.
+SCRYPT_MAX_R = 8
+SCRYPT_MAX_P = 1
+SCRYPT_MAX_N = 1 << ((SCRYPT_MAXMEM // (128 * SCRYPT_MAX_R) - SCRYPT_MAX_P - 2).bit_length() - 1)
+KDF_MAX_PARAMS = {  # id: (cost, r, p)
+    1: (10 * 600000, 0, 0),
+    2: (SCRYPT_MAX_N, SCRYPT_MAX_R, SCRYPT_MAX_P),
+}
 
 
 # ================================================================
@@ -124,6 +224,15 @@ th_abort = False  # If true, abort all threads
 # Classes.
 #
 # ================================================================
+class LockFilesError(Exception):
+    '''
+    Raised by err() after the error has been reported.
+
+    The command line tool exits with status 1, library callers can
+    catch it.
+    '''
+
+
 class AESCipher:
     '''
     Class that provides an object to encrypt or decrypt a string
@@ -131,7 +240,7 @@ class AESCipher:
 
     CITATION: http://joelinoff.com/blog/?p=885
     '''
-    def __init__(self, openssl=False, digest='md5', keylen=32, ivlen=16):
+    def __init__(self, openssl=False, digest='md5', keylen=32, ivlen=16, kdf=None, segment_size=None):
         '''
         Initialize the object.
 
@@ -140,8 +249,15 @@ class AESCipher:
         @param digest   The digest used.
         @param keylen   The key length (32-256, 16-128, 8-64).
         @param ivlen    Length of the initialization vector.
+        @param kdf      Encrypt in the kdf format using this password
+                        KDF (pbkdf2 or scrypt).
+        @param segment_size  Encrypt in the segmented format using
+                        segments of this size, it requires kdf.
         '''
+        load_crypto()
         self.m_openssl = openssl
+        self.m_kdf = kdf
+        self.m_segment_size = segment_size
         self.m_openssl_prefix = b'Salted__'  # Hardcoded into openssl.
         self.m_openssl_prefix_len = len(self.m_openssl_prefix)
         self.m_digest = getattr(__import__('hashlib', fromlist=[digest]), digest)
@@ -151,6 +267,13 @@ class AESCipher:
             err('invalid keylen {}, must be 16, 24 or 32'.format(keylen))
         if openssl and ivlen != 16:
             err('invalid ivlen size {}, for openssl compatibility it must be 16'.format(ivlen))
+        if kdf is not None and kdf not in KDF_PARAMS:
+            err('invalid kdf {}, must be one of {}'.format(kdf, ', '.join(sorted(KDF_PARAMS))))
+        if kdf is not None and (keylen != 32 or ivlen != 16):
+            err('invalid keylen {} or ivlen {}, the kdf format requires 32 and 16'.format(keylen, ivlen))
+        if segment_size is not None and (kdf is None or not 1 <= segment_size <= SEGMENT_MAX_SIZE):
+            err('invalid segment size {}, the segmented format requires a kdf and at most {} bytes'.format(
+                segment_size, SEGMENT_MAX_SIZE))
 
     def encrypt(self, password, plaintext):
         '''
@@ -166,37 +289,37 @@ class AESCipher:
         @param plaintext The plaintext to encrypt.
         @param msgdgst   The message digest algorithm.
         '''
-        # Setup key and IV for both modes.
-        if self.m_openssl:
-            salt = os.urandom(self.m_ivlen - len(self.m_openssl_prefix))
-            key, iv = self._get_key_and_iv(password, salt)
-            if key is None or iv is None:
-                return None
-        else:
-            # No 'Salted__' prefix.
-            key = self._get_password_key(password)
-            iv = os.urandom(self.m_ivlen)  # IV is the same as block size for CBC mode
+        if self.m_segment_size is not None:
+            out = io.BytesIO()
+            self.encrypt_stream(password, io.BytesIO(plaintext), out)
+            return base64.b64encode(out.getvalue())
 
-        # Key
-        key = self._encode(key)
+        # Setup key and IV for all modes.
+        key, iv, prefix = self._get_encrypt_key_and_iv(password)
+        if key is None or iv is None:
+            return None
 
         # Encrypt
-        padded_plaintext = self._pkcs7_pad(plaintext, self.m_ivlen)
+        # The prefix and the ciphertext are written into a single
+        # preallocated buffer and only the last block is padded so
+        # the plaintext is never copied.
+        # In openssl mode the prefix makes it openssl compatible.
+        # I first discovered this when I wrote the C++ Cipher class.
+        # CITATION: http://projects.joelinoff.com/cipher-1.1/doxydocs/html/
         backend = default_backend()
         cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=backend)
         encryptor = cipher.encryptor()
-        ciphertext_binary = encryptor.update(padded_plaintext) + encryptor.finalize()
-
-        # Finalize
-        if self.m_openssl:
-            # Make openssl compatible.
-            # I first discovered this when I wrote the C++ Cipher class.
-            # CITATION: http://projects.joelinoff.com/cipher-1.1/doxydocs/html/
-            openssl_compatible = self.m_openssl_prefix + salt + ciphertext_binary
-            ciphertext = base64.b64encode(openssl_compatible)
-        else:
-            ciphertext = base64.b64encode(iv + ciphertext_binary)
-
+        view = memoryview(plaintext)
+        full = len(view) - (len(view) % self.m_ivlen)
+        out = memoryview(bytearray(len(prefix) + full + 2 * self.m_ivlen - 1))
+        out[:len(prefix)] = prefix
+        num = len(prefix)
+        num += encryptor.update_into(view[:full], out[num:])
+        num += encryptor.update_into(self._pkcs7_pad(bytes(view[full:]), self.m_ivlen), out[num:])
+        encryptor.finalize()
+
+        # Base64 encode
+        ciphertext = base64.b64encode(out[:num])
         return ciphertext
 
     def decrypt(self, password, ciphertext):
@@ -211,35 +334,476 @@ class AESCipher:
 
         @param password   The password.
         @param ciphertext The ciphertext to decrypt.
-        @returns the decrypted data.
+        @returns the decrypted data in a bytearray.
+        '''
+        # Base64 decode
+        ciphertext_prefixed_binary = base64.b64decode(ciphertext)
+        if is_segmented(ciphertext_prefixed_binary):
+            out = io.BytesIO()
+            self.decrypt_stream(password, io.BytesIO(ciphertext_prefixed_binary), out)
+            return bytearray(out.getvalue())
+
+        # Now create the key and iv.
+        key, iv, prefix_len = self._get_decrypt_key_and_iv(password, ciphertext_prefixed_binary)
+        if key is None or iv is None:
+            return None
+
+        # Decrypt
+        # The plaintext is decrypted into a preallocated buffer that
+        # is truncated in place to remove the padding.
+        ciphertext_binary = memoryview(ciphertext_prefixed_binary)[prefix_len:]
+        decryptor = get_cbc_decryptor(key, iv)
+        plaintext = bytearray(len(ciphertext_binary) + self.m_ivlen - 1)
+        num = decryptor.update_into(ciphertext_binary, plaintext)
+        decryptor.finalize()
+        if num == 0:
+            raise ValueError('locked data has no content')
+        del plaintext[num:]
+        del plaintext[num - self._pkcs7_check(plaintext):]
+        return plaintext
+
+    def encrypt_stream(self, password, ifp, ofp, width=0, chunk_size=CHUNK_SIZE, binary=False):
+        '''
+        Encrypt the contents of an input stream and write the base64
+        encoded ciphertext to an output stream.
+
+        If binary is True, the ciphertext is written as is. That is
+        only allowed for the kdf format because its header is what
+        allows decrypt_stream() to recognize binary data.
+
+        Only chunk_size bytes of plaintext are held in memory at a
+        time so the memory used does not depend on the size of the
+        input. The output is byte for byte identical to the result of
+        encrypt() broken into lines of width characters.
+
+        @param password   The password.
+        @param ifp        The plaintext input stream.
+        @param ofp        The ciphertext output stream.
+        @param width      The base64 line width, 0 means no new lines.
+        @param chunk_size The number of bytes to read at a time.
+        @param binary     Do not base64 encode the output.
+        @returns the number of bytes read and written.
+        '''
+        writer = self.encrypt_writer(password, ofp, width=width, binary=binary)
+        if writer is None:
+            return None
+
+        # The input buffer is allocated once and reused for every
+        # chunk. Memory mapped input is encrypted directly from the
+        # mapping.
+        readview = getattr(ifp, 'readview', None)
+        ibuf = None if readview is not None else memoryview(bytearray(chunk_size))
+        while True:
+            start = timing_clock()
+            if readview is not None:
+                chunk = readview(chunk_size)
+            else:
+                chunk = ibuf[:readinto(ifp, ibuf)]
+            timing_add('read', start)
+            if len(chunk) == 0:
+                break
+            writer.write(chunk)
+        return writer.close()
+
+    def encrypt_writer(self, password, ofp, width=0, binary=False):
+        '''
+        Get a stream that encrypts the data written to it and writes
+        the ciphertext to an output stream.
+
+        This is the push style counterpart of encrypt_stream() for
+        producers like tarfile that write their output.
+
+        @param password   The password.
+        @param ofp        The ciphertext output stream.
+        @param width      The base64 line width, 0 means no new lines.
+        @param binary     Do not base64 encode the output.
+        @returns the EncryptWriter, its close() call must be used to
+                 write the last block.
+        '''
+        if binary is True and self.m_kdf is None:
+            err('binary output requires the kdf format')
+        if self.m_segment_size is not None:
+            return self._get_segment_writer(password, ofp)
+
+        # Setup key and IV for all modes.
+        key, iv, prefix = self._get_encrypt_key_and_iv(password)
+        if key is None or iv is None:
+            return None
+
+        backend = default_backend()
+        cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=backend)
+
+        # The base64 encoder is fed multiples of 3 bytes so that there
+        # is no internal padding, the remainder is carried over.
+        armor = RawWriter(ofp) if binary is True else ArmorWriter(ofp, width)
+        armor.write(prefix)
+        handoff = binary is True and getattr(ofp, 'm_handoff', False) is True
+        return EncryptWriter(cipher.encryptor(), armor, self.m_ivlen, handoff)
+
+    def decrypt_stream(self, password, ifp, ofp, chunk_size=CHUNK_SIZE):
+        '''
+        Decrypt the base64 encoded contents of an input stream and
+        write the plaintext to an output stream.
+
+        Binary kdf format input is recognized by its header and is
+        decrypted without base64 decoding it.
+
+        This is the streaming counterpart of decrypt(), it only holds
+        chunk_size bytes of ciphertext in memory at a time.
+
+        @param password   The password.
+        @param ifp        The base64 encoded ciphertext input stream.
+        @param ofp        The plaintext output stream.
+        @param chunk_size The number of bytes to read at a time.
+        @returns the number of bytes read and written.
+        '''
+        reader = self.decrypt_reader(password, ifp, chunk_size)
+        if reader is None:
+            return None
+        reader.m_handoff = getattr(ofp, 'm_handoff', False)
+        nwritten = 0
+        while True:
+            plaintext = reader.read_chunk()
+            if len(plaintext) == 0:
+                break
+            start = timing_clock()
+            ofp.write(plaintext)
+            timing_add('write', start)
+            nwritten += len(plaintext)
+        return reader.m_armor.m_read, nwritten
+
+    def decrypt_reader(self, password, ifp, chunk_size=CHUNK_SIZE):
+        '''
+        Get a stream that reads the plaintext of a locked input
+        stream.
+
+        This is the pull style counterpart of decrypt_stream() for
+        consumers like tarfile that read their input.
+
+        @param password   The password.
+        @param ifp        The ciphertext input stream.
+        @param chunk_size The number of bytes to read at a time.
+        @returns the DecryptReader.
         '''
+        head = ifp.read(len(CONTAINER_MAGIC))
+        if head == CONTAINER_MAGIC:
+            head += ifp.read(1)  # the version
+            if is_segmented(head):
+                return self._get_segment_reader(password, ifp, head)
+            armor = RawReader(ifp, chunk_size, head)
+        else:
+            armor = ArmorReader(ifp, chunk_size, head)
+
+        # Read enough to cover the longest header.
+        data = b''
+        while len(data) < CONTAINER_HEADER.size:
+            more = armor.read()
+            if not more:
+                break
+            data += more
+
+        key, iv, prefix_len = self._get_decrypt_key_and_iv(password, data)
+        if key is None or iv is None:
+            return None
+        return DecryptReader(get_cbc_decryptor(key, iv), armor, data[prefix_len:], self.m_ivlen, self._pkcs7_unpad)
+
+    def _get_encrypt_key_and_iv(self, password):
+        '''
+        Create the key and IV for a new encryption.
+
+        @param password  The password.
+        @returns the key, the IV and the prefix that is written in
+        front of the ciphertext so that they can be recreated.
+        '''
+        if self.m_kdf is not None:
+            kdf_id, cost, r, p = KDF_PARAMS[self.m_kdf]
+            run_salt = get_run_salt()
+            file_salt = os.urandom(SALT_LEN)
+            iv = os.urandom(self.m_ivlen)
+            master_key = get_master_key(password, kdf_id, cost, r, p, run_salt)
+            key = self._get_file_key(master_key, file_salt)
+            prefix = CONTAINER_HEADER.pack(CONTAINER_MAGIC, CONTAINER_VERSION, kdf_id, cost, r, p,
+                                           run_salt, file_salt, iv, self._get_key_check(master_key, file_salt))
+            return key, iv, prefix
+
         if self.m_openssl:
-            # Base64 decode
-            ciphertext_prefixed_binary = base64.b64decode(ciphertext)
-            if ciphertext_prefixed_binary[:self.m_openssl_prefix_len] != self.m_openssl_prefix:
-                err('bad header, cannot decrypt')
-            salt = ciphertext_prefixed_binary[self.m_openssl_prefix_len:self.m_ivlen]  # get the salt
+            salt = os.urandom(self.m_ivlen - len(self.m_openssl_prefix))
+            key, iv = self._get_key_and_iv(password, salt)
+            prefix = self.m_openssl_prefix + salt
+        else:
+            # No 'Salted__' prefix.
+            key = self._get_password_key(password)
+            iv = os.urandom(self.m_ivlen)  # IV is the same as block size for CBC mode
+            prefix = iv
+        return self._encode(key), iv, prefix
+
+    def _get_decrypt_key_and_iv(self, password, data):
+        '''
+        Recreate the key and IV from the start of the binary locked
+        data.
+
+        Files in the kdf format are recognized by their header so
+        they are decrypted regardless of how the object was created.
 
-            # Now create the key and iv.
+        @param password  The password.
+        @param data      At least the first CONTAINER_HEADER.size bytes
+                         of the binary data unless it is shorter.
+        @returns the key, the IV and the length of the prefix.
+        '''
+        if data[:len(CONTAINER_MAGIC)] == CONTAINER_MAGIC:
+            header = get_header(CONTAINER_HEADERS, data)
+            if len(data) < header.size:
+                raise ValueError('locked data is too short')
+            fields = header.unpack(data[:header.size])
+            _, _, kdf_id, cost, r, p, run_salt, file_salt, iv = fields[:9]
+            master_key = get_master_key(password, kdf_id, cost, r, p, run_salt)
+            if len(fields) > 9:
+                self._check_key(master_key, file_salt, fields[9])
+            return self._get_file_key(master_key, file_salt), iv, header.size
+
+        if len(data) < self.m_ivlen:
+            raise ValueError('locked data is too short')
+        if self.m_openssl:
+            if data[:self.m_openssl_prefix_len] != self.m_openssl_prefix:
+                err('bad header, cannot decrypt')
+            salt = data[self.m_openssl_prefix_len:self.m_ivlen]  # get the salt
             key, iv = self._get_key_and_iv(password, salt)
-            if key is None or iv is None:
-                return None
         else:
             key = self._get_password_key(password)
-            ciphertext_prefixed_binary = base64.b64decode(ciphertext)
-            iv = ciphertext_prefixed_binary[:self.m_ivlen]  # IV is the same as block size for CBC mode
+            iv = data[:self.m_ivlen]  # IV is the same as block size for CBC mode
+        return self._encode(key), iv, self.m_ivlen
 
-        # Key
-        key = self._encode(key)
+    def _get_key_check(self, master_key, file_salt):
+        '''
+        Derive the key check value that is stored in the header.
 
-        # Decrypt
-        ciphertext_binary = ciphertext_prefixed_binary[self.m_ivlen:]
-        backend = default_backend()
-        cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=backend)
-        decryptor = cipher.decryptor()
-        padded_plaintext  = decryptor.update(ciphertext_binary) + decryptor.finalize()
-        plaintext = self._pkcs7_unpad(padded_plaintext)
-        return plaintext
+        It only depends on the master key and the file salt so a
+        wrong password is detected from the header alone.
+
+        @param master_key  The key derived from the password.
+        @param file_salt   The random salt stored in the file header.
+        '''
+        return self._get_file_key(master_key, file_salt, b'lock_files key check')[:KEY_CHECK_LEN]
+
+    def _check_key(self, master_key, file_salt, check):
+        '''
+        Compare the key check value in the header with the one that
+        the password gives.
+
+        @param master_key  The key derived from the password.
+        @param file_salt   The random salt stored in the file header.
+        @param check       The key check value in the header.
+        '''
+        if hmac.compare_digest(self._get_key_check(master_key, file_salt), check) is False:
+            raise ValueError('wrong password, the key check value does not match')
+
+    def _get_file_key(self, master_key, file_salt, info=b'lock_files file key'):
+        '''
+        Derive the key for a single file from the master key.
+
+        HKDF is cheap so a hardened password KDF can be used for the
+        master key without paying its cost for every file.
+
+        @param master_key  The key derived from the password.
+        @param file_salt   The random salt stored in the file header.
+        @param info        Distinguishes the keys for each format.
+        '''
+        start = timing_clock()
+        hkdf = HKDF(algorithm=hashes.SHA256(),
+                    length=self.m_keylen,
+                    salt=file_salt,
+                    info=info,
+                    backend=default_backend())
+        key = hkdf.derive(master_key)
+        timing_add('kdf', start)
+        return key
+
+    def _get_segment_writer(self, password, ofp):
+        '''
+        Create the header and the writer for a new encryption in the
+        segmented format.
+        '''
+        kdf_id, cost, r, p = KDF_PARAMS[self.m_kdf]
+        run_salt = get_run_salt()
+        file_salt = os.urandom(SALT_LEN)
+        nonce_prefix = os.urandom(7)
+        master_key = get_master_key(password, kdf_id, cost, r, p, run_salt)
+        key = self._get_file_key(master_key, file_salt, b'lock_files segment key')
+        header = SEGMENT_HEADER.pack(CONTAINER_MAGIC, SEGMENT_VERSION, kdf_id, cost, r, p,
+                                     run_salt, file_salt, nonce_prefix, self.m_segment_size,
+                                     self._get_key_check(master_key, file_salt))
+        armor = RawWriter(ofp)
+        armor.write(header)
+        return SegmentWriter(AESGCM(key), header, nonce_prefix, self.m_segment_size, armor)
+
+    def decrypt_range(self, password, ifp, ofp, start, stop=None):
+        '''
+        Decrypt part of the plaintext of locked data and write it to
+        an output stream.
+
+        The start and stop offsets work like a slice, negative
+        offsets count from the end of the plaintext.
+
+        Binary data is random access: only the segments that cover
+        the range are read and decrypted for the segmented format,
+        their positions are computed from the segment size, and only
+        the blocks that cover the range are decrypted for the kdf
+        format because a CBC block only depends on the previous
+        ciphertext block. Base64 encoded data is decrypted from the
+        start.
+
+        The plaintext is written as it is decrypted, an error can
+        occur after part of the range has been written.
+
+        @param password  The password.
+        @param ifp       The ciphertext input stream, it must be
+                         seekable for the segmented format.
+        @param ofp       The plaintext output stream.
+        @param start     The offset of the first byte.
+        @param stop      The offset after the last byte, None for the
+                         end.
+        @returns the number of bytes written.
+        '''
+        pos = ifp.tell()
+        head = ifp.read(len(CONTAINER_MAGIC) + 1)
+        if is_segmented(head):
+            return self._decrypt_segment_range(password, ifp, ofp, pos, head, start, stop)
+        if head[:len(CONTAINER_MAGIC)] == CONTAINER_MAGIC:
+            return self._decrypt_block_range(password, ifp, ofp, pos, head, start, stop)
+        ifp.seek(pos)
+        reader = self.decrypt_reader(password, ifp)
+        if reader is None:
+            return None
+        return select_range(iter(reader.read_chunk, memoryview(b'')), start, stop, ofp)
+
+    def _decrypt_block_range(self, password, ifp, ofp, pos, head, start, stop):
+        '''
+        Decrypt part of the plaintext of binary data in the kdf
+        format.
+
+        @param password  The password.
+        @param ifp       The seekable input stream.
+        @param ofp       The plaintext output stream.
+        @param pos       The position of the header in the stream.
+        @param head      The start of the header that was already read.
+        @param start     The offset of the first byte.
+        @param stop      The offset after the last byte, None for the
+                         end.
+        @returns the number of bytes written.
+        '''
+        header = head + read_full(ifp, get_header(CONTAINER_HEADERS, head).size - len(head))
+        key, iv, prefix_len = self._get_decrypt_key_and_iv(password, header)
+        first_pos = pos + prefix_len
+        blocksize = self.m_ivlen
+        body = ifp.seek(0, os.SEEK_END) - first_pos
+        if body == 0:
+            raise ValueError('locked data has no content')
+        if body % blocksize != 0:
+            raise ValueError('locked data is truncated')
+
+        def get_decryptor(first):
+            # The previous ciphertext block is the IV of the first one.
+            if first == 0:
+                ifp.seek(first_pos)
+                block_iv = iv
+            else:
+                ifp.seek(first_pos + (first - 1) * blocksize)
+                block_iv = read_full(ifp, blocksize)
+            return Cipher(algorithms.AES(key), modes.CBC(block_iv), backend=default_backend()).decryptor()
+
+        # The size comes from the padding in the last block.
+        num = body // blocksize
+        last_block = self._pkcs7_unpad(get_decryptor(num - 1).update(read_full(ifp, blocksize)))
+        size = body - blocksize + len(last_block)
+        start, stop, _ = slice(start, stop).indices(size)
+        if start >= stop:
+            return 0
+
+        # The blocks are decrypted a chunk at a time, the padding is
+        # past stop.
+        offset = start // blocksize * blocksize
+        decryptor = get_decryptor(offset // blocksize)
+        while offset < stop:
+            plaintext = decryptor.update(read_full(ifp, min(CHUNK_SIZE, stop - offset + blocksize - 1)
+                                                   // blocksize * blocksize))
+            ofp.write(memoryview(plaintext)[max(0, start - offset):stop - offset])
+            offset += len(plaintext)
+        return stop - start
+
+    def _decrypt_segment_range(self, password, ifp, ofp, pos, head, start, stop):
+        '''
+        Decrypt part of the plaintext of data in the segmented format.
+
+        @param password  The password.
+        @param ifp       The seekable input stream.
+        @param ofp       The plaintext output stream.
+        @param pos       The position of the header in the stream.
+        @param head      The start of the header that was already read.
+        @param start     The offset of the first byte.
+        @param stop      The offset after the last byte, None for the
+                         end.
+        @returns the number of bytes written.
+        '''
+        aead, header, nonce_prefix, segment_size = self._get_segment_key(password, ifp, head)
+        first_pos = pos + len(header)
+        segment_len = segment_size + SEGMENT_TAG_LEN
+        body = ifp.seek(0, os.SEEK_END) - first_pos
+        num = -(-body // segment_len)
+        last_len = body - (num - 1) * segment_len
+        if num == 0:
+            raise ValueError('locked data has no content')
+        if last_len < SEGMENT_TAG_LEN:
+            raise ValueError('locked data is truncated')
+        size = (num - 1) * segment_size + last_len - SEGMENT_TAG_LEN
+        start, stop, _ = slice(start, stop).indices(size)
+        if start >= stop:
+            return 0
+        for index in range(start // segment_size, (stop - 1) // segment_size + 1):
+            ifp.seek(first_pos + index * segment_len)
+            nonce = get_segment_nonce(nonce_prefix, index, index == num - 1)
+            plaintext = decrypt_segment(aead, header, nonce, read_full(ifp, segment_len))
+            offset = index * segment_size
+            ofp.write(memoryview(plaintext)[max(0, start - offset):stop - offset])
+        return stop - start
+
+    def _get_segment_key(self, password, ifp, head):
+        '''
+        Read the rest of the segmented format header and derive the
+        key.
+
+        @param password  The password.
+        @param ifp       The input stream.
+        @param head      The start of the header that was already read.
+        @returns the AES-GCM cipher, the header, the nonce prefix and
+                 the segment size.
+        '''
+        size = get_header(SEGMENT_HEADERS, head).size
+        header = head + read_full(ifp, size - len(head))
+        if len(header) < size:
+            raise ValueError('locked data is too short')
+        fields = get_header(SEGMENT_HEADERS, header).unpack(header)
+        _, _, kdf_id, cost, r, p, run_salt, file_salt, nonce_prefix, segment_size = fields[:10]
+        if not 1 <= segment_size <= SEGMENT_MAX_SIZE:
+            raise ValueError('invalid segment size {}'.format(segment_size))
+        master_key = get_master_key(password, kdf_id, cost, r, p, run_salt)
+        if len(fields) > 10:
+            self._check_key(master_key, file_salt, fields[10])
+        key = self._get_file_key(master_key, file_salt, b'lock_files segment key')
+        return AESGCM(key), header, nonce_prefix, segment_size
+
+    def _get_segment_reader(self, password, ifp, head):
+        '''
+        Read the rest of the segmented format header and create the
+        reader for the segments.
+
+        @param password  The password.
+        @param ifp       The input stream.
+        @param head      The start of the header that was already read.
+        '''
+        aead, header, nonce_prefix, segment_size = self._get_segment_key(password, ifp, head)
+        armor = RawReader(ifp, segment_size + SEGMENT_TAG_LEN)
+        armor.m_read += len(header)
+        return SegmentReader(aead, header, nonce_prefix, segment_size, armor)
 
     def _get_password_key(self, password):
         '''
@@ -266,6 +830,7 @@ class AESCipher:
         @param password  The password to use as the seed.
         @param salt      The salt.
         '''
+        start = timing_clock()
         try:
             # Ignore is okay here because it will be symmetric for
             # both encrypt and decrypt operations.
@@ -278,6 +843,7 @@ class AESCipher:
                 keyiv += digest  # append the last 16 bytes
             key = keyiv[:self.m_keylen]
             iv = keyiv[self.m_keylen:self.m_keylen + self.m_ivlen]
+            timing_add('kdf', start)
             return key, iv
         except UnicodeDecodeError as exc:
             err('failed to generate key and iv: {}'.format(exc))
@@ -324,172 +890,2350 @@ class AESCipher:
         Works for python 2/3.
         '''
         if isinstance(padded, str):
-            unpadded_len = ord(padded[-1])
-        elif isinstance(padded, bytes):
-            unpadded_len = padded[-1]
+            return padded[:-self._pkcs7_check(bytearray(padded, 'latin-1'))]
+        elif isinstance(padded, (bytes, bytearray)):
+            return padded[:-self._pkcs7_check(padded)]
         else:
             assert False
-        return padded[:-unpadded_len]
 
+    def _pkcs7_check(self, padded):
+        '''
+        Check the PKCS#7 padding.
 
-# ================================================================
-#
-# Message Utility Functions.
-#
-# ================================================================
-def _msg(prefix, msg, level, ofp):
-    '''
-    Thread safe message reporting.
-    '''
-    th_mutex.acquire()
-    try:
-        ofp.write('{}:{} {}\n'.format(prefix, inspect.stack()[level][2], msg))
-    finally:
-        th_mutex.release()
+        A wrong password or modified data almost never decrypts to
+        valid padding so this is the only check for the formats that
+        are not authenticated.
+
+        @param padded  The padded bytes.
+        @returns the number of padding bytes.
+        '''
+        num = padded[-1] if padded else 0
+        if num < 1 or num > self.m_ivlen or len(padded) < num or \
+           padded[-num:] != bytes(bytearray([num] * num)):
+            raise ValueError('bad padding, the password is wrong or the data was modified')
+        return num
 
 
-def info(msg, level=1, ofp=sys.stdout):
+class EncryptWriter:
     '''
-    Display a simple information message with context information.
+    Write only stream that encrypts the data written to it.
+
+    Use AESCipher.encrypt_writer() to create it.
     '''
-    _msg('INFO', msg, level+1, ofp)
+    def __init__(self, encryptor, armor, blocksize, handoff=False):
+        '''
+        Initialize the object.
 
+        @param encryptor  The CBC encryptor.
+        @param armor      The ArmorWriter or RawWriter for the output.
+        @param blocksize  The cipher block size.
+        @param handoff    The armor keeps the buffers written to it,
+                          see WriteBehind.
+        '''
+        self.m_encryptor = encryptor
+        self.m_armor = armor
+        self.m_blocksize = blocksize
+        self.m_handoff = handoff
+        self.m_obuf = memoryview(bytearray(0))  # reused for every write unless handed off
+        self.m_read = 0
+
+    def write(self, data):
+        '''
+        Encrypt the data.
+        '''
+        view = memoryview(data)
+        if len(view) == 0:
+            return 0
+        if len(self.m_obuf) < len(view) + self.m_blocksize - 1:
+            self.m_obuf = memoryview(bytearray(len(view) + self.m_blocksize - 1))
+        start = timing_clock()
+        num = self.m_encryptor.update_into(view, self.m_obuf)
+        timing_add('aes', start)
+        self.m_armor.write(self.m_obuf[:num])
+        if self.m_handoff is True:
+            self.m_obuf = memoryview(bytearray(0))
+        self.m_read += len(view)
+        return len(view)
+
+    def close(self):
+        '''
+        Pad and write the last block.
 
-def infov(opts, msg, level=1, ofp=sys.stdout):
-    '''
-    Display a simple information message with context information.
-    '''
-    if opts.verbose:
-        _msg('INFO', msg, level+1, ofp)
+        @returns the number of bytes read and written.
+        '''
+        if self.m_encryptor is not None:
+            # Only the last block is padded.
+            num_bytes = self.m_blocksize - (self.m_read % self.m_blocksize)
+            padding = bytes(bytearray([num_bytes] * num_bytes))
+            self.m_armor.write(self.m_encryptor.update(padding) + self.m_encryptor.finalize())
+            self.m_armor.close()
+            self.m_encryptor = None
+        return self.m_read, self.m_armor.m_written
 
 
-def infov2(opts, msg, level=1, ofp=sys.stdout):
+class DecryptReader:
     '''
-    Display a simple information message with context information.
+    Read only stream of the plaintext of locked data.
+
+    Use AESCipher.decrypt_reader() to create it.
     '''
-    if opts.verbose > 1:
-        _msg('INFO', msg, level+1, ofp)
+    def __init__(self, decryptor, armor, data, blocksize, unpad):
+        '''
+        Initialize the object.
 
+        @param decryptor  The CBC decryptor from get_cbc_decryptor().
+        @param armor      The ArmorReader or RawReader for the input.
+        @param data       Ciphertext that was already read after the
+                          header.
+        @param blocksize  The cipher block size.
+        @param unpad      Function that removes the padding.
+        '''
+        self.m_decryptor = decryptor
+        self.m_armor = armor
+        self.m_data = data
+        self.m_blocksize = blocksize
+        self.m_unpad = unpad
+        self.m_buf = bytearray()
+        self.m_view = memoryview(self.m_buf)
+        self.m_held = 0  # decrypted bytes at the start of m_buf
+        self.m_handoff = False  # the caller keeps the chunks, see WriteBehind
+        self.m_done = False
+        self.m_rest = memoryview(b'')  # the part of the last chunk that read() did not return
+
+    def read_chunk(self):
+        '''
+        Decrypt the next chunk.
 
-def err(msg, level=1, ofp=sys.stdout):
-    '''
-    Display error message with context information and exit.
-    '''
-    _msg('ERROR', msg, level+1, ofp)
-    abort_threads()
-    sys.exit(1)
+        The plaintext is decrypted into a reusable buffer. The last
+        block is held back at the start of the buffer until the end
+        because it contains the padding.
+
+        @returns a memoryview of the plaintext that is only valid
+                 until the next call unless m_handoff is set, it is
+                 empty at the end.
+        '''
+        blocksize = self.m_blocksize
+        while self.m_done is False:
+            if self.m_held > blocksize:
+                # The chunk returned by the last call has been used,
+                # a handed off chunk keeps its buffer.
+                last = self.m_buf[self.m_held - blocksize:self.m_held]
+                if self.m_handoff is True:
+                    self.m_buf = bytearray(len(self.m_buf))
+                    self.m_view = memoryview(self.m_buf)
+                self.m_view[:blocksize] = last
+                self.m_held = blocksize
+            data, self.m_data = self.m_data, b''
+            if not data:
+                data = self.m_armor.read()
+            if not data:
+                self.m_done = True
+                self.m_decryptor.finalize()
+                if self.m_held == 0:
+                    raise ValueError('locked data has no content')
+                return memoryview(self.m_unpad(bytes(self.m_view[:self.m_held])))
+            if len(self.m_buf) < self.m_held + len(data) + blocksize - 1:
+                self.m_buf = bytearray(self.m_buf[:self.m_held]) + bytearray(len(data) + blocksize - 1)
+                self.m_view = memoryview(self.m_buf)
+            start = timing_clock()
+            self.m_held += self.m_decryptor.update_into(data, self.m_view[self.m_held:])
+            timing_add('aes', start)
+            if self.m_held > blocksize:
+                return self.m_view[:self.m_held - blocksize]
+        return memoryview(b'')
+
+    def read(self, size=-1):
+        '''
+        Read up to size bytes of plaintext, all of it if size is
+        negative.
+        '''
+        parts = []
+        num = 0
+        while size < 0 or num < size:
+            if len(self.m_rest) == 0:
+                self.m_rest = self.read_chunk()
+                if len(self.m_rest) == 0:
+                    break
+            take = len(self.m_rest) if size < 0 else min(size - num, len(self.m_rest))
+            parts.append(self.m_rest[:take].tobytes())
+            self.m_rest = self.m_rest[take:]
+            num += take
+        return b''.join(parts)
 
 
-def errn(msg, level=1, ofp=sys.stdout):
+class ParallelDecryptor:
     '''
-    Display error message with context information but do not exit.
-    '''
-    _msg('ERROR', msg, level+1, ofp)
+    AES-CBC decryptor that decrypts large updates in the cipher pool.
 
+    Each plaintext block only depends on its own ciphertext block and
+    the one in front of it, so a block aligned range can be decrypted
+    on its own using the ciphertext block in front of it as the IV.
+    The ranges of an update are decrypted at the same time and the
+    result is identical to a sequential decryption.
 
-def warn(msg, level=1, ofp=sys.stdout):
-    '''
-    Display error message with context information but do not exit.
+    It has the update_into() and finalize() calls of a cryptography
+    decryptor, use get_cbc_decryptor() to create it.
     '''
-    _msg('WARNING', msg, level+1, ofp)
+    def __init__(self, key, iv, pool, jobs):
+        '''
+        Initialize the object.
 
+        @param key   The key.
+        @param iv    The IV.
+        @param pool  The cipher pool.
+        @param jobs  The number of threads in the pool.
+        '''
+        self.m_key = key
+        self.m_prev = bytes(iv)  # the last ciphertext block
+        self.m_carry = bytearray(len(iv))  # a partial block left by the last update
+        self.m_ncarry = 0
+        self.m_scratch = bytearray(2 * len(iv) - 1)
+        self.m_decryptor = None  # sequential decryptor that continues from m_prev
+        self.m_pool = pool
+        self.m_jobs = jobs
+
+    def update_into(self, data, out):
+        '''
+        Decrypt the data into out which must have room for an extra
+        block like the cryptography call requires.
 
-def _println(msg, ofp=sys.stdout):
-    '''
-    Print a message with a new line.
-    '''
-    th_mutex.acquire()
-    try:
-        ofp.write(msg + '\n')
-    finally:
-        th_mutex.release()
+        @returns the number of bytes decrypted.
+        '''
+        blocksize = len(self.m_prev)
+        view = memoryview(data)
+        out = memoryview(out)
+        done = 0
+        if self.m_ncarry > 0:
+            # Complete the partial block, only it is copied.
+            num = min(blocksize - self.m_ncarry, len(view))
+            self.m_carry[self.m_ncarry:self.m_ncarry + num] = view[:num]
+            self.m_ncarry += num
+            view = view[num:]
+            if self.m_ncarry < blocksize:
+                return 0
+            done = self._serial(self.m_carry, out)
+            self.m_prev = bytes(self.m_carry)
+            self.m_ncarry = 0
+        num = len(view) - (len(view) % blocksize)
+        self.m_carry[:len(view) - num] = view[num:]
+        self.m_ncarry = len(view) - num
+        if num == 0:
+            return done
+
+        # The aligned part is decrypted straight into out, except for
+        # a last block that does not leave the extra block of room.
+        out = out[done:]
+        direct = min(num, (len(out) - blocksize + 1) // blocksize * blocksize)
+        nranges = min(self.m_jobs, direct // CBC_RANGE_MIN)
+        if nranges < 2:
+            if direct > 0:
+                self._serial(view[:direct], out)
+        else:
+            self.m_decryptor = None
+            step = -(-direct // blocksize // nranges) * blocksize
+            futures = []
+            for start in range(0, direct, step):
+                iv = self.m_prev if start == 0 else view[start - blocksize:start]
+                stop = min(start + step, direct)
+                futures.append(self.m_pool.submit(self._decrypt_into, iv, view[start:stop],
+                                                  out[start:stop + blocksize - 1]))
+            for future in futures:
+                future.result()
+            self.m_prev = view[direct - blocksize:direct].tobytes()
+        if direct < num:
+            self._serial(view[direct:num], out[direct:])
+        self.m_prev = view[num - blocksize:num].tobytes()
+        return done + num
+
+    def finalize(self):
+        '''
+        Check that all of the data was decrypted.
+        '''
+        if self.m_ncarry > 0:
+            raise ValueError('The length of the provided data is not a multiple of the block length.')
+        return b''
 
+    def _decryptor(self, iv):
+        '''
+        Get a decryptor for a range.
+        '''
+        return Cipher(algorithms.AES(self.m_key), modes.CBC(bytes(iv)), backend=default_backend()).decryptor()
 
-# ================================================================
-#
-# Thread utility functions.
-#
-# ================================================================
-def abort_threads():
-    '''
-    Set the abort flag.
-    '''
-    th_mutex.acquire()
-    try:
-        global th_abort
-        th_abort = True
-    finally:
-        th_mutex.release()
+    def _serial(self, data, out):
+        '''
+        Decrypt in this thread, the decryptor is kept until a
+        parallel update moves past it.
+
+        A single block that out has no extra room for is decrypted
+        into a scratch block and copied.
+        '''
+        if self.m_decryptor is None:
+            self.m_decryptor = self._decryptor(self.m_prev)
+        if len(out) >= len(data) + len(self.m_prev) - 1:
+            return self.m_decryptor.update_into(data, out)
+        num = self.m_decryptor.update_into(data, self.m_scratch)
+        out[:num] = self.m_scratch[:num]
+        return num
+
+    def _decrypt_into(self, iv, data, out):
+        '''
+        Decrypt a range.
+        '''
+        return self._decryptor(iv).update_into(data, out)
 
 
-def get_num_cores():
+class SegmentWriter:
     '''
-    Get the number of available cores.
-    Unforunately, multiprocessing.cpu_count() uses _NPROCESSORS_ONLN
-    which may be different than the actual number of cores available
-    if power saving mode is enabled.
-
-    On Linux and Mac we can use "getconf _NPROCESSORS_CONF", I have
-    no idea how to get it on windows, maybe some WMIC call.
+    Write only stream that encrypts the data written to it in the
+    segmented format.
+
+    The data is split into segments that are encrypted with AES-GCM
+    by the cipher thread pool so that a single large file can use
+    all of the -j threads. Each segment nonce is made of the random
+    nonce prefix from the header, the segment number and a flag that
+    marks the last segment so segments cannot be reordered, dropped
+    or truncated without failing authentication. The header is
+    authenticated with every segment.
+
+    Use AESCipher.encrypt_writer() to create it.
     '''
-    if os.name == 'posix':
-        # should be able to run getconf.
-        try:
-            out = subprocess.check_output('getconf _NPROCESSORS_CONF', stderr=subprocess.STDOUT, shell=True)
-            return int(out.strip())
-        except subprocess.CallProcessError as exc:
-            err('command failed: {}'.format(exc))
+    def __init__(self, aead, header, nonce_prefix, segment_size, armor):
+        '''
+        Initialize the object.
 
-    return multiprocessing.cpu_count()
+        @param aead          The AES-GCM cipher.
+        @param header        The header, it has already been written.
+        @param nonce_prefix  The nonce prefix from the header.
+        @param segment_size  The number of plaintext bytes in a segment.
+        @param armor         The RawWriter for the output.
+        '''
+        self.m_aead = aead
+        self.m_header = header
+        self.m_nonce_prefix = nonce_prefix
+        self.m_segment_size = segment_size
+        self.m_armor = armor
+        self.m_pool = get_cipher_pool()
+        self.m_window = collections.deque()  # segments in the pool, in order
+        self.m_buf = bytearray()
+        self.m_index = 0
+        self.m_read = 0
+        self.m_closed = False
+
+    def write(self, data):
+        '''
+        Encrypt the data.
 
+        A full segment is only encrypted when more data arrives
+        because the last segment is flagged.
+        '''
+        view = memoryview(data)
+        self.m_buf += view
+        self.m_read += len(view)
+        while len(self.m_buf) > self.m_segment_size:
+            self._submit(bytes(self.m_buf[:self.m_segment_size]), False)
+            del self.m_buf[:self.m_segment_size]
+        return len(view)
+
+    def close(self):
+        '''
+        Encrypt the last segment and wait for the rest.
 
-def thread_process_file(opts, password, entry, stats):
-    '''
-    Thread worker.
+        @returns the number of bytes read and written.
+        '''
+        if self.m_closed is False:
+            self.m_closed = True
+            self._submit(bytes(self.m_buf), True)
+            self.m_buf = bytearray()
+            while self.m_window:
+                self.m_armor.write(self._result(self.m_window.popleft()))
+            self.m_armor.close()
+        return self.m_read, self.m_armor.m_written
+
+    def _submit(self, data, last):
+        '''
+        Encrypt a segment in the pool, the segments are written in
+        order as they complete.
+        '''
+        nonce = get_segment_nonce(self.m_nonce_prefix, self.m_index, last)
+        self.m_index += 1
+        if self.m_pool is None:
+            start = timing_clock()
+            ciphertext = self.m_aead.encrypt(nonce, data, self.m_header)
+            timing_add('aes', start)
+            self.m_armor.write(ciphertext)
+            return
+        self.m_window.append(self.m_pool.submit(self.m_aead.encrypt, nonce, data, self.m_header))
+        while len(self.m_window) > 2 * th_cipher_jobs:
+            self.m_armor.write(self._result(self.m_window.popleft()))
+
+    def _result(self, future):
+        '''
+        Wait for a segment, the wait is counted as aes time.
+        '''
+        start = timing_clock()
+        ciphertext = future.result()
+        timing_add('aes', start)
+        return ciphertext
 
-    Waits for the semaphore to make a slot available, then
-    runs the specified function.
+
+class SegmentReader(DecryptReader):
     '''
-    if th_abort is False:
-        with th_semaphore:
-            process_file(opts, password, entry, stats)
+    Read only stream of the plaintext of data in the segmented format.
 
+    The segments are decrypted in the cipher thread pool, see
+    SegmentWriter.
 
-def wait_for_threads():
-    '''
-    Wait for threads to complete.
+    Use AESCipher.decrypt_reader() to create it.
     '''
-    for th in threading.enumerate():
-        if th == threading.currentThread():
-            continue
-        th.join()
+    def __init__(self, aead, header, nonce_prefix, segment_size, armor):  # pylint: disable=super-init-not-called
+        '''
+        Initialize the object.
 
+        @param aead          The AES-GCM cipher.
+        @param header        The header.
+        @param nonce_prefix  The nonce prefix from the header.
+        @param segment_size  The number of plaintext bytes in a segment.
+        @param armor         The RawReader for the input, it returns
+                             one segment at a time.
+        '''
+        self.m_aead = aead
+        self.m_header = header
+        self.m_nonce_prefix = nonce_prefix
+        self.m_segment_size = segment_size
+        self.m_armor = armor
+        self.m_pool = get_cipher_pool()
+        self.m_window = collections.deque()  # segments in the pool, in order
+        self.m_index = 0
+        self.m_next = armor.read()  # read one segment ahead to find the last one
+        self.m_done = False
+        self.m_rest = memoryview(b'')
+        if not self.m_next:
+            raise ValueError('locked data has no content')
+
+    def read_chunk(self):
+        '''
+        Decrypt the next segment.
 
-# ================================================================
-#
-# Program specific functions.
-#
-# ================================================================
-def get_err_fct(opts):
-    '''
-    Get the message function: error or warning depending on
-    the --warn setting.
-    '''
-    if opts.warn is True:
-        return warn
-    return err
+        @returns the plaintext, it is empty at the end.
+        '''
+        limit = 1 if self.m_pool is None else 2 * th_cipher_jobs
+        while self.m_done is False and len(self.m_window) < limit:
+            data, self.m_next = self.m_next, self.m_armor.read()
+            last = not self.m_next
+            nonce = get_segment_nonce(self.m_nonce_prefix, self.m_index, last)
+            self.m_index += 1
+            self.m_done = last
+            if self.m_pool is None:
+                self.m_window.append(self._decrypt(nonce, data))
+            else:
+                self.m_window.append(self.m_pool.submit(self._decrypt, nonce, data))
+        if not self.m_window:
+            return memoryview(b'')
+        result = self.m_window.popleft()
+        if self.m_pool is not None:
+            start = timing_clock()
+            result = result.result()
+            timing_add('aes', start)
+        return memoryview(result)
+
+    def _decrypt(self, nonce, data):
+        '''
+        Decrypt and authenticate a segment.
+        '''
+        if self.m_pool is not None:
+            return decrypt_segment(self.m_aead, self.m_header, nonce, data)
+        start = timing_clock()
+        plaintext = decrypt_segment(self.m_aead, self.m_header, nonce, data)
+        timing_add('aes', start)
+        return plaintext
 
 
-def stat_inc(stats, key, value=1):
+class MmapFile:
     '''
-    Increment the stat in a synchronous way using a mutex
-    to coordinate between threads.
+    Read only stream backed by a memory mapped file.
+
+    It supports the read() and readinto() calls of a regular file
+    plus readview() which returns a memoryview of the mapping so that
+    the data can be used directly from the page cache without being
+    copied.
     '''
-    th_mutex.acquire()
-    try:
-        stats[key] += value
-    finally:  # avoid deadlock from exception
-        th_mutex.release()
+    def __init__(self, ifp):
+        '''
+        Map the file.
+
+        @param ifp  The open file, it must not be empty.
+        '''
+        self.m_mmap = mmap.mmap(ifp.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self.m_mmap, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.m_mmap.madvise(mmap.MADV_SEQUENTIAL)
+        self.m_view = memoryview(self.m_mmap)
+        self.m_pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=-1):
+        '''
+        Read up to size bytes.
+        '''
+        return self.readview(size).tobytes()
+
+    def readinto(self, buf):
+        '''
+        Read into a preallocated buffer.
+        '''
+        view = self.readview(len(buf))
+        buf[:len(view)] = view
+        return len(view)
+
+    def readview(self, size=-1):
+        '''
+        Get a view of up to the next size bytes without copying them.
+        '''
+        end = len(self.m_view) if size < 0 else min(self.m_pos + size, len(self.m_view))
+        view = self.m_view[self.m_pos:end]
+        self.m_pos = end
+        return view
+
+    def close(self):
+        '''
+        Unmap the file.
+        '''
+        if self.m_view is not None:
+            self.m_view.release()
+            self.m_view = None
+            try:
+                self.m_mmap.close()
+            except BufferError:
+                pass  # a view is still referenced, it is unmapped when that is released
+
+
+class Stats:
+    '''
+    Counters that are sharded per thread.
+
+    Each thread increments the counters in its own shard so the
+    workers never wait for each other, the shards are only added up
+    when the counters are read.
+    '''
+    def __init__(self, initial=None):
+        '''
+        Initialize the object.
+
+        @param initial  The counters and their initial values.
+        '''
+        self.m_base = dict(initial or {})
+        self.m_shards = []
+        self.m_local = threading.local()
+        self.m_mutex = Lock()  # only used to add a shard
+
+    def inc(self, key, value=1):
+        '''
+        Increment a counter.
+        '''
+        shard = getattr(self.m_local, 'shard', None)
+        if shard is None:
+            shard = collections.defaultdict(int)
+            self.m_local.shard = shard
+            with self.m_mutex:
+                self.m_shards.append(shard)
+        shard[key] += value
+
+    def snapshot(self):
+        '''
+        Add up the shards.
+
+        @returns a dict of the counters.
+        '''
+        with self.m_mutex:
+            shards = list(self.m_shards)
+        result = dict(self.m_base)
+        for shard in shards:
+            for key, value in shard.copy().items():  # copy() is atomic
+                result[key] = result.get(key, 0) + value
+        return result
+
+    def __getitem__(self, key):
+        '''
+        Get a counter.
+        '''
+        with self.m_mutex:
+            shards = list(self.m_shards)
+        return self.m_base.get(key, 0) + sum(shard.get(key, 0) for shard in shards)
+
+
+# ================================================================
+#
+# Armor classes.
+#
+# ================================================================
+class ArmorWriter:
+    '''
+    Incremental base64 encoder that writes lines of a fixed width.
+
+    The output is the same as encoding all of the data at once and
+    breaking it into lines afterwards but each block of data is
+    encoded with a single call and written with a single write
+    instead of one write per line.
+    '''
+    def __init__(self, ofp, width=0):
+        '''
+        Initialize the object.
+
+        @param ofp    The output stream.
+        @param width  The line width, 0 means no new lines.
+        '''
+        self.m_ofp = ofp
+        self.m_width = width
+        self.m_binary = b''  # binary data not yet encoded
+        self.m_line = b''  # encoded data of the last partial line
+        self.m_written = 0
+
+    def write(self, data):
+        '''
+        Encode the data, the last 0-2 bytes are held back so that
+        there is no padding until the end.
+
+        The data can be a memoryview of a buffer that the caller
+        reuses, nothing refers to it after the call.
+        '''
+        view = memoryview(data)
+        if self.m_binary:
+            # Complete the bytes held back by the last call separately
+            # so that the data does not have to be copied.
+            num = min(3 - len(self.m_binary), len(view))
+            self.m_binary += view[:num].tobytes()
+            view = view[num:]
+            if len(self.m_binary) < 3:
+                return
+            self._emit(base64.b64encode(self.m_binary))
+        num = len(view) - (len(view) % 3)
+        self.m_binary = view[num:].tobytes()
+        if num > 0:
+            start = timing_clock()
+            text = base64.b64encode(view[:num])
+            timing_add('base64', start)
+            self._emit(text)
+
+    def close(self):
+        '''
+        Encode the remaining data and write the last line.
+        '''
+        if self.m_binary:
+            self._emit(base64.b64encode(self.m_binary))
+            self.m_binary = b''
+        if self.m_line:
+            self._write(self.m_line + b'\n')
+            self.m_written += len(self.m_line)
+            self.m_line = b''
+
+    def _emit(self, text):
+        '''
+        Write all of the complete lines in a single write.
+        '''
+        width = self.m_width
+        if width < 1:
+            self._write(text)
+            self.m_written += len(text)
+            return
+
+        # Complete the partial line from the last call.
+        start = timing_clock()
+        lines = []
+        first = 0
+        if self.m_line:
+            first = width - len(self.m_line)
+            if len(text) < first:
+                self.m_line += text
+                timing_add('wrap', start)
+                return
+            lines.append(self.m_line + text[:first])
+
+        end = len(text) - ((len(text) - first) % width)
+        lines.extend([text[i:i+width] for i in range(first, end, width)])
+        if lines:
+            lines.append(b'')  # for the trailing new line
+            lines = b'\n'.join(lines)
+        timing_add('wrap', start)
+        if lines:
+            self._write(lines)
+        self.m_written += end + len(self.m_line)
+        self.m_line = text[end:]
+
+    def _write(self, data):
+        '''
+        Write to the output stream.
+        '''
+        start = timing_clock()
+        self.m_ofp.write(data)
+        timing_add('write', start)
+
+
+class ArmorReader:
+    '''
+    Incremental base64 decoder.
+
+    Lines that start with # are comments and are skipped. All other
+    characters that are not part of the base64 alphabet, like new
+    lines, are discarded the same way that base64.b64decode() does.
+    '''
+    m_alphabet = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='
+    m_ignore = bytes(bytearray(set(range(256)) - set(bytearray(m_alphabet))))
+
+    def __init__(self, ifp, chunk_size=CHUNK_SIZE, head=b''):
+        '''
+        Initialize the object.
+
+        @param ifp         The input stream.
+        @param chunk_size  The number of bytes to read at a time.
+        @param head        Data that was already read from ifp.
+        '''
+        self.m_ifp = ifp
+        self.m_chunk_size = chunk_size
+        self.m_text = b''  # encoded data not yet decoded
+        self.m_bol = True  # at the beginning of a line
+        self.m_comment = False  # in a comment line
+        self.m_head = head
+        self.m_read = len(head)
+
+    def read(self):
+        '''
+        Read and decode the next chunk.
+
+        @returns the decoded data or an empty string at the end.
+        '''
+        while True:
+            if self.m_head:
+                data, self.m_head = self.m_head, b''
+            else:
+                start = timing_clock()
+                data = self.m_ifp.read(self.m_chunk_size)
+                timing_add('read', start)
+                self.m_read += len(data)
+            start = timing_clock()
+            if not data:
+                text, self.m_text = self.m_text, b''
+                data = binascii.a2b_base64(text) if text else b''
+                timing_add('base64', start)
+                return data
+            text = self._strip(data)
+            if self.m_text:
+                text = self.m_text + text
+            num = len(text) - (len(text) % 4)
+            self.m_text = text[num:]
+            if num > 0:
+                data = binascii.a2b_base64(text[:num])
+                timing_add('base64', start)
+                return data
+            timing_add('base64', start)
+
+    def _strip(self, data):
+        '''
+        Remove the comments and the characters that are not part of
+        the base64 alphabet.
+
+        Comments are rare so the common case is a single translate()
+        call for the whole chunk.
+        '''
+        if self.m_comment is False and (b'#' not in data):
+            self.m_bol = data[-1:] == b'\n'
+            return data.translate(None, self.m_ignore)
+
+        parts = []
+        pos = 0
+        while pos < len(data):
+            if self.m_bol is True:
+                self.m_comment = data[pos:pos+1] == b'#'
+            nl = data.find(b'\n', pos)
+            end = len(data) if nl < 0 else nl + 1
+            if self.m_comment is False:
+                parts.append(data[pos:end])
+            self.m_bol = nl >= 0
+            if self.m_bol is True:
+                self.m_comment = False
+            pos = end
+        return b''.join(parts).translate(None, self.m_ignore)
+
+
+class RawWriter:
+    '''
+    Writer with the same interface as ArmorWriter for binary
+    output.
+    '''
+    def __init__(self, ofp):
+        '''
+        Initialize the object.
+
+        @param ofp    The output stream.
+        '''
+        self.m_ofp = ofp
+        self.m_written = 0
+
+    def write(self, data):
+        '''
+        Write the data.
+        '''
+        start = timing_clock()
+        self.m_ofp.write(data)
+        timing_add('write', start)
+        self.m_written += len(data)
+
+    def close(self):
+        '''
+        Nothing is buffered.
+        '''
+        pass
+
+
+class RawReader:
+    '''
+    Reader with the same interface as ArmorReader for binary
+    input.
+    '''
+    def __init__(self, ifp, chunk_size=CHUNK_SIZE, head=b''):
+        '''
+        Initialize the object.
+
+        @param ifp         The input stream.
+        @param chunk_size  The number of bytes to read at a time.
+        @param head        Data that was already read from ifp.
+        '''
+        self.m_ifp = ifp
+        self.m_read_fct = getattr(ifp, 'readview', ifp.read)  # avoid copies for mmap input
+        self.m_chunk_size = chunk_size
+        self.m_head = head
+        self.m_read = len(head)
+
+    def read(self):
+        '''
+        Read the next chunk.
+
+        @returns the data or an empty string at the end.
+        '''
+        if self.m_head:
+            data, self.m_head = self.m_head, b''
+            return data
+        start = timing_clock()
+        data = self.m_read_fct(self.m_chunk_size)
+        if 0 < len(data) < self.m_chunk_size:
+            # Only the last chunk is short so that the segmented
+            # format can read one segment at a time.
+            data = bytes(data) + read_full(self.m_read_fct, self.m_chunk_size - len(data))
+        timing_add('read', start)
+        self.m_read += len(data)
+        return data
+
+
+# ================================================================
+#
+# Pipeline classes.
+#
+# ================================================================
+class ByteQueue:
+    '''
+    Queue that is bounded by the number of bytes in it rather than
+    the number of items.
+
+    An item that is larger than the limit is accepted when the queue
+    is empty so that it cannot block forever.
+    '''
+    def __init__(self, limit):
+        '''
+        Initialize the object.
+
+        @param limit  The maximum number of bytes in the queue.
+        '''
+        self.m_limit = limit
+        self.m_items = collections.deque()
+        self.m_bytes = 0
+        self.m_closed = False
+        self.m_cond = threading.Condition()
+
+    def put(self, item, size):
+        '''
+        Add an item, blocks while the queue is full.
+
+        @param item  The item.
+        @param size  The number of bytes in the item.
+        @returns False if the queue was closed.
+        '''
+        with self.m_cond:
+            while self.m_bytes > 0 and self.m_bytes + size > self.m_limit and self.m_closed is False:
+                self.m_cond.wait()
+            if self.m_closed is True:
+                return False
+            self.m_items.append((item, size))
+            self.m_bytes += size
+            self.m_cond.notify_all()
+            return True
+
+    def get(self):
+        '''
+        Remove the next item, blocks while the queue is empty.
+        '''
+        with self.m_cond:
+            while not self.m_items:
+                self.m_cond.wait()
+            item, size = self.m_items.popleft()
+            self.m_bytes -= size
+            self.m_cond.notify_all()
+            return item
+
+    def close(self):
+        '''
+        Discard the items that are added from now on and release the
+        producer if it is blocked.
+        '''
+        with self.m_cond:
+            self.m_closed = True
+            self.m_cond.notify_all()
+
+
+class ReadAhead:
+    '''
+    Input stream that reads ahead in its own thread so that the reads
+    overlap with the work that is done on the data.
+    '''
+    def __init__(self, ifp, chunk_size, limit):
+        '''
+        Start reading.
+
+        @param ifp         The input stream.
+        @param chunk_size  The number of bytes to read at a time.
+        @param limit       The maximum number of bytes read ahead.
+        '''
+        self.m_queue = ByteQueue(limit)
+        self.m_view = memoryview(b'')
+        self.m_eof = False
+        self.m_thread = Thread(target=self._run, args=(ifp, chunk_size))
+        self.m_thread.daemon = True
+        self.m_thread.start()
+
+    def _run(self, ifp, chunk_size):
+        '''
+        Read the chunks, an empty chunk marks the end.
+        '''
+        try:
+            while True:
+                data = ifp.read(chunk_size)
+                if self.m_queue.put(data, len(data)) is False or not data:
+                    return
+        except Exception as exc:  # pylint: disable=broad-except
+            self.m_queue.put(exc, 0)  # raised by the reader
+
+    def readview(self, size=-1):
+        '''
+        Get a view of up to the next size bytes without copying them.
+        '''
+        while len(self.m_view) == 0 and self.m_eof is False:
+            item = self.m_queue.get()
+            if isinstance(item, Exception):
+                self.m_eof = True
+                raise item
+            if not item:
+                self.m_eof = True
+            self.m_view = memoryview(item)
+        num = len(self.m_view) if size < 0 else min(size, len(self.m_view))
+        view = self.m_view[:num]
+        self.m_view = self.m_view[num:]
+        return view
+
+    def read(self, size=-1):
+        '''
+        Read up to size bytes, all of the rest if size is negative.
+        '''
+        parts = []
+        num = 0
+        while size < 0 or num < size:
+            view = self.readview(-1 if size < 0 else size - num)
+            if len(view) == 0:
+                break
+            parts.append(view.tobytes())
+            num += len(view)
+        return b''.join(parts)
+
+    def close(self):
+        '''
+        Stop reading.
+        '''
+        self.m_queue.close()
+        self.m_thread.join()
+
+
+class WriteBehind:
+    '''
+    Output stream that writes in its own thread so that the writes
+    overlap with the work that produces the data.
+
+    The buffers written to it are queued as they are, the producers
+    that reuse a buffer check m_handoff and use a fresh one for every
+    write instead.
+    '''
+    def __init__(self, ofp, limit):
+        '''
+        Start the writer.
+
+        @param ofp    The output stream.
+        @param limit  The maximum number of bytes waiting to be written.
+        '''
+        self.m_ofp = ofp
+        self.m_queue = ByteQueue(limit)
+        self.m_error = None
+        self.m_handoff = True
+        self.m_thread = Thread(target=self._run)
+        self.m_thread.daemon = True
+        self.m_thread.start()
+
+    def _run(self):
+        '''
+        Write the data until the None sentinel, the first error is
+        kept for the producer.
+        '''
+        while True:
+            data = self.m_queue.get()
+            if data is None:
+                return
+            if self.m_error is None:
+                try:
+                    self.m_ofp.write(data)
+                except Exception as exc:  # pylint: disable=broad-except
+                    self.m_error = exc
+
+    def write(self, data):
+        '''
+        Queue the data, the caller must not modify it afterwards.
+        '''
+        if self.m_error is not None:
+            raise self.m_error
+        self.m_queue.put(data, len(data))
+        return len(data)
+
+    def close(self):
+        '''
+        Wait for all of the data to be written.
+        '''
+        if self.m_thread is not None:
+            self.m_queue.put(None, 0)
+            self.m_thread.join()
+            self.m_thread = None
+        if self.m_error is not None:
+            raise self.m_error
+
+
+class LogWriter:
+    '''
+    Writes the messages and the events in its own thread.
+
+    The callers only queue the output along with the function that
+    formats it, so they never wait for each other or for the output
+    streams. The queue is bounded so that a slow terminal slows the
+    callers down instead of using more and more memory.
+    '''
+    def __init__(self, limit=LOG_QUEUE_DEPTH):
+        '''
+        Start the writer.
+
+        @param limit  The maximum number of queued items.
+        '''
+        self.m_queue = queue.Queue(maxsize=limit)
+        self.m_streams = set()  # the streams written to since the last flush
+        self.m_errors = {}  # the first write error of each stream
+        self.m_thread = Thread(target=self._run)
+        self.m_thread.daemon = True
+        self.m_thread.start()
+
+    def _run(self):
+        '''
+        Format and write the queued items.
+
+        The first error of each stream is kept for get_error(), the
+        stream may be the one that it would be reported on.
+        '''
+        while True:
+            ofp, fct, args = self.m_queue.get()
+            try:
+                if ofp is None:
+                    for stream in self.m_streams:
+                        try:
+                            stream.flush()
+                        except Exception as exc:  # pylint: disable=broad-except
+                            self.m_errors.setdefault(stream, exc)
+                    self.m_streams.clear()
+                else:
+                    try:
+                        ofp.write(fct(*args))
+                        self.m_streams.add(ofp)
+                    except Exception as exc:  # pylint: disable=broad-except
+                        self.m_errors.setdefault(ofp, exc)
+            finally:
+                self.m_queue.task_done()
+
+    def put(self, ofp, fct, *args):
+        '''
+        Queue the output.
+
+        @param ofp   The output stream.
+        @param fct   The function that returns the text to write.
+        @param args  The arguments of fct.
+        '''
+        self.m_queue.put((ofp, fct, args))
+
+    def flush(self):
+        '''
+        Wait for the queued output to be written and flushed.
+        '''
+        self.m_queue.put((None, None, None))
+        self.m_queue.join()
+
+    def get_error(self, ofp):
+        '''
+        Get the first error writing to a stream, use flush() first.
+
+        @param ofp  The output stream.
+        @returns the exception or None.
+        '''
+        return self.m_errors.get(ofp)
+
+
+class Progress:
+    '''
+    Reports the --progress of the workers on stderr.
+
+    The counters are read from the sharded Stats once per interval by
+    a separate thread so the workers do not do any extra work. The
+    totals come from the sizes of the files as they are queued, they
+    are marked with a + until the enumeration is complete.
+    '''
+    def __init__(self, stats, interval=PROGRESS_INTERVAL):
+        '''
+        Start reporting.
+
+        @param stats     The Stats of the run.
+        @param interval  The seconds between reports.
+        '''
+        self.m_stats = stats
+        self.m_interval = interval
+        self.m_start = time.time()
+        self.m_tty = sys.stderr.isatty()
+        self.m_scanned = threading.Event()
+        self.m_stop = threading.Event()
+        self.m_thread = Thread(target=self._run)
+        self.m_thread.daemon = True
+        self.m_thread.start()
+
+    def _run(self):
+        '''
+        Report until stopped, the last report is always written.
+        '''
+        while True:
+            stopped = self.m_stop.wait(self.m_interval)
+            end = '\n' if stopped is True or self.m_tty is False else ''
+            get_log_writer().put(sys.stderr, self.format, self.m_stats.snapshot(), time.time() - self.m_start,
+                                 self.m_scanned.is_set(), '\r' if self.m_tty is True else '', end)
+            if stopped is True:
+                return
+
+    @staticmethod
+    def format(counters, seconds, scanned, start, end):
+        '''
+        Format a report, it is called by the log writer thread.
+        '''
+        mib = 1024.0 * 1024
+        files = counters.get('done', 0)
+        nbytes = counters.get('done_bytes', 0)
+        remaining = max(0, counters.get('queued_bytes', 0) - nbytes)
+        rate = nbytes / seconds if seconds > 0 else 0.0
+        if rate > 0:
+            eta = int(remaining / rate)
+            eta = '{}:{:02}:{:02}'.format(eta // 3600, eta // 60 % 60, eta % 60)
+        else:
+            eta = '-'
+        return '{}progress: {:,}/{:,}{} files {:.1f} files/s {:.1f} MB/s {:.1f}{} MB remaining ETA {}{}'.format(
+            start, files, counters.get('queued', 0), '' if scanned else '+',
+            files / seconds if seconds > 0 else 0.0, rate / mib,
+            remaining / mib, '' if scanned else '+', eta, end)
+
+    def scanned(self):
+        '''
+        Mark the enumeration as complete.
+        '''
+        self.m_scanned.set()
+
+    def stop(self):
+        '''
+        Write the last report and stop.
+        '''
+        self.m_stop.set()
+        self.m_thread.join()
+
+
+class JobTuner:
+    '''
+    Adapts the number of active workers for --jobs auto.
+
+    The workers start at one per core. Once per interval the CPU time
+    of the process is compared with the time that passed. If files
+    are waiting for a worker and the cores are not busy, the workers
+    are mostly waiting for I/O, typically lots of small files or a
+    slow disk, so another worker is admitted. If the cores are busy,
+    typically a few large files, the extra workers are retired until
+    there is one per core again.
+
+    The other workers wait in acquire() so the threads are only
+    started once.
+    '''
+    def __init__(self, cores, max_jobs, interval=AUTO_JOBS_INTERVAL):
+        '''
+        Start tuning.
+
+        @param cores     The number of cores that can be used.
+        @param max_jobs  The number of worker threads.
+        @param interval  The seconds between adjustments.
+        '''
+        self.m_cores = cores
+        self.m_max = max_jobs
+        self.m_limit = min(cores, max_jobs)
+        self.m_active = 0
+        self.m_cond = threading.Condition()
+        self.m_interval = interval
+        self.m_stop = threading.Event()
+        self.m_thread = Thread(target=self._run)
+        self.m_thread.daemon = True
+        self.m_thread.start()
+
+    def acquire(self):
+        '''
+        Wait until the worker is allowed to take a file.
+        '''
+        with self.m_cond:
+            while self.m_active >= self.m_limit:
+                self.m_cond.wait()
+            self.m_active += 1
+
+    def release(self):
+        '''
+        Let another worker take a file.
+        '''
+        with self.m_cond:
+            self.m_active -= 1
+            self.m_cond.notify()
+
+    def adjust(self, busy, waiting):
+        '''
+        Change the number of active workers.
+
+        @param busy     The average number of cores that were in use.
+        @param waiting  True if there are files waiting for a worker.
+        @returns the number of active workers.
+        '''
+        with self.m_cond:
+            if busy >= self.m_cores * AUTO_JOBS_BUSY:
+                self.m_limit = max(min(self.m_cores, self.m_max), self.m_limit - 1)
+            elif waiting is True and self.m_limit < self.m_max:
+                self.m_limit += 1
+                self.m_cond.notify()
+            return self.m_limit
+
+    def _run(self):
+        '''
+        Measure the CPU use once per interval until stopped.
+        '''
+        times = os.times()
+        cpu = times[0] + times[1]
+        start = time.time()
+        while self.m_stop.wait(self.m_interval) is False:
+            times = os.times()
+            now = time.time()
+            busy = (times[0] + times[1] - cpu) / (now - start) if now > start else 0.0
+            cpu = times[0] + times[1]
+            start = now
+            self.adjust(busy, th_queue is not None and th_queue.qsize() > 0)
+
+    def stop(self):
+        '''
+        Stop tuning.
+        '''
+        self.m_stop.set()
+        self.m_thread.join()
+
+
+# ================================================================
+#
+# Key derivation functions.
+#
+# ================================================================
+def load_crypto():
+    '''
+    Import the cryptography classes, it is done when the first cipher
+    is created rather than when the module is imported.
+    '''
+    global InvalidTag, hashes, Cipher, algorithms, modes, AESGCM, HKDF, default_backend
+    if default_backend is not None:
+        return
+    try:
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+        from cryptography.hazmat.backends import default_backend
+    except ImportError as exc:
+        err('Import failed, you may need to run "pip install cryptography".\n{:>7}{}'.format('', exc))
+
+
+def get_run_salt():
+    '''
+    Get the salt used to derive the master key for files locked in
+    the kdf format. It is created once per run.
+    '''
+    global th_run_salt
+    with th_kdf_mutex:
+        if th_run_salt is None:
+            th_run_salt = os.urandom(SALT_LEN)
+        return th_run_salt
+
+
+def get_cbc_decryptor(key, iv):
+    '''
+    Get an AES-CBC decryptor, it decrypts in parallel if there is a
+    cipher pool.
+    '''
+    pool = get_cipher_pool()
+    if pool is None:
+        return Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend()).decryptor()
+    return ParallelDecryptor(key, iv, pool, th_cipher_jobs)
+
+
+def get_segment_nonce(nonce_prefix, index, last):
+    '''
+    Get the nonce of a segment in the segmented format.
+    '''
+    if index >= 1 << 32:
+        raise ValueError('too many segments')
+    return SEGMENT_NONCE.pack(nonce_prefix, index, 1 if last else 0)
+
+
+def decrypt_segment(aead, header, nonce, data):
+    '''
+    Decrypt and authenticate a segment of the segmented format.
+    '''
+    if len(data) < SEGMENT_TAG_LEN:
+        raise ValueError('locked data is truncated')
+    try:
+        return aead.decrypt(nonce, data, header)
+    except InvalidTag:
+        raise ValueError('authentication failed, the password is wrong or the data was modified')
+
+
+def select_range(chunks, start, stop, ofp):
+    '''
+    Write part of a stream of chunks to an output stream like a
+    slice.
+
+    The data is written as the chunks arrive when start is positive,
+    a negative stop holds back that many bytes and the chunks are not
+    read past the range when both offsets are positive. A negative
+    start keeps that many bytes until the end.
+
+    @param chunks  Iterable of the chunks.
+    @param start   The offset of the first byte.
+    @param stop    The offset after the last byte, None for the end.
+    @param ofp     The output stream.
+    @returns the number of bytes written.
+    '''
+    nwritten = 0
+    if start >= 0:
+        hold = bytearray()  # the bytes that a negative stop can still cut off
+        base = 0  # the offset of the next chunk in the stream
+        for chunk in chunks:
+            view = memoryview(chunk)
+            offset, base = base, base + len(view)
+            view = view[max(0, start - offset):]
+            if stop is not None and stop >= 0:
+                view = view[:max(0, stop - max(start, offset))]
+            elif stop is not None:
+                hold += view
+                view = hold[:max(0, len(hold) + stop)]
+                del hold[:len(view)]
+            if len(view) > 0:
+                ofp.write(view)
+                nwritten += len(view)
+            if stop is not None and stop >= 0 and base >= stop:
+                break
+        return nwritten
+
+    buf = bytearray()
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        buf += chunk
+        if len(buf) > -start:
+            del buf[:len(buf) + start]
+    base = size - len(buf)  # the offset of buf in the stream
+    start, stop, _ = slice(start, stop).indices(size)
+    if start < stop:
+        ofp.write(buf[start - base:stop - base])
+        nwritten = stop - start
+    return nwritten
+
+
+def is_segmented(data):
+    '''
+    Check whether binary locked data is in the segmented format.
+    '''
+    return data[:len(CONTAINER_MAGIC)] == CONTAINER_MAGIC and data[8:9] != b'' and data[8] in SEGMENT_HEADERS
+
+
+def get_header(headers, data):
+    '''
+    Get the header layout for the version in binary locked data.
+
+    @param headers  The CONTAINER_HEADERS or SEGMENT_HEADERS.
+    @param data     At least the magic and the version.
+    @returns the struct of the header.
+    '''
+    version = data[len(CONTAINER_MAGIC)] if len(data) > len(CONTAINER_MAGIC) else None
+    if version not in headers:
+        raise ValueError('unsupported locked file version {}'.format(version))
+    return headers[version]
+
+
+def get_master_key(password, kdf_id, cost, r, p, salt):
+    '''
+    Derive the master key from the password using a deliberately
+    slow KDF.
+
+    The key is cached so it is only derived once per run for each
+    salt rather than once per file. Workers that need a key that is
+    being derived wait for it instead of deriving it again, keys with
+    different salts are derived in parallel.
+
+    The parameters come from the file header so they are checked
+    against KDF_MAX_PARAMS before anything is derived.
+
+    @param password  The password.
+    @param kdf_id    The KDF identifier from the file header.
+    @param cost      The PBKDF2 iterations or the scrypt N.
+    @param r         The scrypt block size.
+    @param p         The scrypt parallelization.
+    @param salt      The master key salt.
+    '''
+    if kdf_id not in KDF_MAX_PARAMS:
+        raise ValueError('unsupported key derivation function {}'.format(kdf_id))
+    max_cost, max_r, max_p = KDF_MAX_PARAMS[kdf_id]
+    if not 1 <= cost <= max_cost or r > max_r or p > max_p:
+        raise ValueError('invalid key derivation parameters {}, {}, {}'.format(cost, r, p))
+    if not isinstance(password, bytes):
+        password = password.encode('utf-8')
+    entry = (password, kdf_id, cost, r, p, salt)
+    start = timing_clock()
+    with th_kdf_mutex:
+        key = th_master_keys.get(entry)
+        if key is not None:
+            timing_add('kdf', start)
+            return key
+        lock = th_kdf_locks.setdefault(entry, Lock())
+    with lock:
+        with th_kdf_mutex:
+            key = th_master_keys.get(entry)
+        if key is None:
+            if kdf_id == KDF_PARAMS['pbkdf2'][0]:
+                key = hashlib.pbkdf2_hmac('sha256', password, salt, cost, 32)
+            else:
+                key = hashlib.scrypt(password, salt=salt, n=cost, r=r, p=p, maxmem=SCRYPT_MAXMEM, dklen=32)
+            with th_kdf_mutex:
+                th_master_keys[entry] = key
+                th_kdf_locks.pop(entry, None)
+    timing_add('kdf', start)
+    return key
+
+
+# ================================================================
+#
+# Incremental index functions.
+#
+# ================================================================
+def load_index(path):
+    '''
+    Load the --incremental index.
+
+    The index maps the absolute path of each file that was locked to
+    its size, modification time, inode, optional content hash and
+    the path of the locked file. A missing index is empty.
+    '''
+    import json
+    global th_index
+    try:
+        with open(path, 'r') as ifp:
+            data = json.load(ifp)
+    except IOError as exc:
+        if exc.errno == errno.ENOENT:
+            th_index = {}
+            return
+        err('failed to read index "{}": {}'.format(path, exc))
+    except ValueError as exc:
+        err('invalid index "{}": {}'.format(path, exc))
+    if not isinstance(data, dict) or data.get('version') != INDEX_VERSION:
+        err('invalid index "{}": unsupported version'.format(path))
+    th_index = data['files']
+
+
+def save_index(path):
+    '''
+    Save the --incremental index.
+
+    It is written to a temporary file that is renamed so that an
+    interrupted save does not lose the previous index.
+
+    The entries of the files that this run did not find and that no
+    longer exist are removed so that the index does not grow forever.
+    '''
+    import json
+    with th_mutex:
+        for key in [key for key in th_index if key not in th_index_seen]:
+            if not os.path.lexists(key):
+                del th_index[key]
+        data = {'version': INDEX_VERSION, 'files': th_index}
+        try:
+            tmp, ofp = open_output(path)
+            try:
+                with ofp:
+                    ofp.write(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+                close_output(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        except (IOError, OSError) as exc:
+            errn('failed to write index "{}": {}'.format(path, exc))
+
+
+def get_file_hash(path, chunk_size=CHUNK_SIZE):
+    '''
+    Get the SHA-256 hash of the contents of a file.
+    '''
+    digest = hashlib.sha256()
+    buf = memoryview(bytearray(chunk_size))
+    with open(path, 'rb') as ifp:
+        while True:
+            num = readinto(ifp, buf)
+            if num == 0:
+                break
+            digest.update(buf[:num])
+    return digest.hexdigest()
+
+
+def index_unchanged(opts, path, stats, st):
+    '''
+    Check whether a file has changed since it was last locked.
+
+    Unchanged files are counted and skipped. The state of a changed
+    file is kept until it has been locked, see index_commit().
+
+    If --incremental-hash was specified, a changed file is hashed by
+    the worker, see index_hash_unchanged().
+
+    The index itself is never locked.
+
+    @param st  The os.stat() result for the file.
+    @returns True if the file should be skipped.
+    '''
+    key = os.path.abspath(path)
+    if key == os.path.abspath(opts.incremental):
+        infov2(opts, 'skip "{}"', path)
+        return True
+    if path.endswith(opts.suffix):
+        # The locked files are next to the inputs in incremental mode.
+        infov2(opts, 'skip "{}"', path)
+        log_event('skipped', path)
+        stat_inc(stats, 'files')
+        stat_inc(stats, 'skipped')
+        return True
+
+    state = {
+        'size': st.st_size,
+        'mtime_ns': getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)),
+        'inode': st.st_ino,
+        'output': os.path.abspath(path + opts.suffix),
+    }
+    with th_mutex:
+        th_index_seen.add(key)
+        old = th_index.get(key)
+    if old is not None and os.path.exists(old['output']):
+        if all(old.get(name) == state[name] for name in ('size', 'mtime_ns', 'inode', 'output')):
+            infov2(opts, 'unchanged "{}"', path)
+            log_event('unchanged', path)
+            stat_inc(stats, 'files')
+            stat_inc(stats, 'unchanged')
+            return True
+    with th_mutex:
+        th_index_pending[key] = state
+    return False
+
+
+def index_hash_unchanged(opts, path, stats):
+    '''
+    Hash a changed file for --incremental-hash.
+
+    It is called by the worker threads so that the files are hashed
+    in parallel rather than by the directory walk. A file whose hash
+    did not change is unchanged, only its new metadata is recorded so
+    that it is not hashed again next time.
+
+    @returns True if the file should be skipped.
+    '''
+    key = os.path.abspath(path)
+    with th_mutex:
+        state = th_index_pending.get(key)
+        old = th_index.get(key)
+    if state is None:
+        return False
+    try:
+        digest = get_file_hash(path, opts.chunk_size)
+    except IOError:
+        return False  # reported when the file is locked
+    with th_mutex:
+        state['hash'] = digest
+    if old is None or old.get('hash') != digest or not os.path.exists(old['output']):
+        return False
+    infov2(opts, 'unchanged "{}"', path)
+    log_event('unchanged', path)
+    with th_mutex:
+        th_index[key] = th_index_pending.pop(key, state)
+    stat_inc(stats, 'files')
+    stat_inc(stats, 'unchanged')
+    return True
+
+
+def index_commit(path):
+    '''
+    Record the state of a file that was locked in the index.
+    '''
+    key = os.path.abspath(path)
+    with th_mutex:
+        state = th_index_pending.pop(key, None)
+        if state is not None:
+            th_index[key] = state
+
+
+# ================================================================
+#
+# Timing functions.
+#
+# ================================================================
+def add_stats_hook(fct):
+    '''
+    Register a function that receives the time spent in each stage.
+
+    It is called as fct('file', record) after each file is processed
+    and as fct('run', report) at the end of the run. The record has
+    the path and the stage times of the file, the report is the same
+    as the --stats-json output. The file records are passed from the
+    worker threads so the function must be thread safe.
+
+    Registering a hook enables the timing.
+    '''
+    global th_timing
+    th_stats_hooks.append(fct)
+    th_timing = True
+
+
+def timing_clock():
+    '''
+    Get the start time of a stage, it is only read if the timing is
+    enabled so that it costs almost nothing otherwise.
+    '''
+    return time.perf_counter() if th_timing is True else 0.0
+
+
+def timing_add(stage, start):
+    '''
+    Add the time since start to a stage of the file that this thread
+    is processing.
+
+    Only the time spent in the calling thread is counted. Work done in
+    the cipher pool is counted as aes time while the thread waits for
+    it and, with --pipeline, read and write are the time spent waiting
+    for the read ahead and write behind stages, the disk time that was
+    not overlapped.
+
+    @param stage  The stage name, one of STATS_STAGES.
+    @param start  The time from timing_clock().
+    '''
+    if th_timing is True:
+        times = getattr(th_local, 'times', None)
+        if times is not None:
+            times[stage] += time.perf_counter() - start
+
+
+def timing_begin():
+    '''
+    Start collecting the stage times in this thread.
+
+    @returns the stage times or None if the timing is not enabled.
+    '''
+    times = collections.defaultdict(float) if th_timing is True else None
+    th_local.times = times
+    return times
+
+
+def timing_end(path, times):
+    '''
+    Stop collecting the stage times in this thread and add them to
+    the run.
+
+    The times are merged once per file so the stages themselves do
+    not take any locks.
+
+    @param path   The file or None for the times of the main thread.
+    @param times  The stage times from timing_begin().
+    '''
+    th_local.times = None
+    if times is None:
+        return
+    record = {'path': path, 'stages': dict(times)}
+    with th_mutex:
+        for stage, seconds in times.items():
+            th_times[stage] += seconds
+        if path is not None and th_file_times is not None:
+            th_file_times.append(record)
+    if path is not None:
+        for fct in th_stats_hooks:
+            fct('file', record)
+
+
+def get_stats_report(opts, stats, seconds):
+    '''
+    Get the --stats-json report.
+
+    @param seconds  The wall clock time of the run.
+    '''
+    with th_mutex:
+        report = {
+            'version': STATS_VERSION,
+            'action': get_action(opts),
+            'format': opts.format,
+            'executor': opts.executor,
+            'jobs': opts.jobs,
+            'seconds': seconds,
+            'counters': stats.snapshot(),
+            'stages': dict((stage, th_times.get(stage, 0.0)) for stage in STATS_STAGES),
+        }
+        if th_file_times is not None:
+            report['files'] = list(th_file_times)
+    return report
+
+
+def save_stats(opts, stats, seconds):
+    '''
+    Pass the report to the stats hooks and write it to the
+    --stats-json file.
+    '''
+    import json
+    report = get_stats_report(opts, stats, seconds)
+    for fct in th_stats_hooks:
+        fct('run', report)
+    if opts.stats_json is None:
+        return
+    try:
+        tmp, ofp = open_output(opts.stats_json)
+        try:
+            with ofp:
+                ofp.write(json.dumps(report, sort_keys=True, indent=2).encode('utf-8'))
+            close_output(tmp, opts.stats_json)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    except (IOError, OSError) as exc:
+        errn('failed to write stats "{}": {}'.format(opts.stats_json, exc))
+
+
+# ================================================================
+#
+# Message Utility Functions.
+#
+# ================================================================
+def get_log_writer():
+    '''
+    Get the log writer, it is started when it is first needed.
+    '''
+    global th_log
+    if th_log is None:
+        with th_log_mutex:
+            if th_log is None:
+                th_log = LogWriter()
+    return th_log
+
+
+def log_flush():
+    '''
+    Wait until all of the queued messages and events have been
+    written.
+    '''
+    if th_log is not None:
+        th_log.flush()
+
+
+def format_msg(prefix, lineno, msg, args):
+    '''
+    Format a message, it is called by the log writer thread.
+    '''
+    if args:
+        msg = msg.format(*args)
+    return '{}:{} {}\n'.format(prefix, lineno, msg)
+
+
+def format_event(record):
+    '''
+    Format a --log-json event, it is called by the log writer thread.
+    '''
+    import json
+    return json.dumps(record, sort_keys=True) + '\n'
+
+
+def _msg(prefix, msg, args, level, ofp):
+    '''
+    Thread safe message reporting.
+
+    Only the line number of the caller is looked up here. The message
+    is formatted and written by the log writer thread so the caller
+    does not wait for the output or for other threads.
+    '''
+    if th_quiet is True:
+        return
+    lineno = sys._getframe(level).f_lineno  # pylint: disable=protected-access
+    get_log_writer().put(sys.stdout if ofp is None else ofp, format_msg, prefix, lineno, msg, args)
+
+
+def info(msg, *args, **kwargs):
+    '''
+    Display a simple information message with context information.
+
+    The message is formatted with args when it is written. The level
+    and ofp keyword arguments select the caller frame that is reported
+    and the output stream, the default is stdout.
+    '''
+    _msg('INFO', msg, args, kwargs.get('level', 1) + 1, kwargs.get('ofp'))
+
+
+def infov(opts, msg, *args, **kwargs):
+    '''
+    Display a simple information message with context information if
+    -v was specified.
+    '''
+    if opts.verbose:
+        _msg('INFO', msg, args, kwargs.get('level', 1) + 1, kwargs.get('ofp'))
+
+
+def infov2(opts, msg, *args, **kwargs):
+    '''
+    Display a simple information message with context information if
+    -v was specified twice.
+
+    Pass the values as args rather than formatting the message so that
+    nothing is formatted unless it is displayed.
+    '''
+    if opts.verbose > 1:
+        _msg('INFO', msg, args, kwargs.get('level', 1) + 1, kwargs.get('ofp'))
+
+
+def err(msg, *args, **kwargs):
+    '''
+    Display error message with context information, abort the
+    threads and raise LockFilesError.
+
+    The command line tool exits with status 1 when it is raised.
+    '''
+    _msg('ERROR', msg, args, kwargs.get('level', 1) + 1, kwargs.get('ofp'))
+    abort_threads()
+    log_flush()
+    raise LockFilesError(msg.format(*args) if args else msg)
+
+
+def errn(msg, *args, **kwargs):
+    '''
+    Display error message with context information but do not exit.
+    '''
+    _msg('ERROR', msg, args, kwargs.get('level', 1) + 1, kwargs.get('ofp'))
+
+
+def warn(msg, *args, **kwargs):
+    '''
+    Display error message with context information but do not exit.
+    '''
+    _msg('WARNING', msg, args, kwargs.get('level', 1) + 1, kwargs.get('ofp'))
+
+
+def _println(msg, ofp=None):
+    '''
+    Print a message with a new line.
+    '''
+    get_log_writer().put(sys.stdout if ofp is None else ofp, '{}\n'.format, msg)
+
+
+def log_event(event, path, **fields):
+    '''
+    Record what happened to a file in the --log-json event log.
+
+    The record is only created if there is an event log. It is
+    serialized by the log writer thread, or returned to the parent by
+    a worker process.
+
+    @param event   The event: locked, unlocked, verified, skipped,
+                   unchanged or failed.
+    @param path    The file.
+    @param fields  Additional fields like the output file or the error.
+    '''
+    if th_event_log is None:
+        return
+    fields['event'] = event
+    fields['path'] = path
+    fields['time'] = time.time()
+    emit_event(fields)
+
+
+def emit_event(record):
+    '''
+    Add an event record to the event log, the records are collected
+    in a list in worker processes and sessions.
+    '''
+    if isinstance(th_event_log, list):
+        th_event_log.append(record)
+    else:
+        get_log_writer().put(th_event_log, format_event, record)
+
+
+def open_event_log(path):
+    '''
+    Open the --log-json event log.
+    '''
+    global th_event_log
+    try:
+        th_event_log = io.open(path, 'w', encoding='utf-8')
+    except IOError as exc:
+        err('failed to open the event log "{}": {}'.format(path, exc))
+
+
+def close_event_log(ofp=None):
+    '''
+    Write the queued events and close the --log-json event log.
+
+    @param ofp  The stream for the error message.
+    @returns False if an event could not be written.
+    '''
+    global th_event_log
+    if th_event_log is None:
+        return True
+    log_flush()
+    exc = get_log_writer().get_error(th_event_log)
+    try:
+        th_event_log.close()
+    except IOError as close_exc:
+        exc = exc or close_exc
+    path = th_event_log.name
+    th_event_log = None
+    if exc is not None:
+        errn('failed to write the event log "{}": {}', path, exc, ofp=ofp)
+        return False
+    return True
+
+
+# ================================================================
+#
+# Thread utility functions.
+#
+# ================================================================
+def abort_threads():
+    '''
+    Set the abort flag.
+    '''
+    th_mutex.acquire()
+    try:
+        global th_abort
+        th_abort = True
+    finally:
+        th_mutex.release()
+
+
+def get_cgroup_dirs(root=CGROUP_ROOT, proc=CGROUP_PROC):
+    '''
+    Get the cgroup directories whose CPU limits apply to this process,
+    the innermost first.
+
+    The cgroups come from /proc/self/cgroup, an entry with no
+    controllers is cgroup v2, cgroup v1 mounts the cpu controller in
+    its own directory. Hybrid hosts mount cgroup v2 in the unified
+    directory next to the cgroup v1 controllers. Inside a container
+    the cgroup is normally the root of the mount so the root is
+    always included.
+
+    @param root  Where the cgroup hierarchies are mounted.
+    @param proc  The file that lists the cgroups of this process.
+    '''
+    dirs = []
+    try:
+        with open(proc) as ifp:
+            entries = [line.rstrip('\n').split(':', 2) for line in ifp]
+    except (IOError, OSError):
+        entries = []
+    for entry in entries:
+        if len(entry) != 3:
+            continue
+        _, controllers, path = entry
+        if controllers == '':
+            unified = os.path.join(root, 'unified')
+            bases = [unified if os.path.isdir(unified) else root]
+        elif 'cpu' in controllers.split(','):
+            bases = [os.path.join(root, controllers), os.path.join(root, 'cpu')]
+        else:
+            continue
+        for base in bases:
+            parent = path.strip('/')
+            while parent:
+                dirs.append(os.path.join(base, parent))
+                parent = os.path.dirname(parent)
+            dirs.append(base)
+    dirs.append(root)
+    return dirs
+
+
+def get_cgroup_cpu_limit(root=CGROUP_ROOT, proc=CGROUP_PROC):
+    '''
+    Get the CPU quota of this process.
+
+    cgroup v2 stores it in cpu.max as "QUOTA PERIOD" where the quota
+    can be max, cgroup v1 in cpu.cfs_quota_us and cpu.cfs_period_us
+    where a quota of -1 means there is none. The smallest quota of
+    the cgroup and its parents applies.
+
+    @param root  Where the cgroup hierarchies are mounted.
+    @param proc  The file that lists the cgroups of this process.
+    @returns the number of CPUs, it can be a fraction, or None if
+             there is no quota.
+    '''
+    limit = None
+    for path in get_cgroup_dirs(root, proc):
+        try:
+            if os.path.exists(os.path.join(path, 'cpu.max')):
+                with open(os.path.join(path, 'cpu.max')) as ifp:
+                    quota, period = ifp.read().split()[:2]
+                if quota == 'max':
+                    continue
+            else:
+                with open(os.path.join(path, 'cpu.cfs_quota_us')) as ifp:
+                    quota = ifp.read().strip()
+                with open(os.path.join(path, 'cpu.cfs_period_us')) as ifp:
+                    period = ifp.read().strip()
+            quota = int(quota)
+            period = int(period)
+        except (IOError, OSError, ValueError):
+            continue
+        if quota > 0 and period > 0 and (limit is None or quota / float(period) < limit):
+            limit = quota / float(period)
+    return limit
+
+
+def get_num_cores():
+    '''
+    Get the number of cores that this process can use.
+
+    It is the number of CPUs in the affinity mask, which is what
+    taskset and cpusets allow, limited by the cgroup CPU quota so
+    that a container does not report the cores of the host.
+    '''
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:  # only available on Linux
+        import multiprocessing
+        count = multiprocessing.cpu_count()
+    limit = get_cgroup_cpu_limit()
+    if limit is not None:
+        count = min(count, max(1, int(math.ceil(limit))))
+    return count
+
+
+def get_cipher_pool():
+    '''
+    Get the thread pool that encrypts and decrypts the segments of
+    the segmented format and decrypts CBC ranges in parallel. It is
+    created when it is first needed.
+
+    @returns the pool or None if there is only one job.
+    '''
+    global th_cipher_pool
+    if th_cipher_jobs < 2:
+        return None
+    with th_mutex:
+        if th_cipher_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            th_cipher_pool = ThreadPoolExecutor(max_workers=th_cipher_jobs)
+        return th_cipher_pool
+
+
+def thread_worker(opts, password, stats):
+    '''
+    Thread worker.
+
+    Takes files from the work queue and processes them until it
+    receives the None sentinel. Once an abort has been requested the
+    remaining files are discarded.
+    '''
+    while True:
+        start = timing_clock()
+        tuner = th_tuner
+        if tuner is not None:
+            tuner.acquire()
+        entry = th_queue.get()
+        try:
+            if entry is None:
+                return
+            path, size = entry
+            if th_abort is False:
+                times = timing_begin()
+                timing_add('queue_wait', start)
+                try:
+                    if opts.incremental_hash is True and index_hash_unchanged(opts, path, stats) is True:
+                        pass
+                    elif th_pool is None:
+                        process_file(opts, password, path, stats)
+                    else:
+                        process_file_in_pool(opts, password, path, stats)
+                finally:
+                    timing_end(path, times)
+                    stat_inc(stats, 'done')
+                    stat_inc(stats, 'done_bytes', size)
+        except LockFilesError:
+            pass  # err() has already reported it and set the abort flag
+        except Exception as exc:  # pylint: disable=broad-except
+            errn('unexpected failure for "{}": {}'.format(entry[0], exc))
+            abort_threads()
+        finally:
+            th_queue.task_done()
+            if tuner is not None:
+                tuner.release()
+
+
+def process_file_in_pool(opts, password, entry, stats):
+    '''
+    Process a file in the process pool and wait for the result.
+
+    The statistics and the stage times collected by the worker
+    process are merged and an abort in the worker process is
+    propagated.
+    '''
+    child_stats, child_times, child_events, aborted = th_pool.submit(process_file_in_child, opts, password,
+                                                                     entry).result()
+    for key, value in child_stats.items():
+        stat_inc(stats, key, value)
+    for event in child_events or []:
+        emit_event(event)
+    times = getattr(th_local, 'times', None)
+    if times is not None and child_times is not None:
+        for stage, seconds in child_times.items():
+            times[stage] += seconds
+    if child_stats.get('locked'):
+        index_commit(entry)
+    if aborted is True:
+        abort_threads()
+
+
+def process_file_in_child(opts, password, entry):
+    '''
+    Process a file in a worker process.
+
+    @returns the statistics, the stage times and the --log-json
+             events for the file and the abort flag.
+    '''
+    global th_abort
+    th_abort = False  # an earlier abort belongs to the parent now
+    stats = Stats()
+    times = timing_begin()
+    events = None
+    if th_event_log is not None:
+        del th_event_log[:]
+    try:
+        process_file(opts, password, entry, stats)
+    except LockFilesError:
+        pass  # err() has already reported it and set the abort flag
+    finally:
+        th_local.times = None
+        log_flush()
+        sys.stdout.flush()
+    if th_event_log is not None:
+        events = list(th_event_log)
+    return stats.snapshot(), (None if times is None else dict(times)), events, th_abort
+
+
+def init_child(run_salt, master_keys, cipher_jobs, timing, events):
+    '''
+    Initialize a worker process.
+
+    ^C is handled by the parent which lets the files that are in
+    progress finish, so the workers ignore it.
+
+    The workers share the run salt and any master keys that the
+    parent already derived so that they are not derived again, the
+    size of the cipher thread pool, whether the stages are timed and
+    whether the --log-json events are collected.
+    '''
+    global th_run_salt, th_cipher_jobs, th_timing, th_event_log
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    th_run_salt = run_salt
+    th_master_keys.update(master_keys)
+    th_cipher_jobs = cipher_jobs
+    th_timing = timing
+    th_event_log = [] if events is True else None
+
+
+def start_threads(opts, password, stats):
+    '''
+    Start a fixed pool of worker threads fed by a bounded queue.
+
+    The queue bound provides backpressure so that the directory walk
+    never gets more than a few files ahead of the workers.
+
+    If --executor process was specified, each worker thread hands
+    its files to a pool of worker processes so that the work that
+    holds the GIL runs on multiple cores.
+    '''
+    global th_queue, th_pool, th_cipher_jobs, th_tuner
+    th_cipher_jobs = opts.jobs
+    if opts.jobs_auto is True:
+        cores = get_num_cores()
+        th_cipher_jobs = cores
+        if opts.executor == 'thread' and opts.jobs > cores:
+            th_tuner = JobTuner(cores, opts.jobs)
+    if opts.executor == 'process':
+        try:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError as exc:
+            err('--executor process is not supported: {}'.format(exc))
+        # Derive the master key once here rather than once in
+        # every worker process.
+        if opts.lock is True and opts.format in ('kdf', 'segmented'):
+            kdf_id, cost, r, p = KDF_PARAMS[opts.kdf]
+            get_master_key(password, kdf_id, cost, r, p, get_run_salt())
+        # Spawn rather than fork, forking while other threads hold
+        # th_mutex would deadlock the child. The mp_context and
+        # initializer arguments need Python 3.7, the version check
+        # at the top rejects older versions before this point. The
+        # processes already use all of the cores so each one gets a
+        # single cipher job instead of its own pool.
+        th_pool = ProcessPoolExecutor(max_workers=opts.jobs,
+                                      mp_context=multiprocessing.get_context('spawn'),
+                                      initializer=init_child,
+                                      initargs=(th_run_salt, dict(th_master_keys), 1, th_timing,
+                                                th_event_log is not None))
+    th_queue = queue.Queue(maxsize=opts.jobs * QUEUE_DEPTH)
+    del th_workers[:]
+    for _ in range(opts.jobs):
+        th = Thread(target=thread_worker, args=(opts, password, stats))
+        th.daemon = True
+        th.start()
+        th_workers.append(th)
+
+
+def queue_file(path, stats, size=0):
+    '''
+    Queue a file for the workers.
+
+    Blocks while the queue is full. The timeout allows ^C and
+    aborts to be noticed while waiting.
+
+    @param size  The size of the file for --progress.
+    '''
+    stat_inc(stats, 'queued')
+    stat_inc(stats, 'queued_bytes', size)
+    start = timing_clock()
+    while th_abort is False:
+        try:
+            th_queue.put((path, size), timeout=0.1)
+            break
+        except queue.Full:
+            pass
+    timing_add('enqueue_wait', start)
+
+
+def drain_queue():
+    '''
+    Discard the files that are still waiting for a worker.
+    '''
+    while True:
+        try:
+            th_queue.get_nowait()
+        except queue.Empty:
+            return
+        th_queue.task_done()
+
+
+def wait_for_threads():
+    '''
+    Wait for the workers to finish the queued files and exit.
+    '''
+    global th_tuner
+    if th_abort is True:
+        drain_queue()
+    for _ in th_workers:
+        th_queue.put(None)
+    for th in th_workers:
+        while th.is_alive():
+            th.join(0.1)  # a timeout keeps ^C responsive
+    if th_pool is not None:
+        th_pool.shutdown(wait=True)
+    if th_tuner is not None:
+        th_tuner.stop()
+        th_tuner = None
+
+
+# ================================================================
+#
+# Program specific functions.
+#
+# ================================================================
+def get_action(opts):
+    '''
+    Get the name of the action.
+    '''
+    return 'lock' if opts.lock is True else 'verify' if opts.verify is True else 'unlock'
+
+
+def get_err_fct(opts):
+    '''
+    Get the message function: error or warning depending on
+    the --warn setting.
+    '''
+    if opts.warn is True:
+        return warn
+    return err
+
+
+def stat_inc(stats, key, value=1):
+    '''
+    Increment the stat, see Stats.
+    '''
+    stats.inc(key, value)
+
+
+def new_stats():
+    '''
+    Get the statistics object with the counters of the summary.
+    '''
+    return Stats({
+        'locked': 0,
+        'unlocked': 0,
+        'skipped': 0,
+        'unchanged': 0,
+        'verified': 0,
+        'failed': 0,
+        'files': 0,
+        'dirs': 0,
+        'walk_time': 0.0,
+        'read': 0,
+        'written': 0,
+        })
 
 
 def check_existence(opts, path):
@@ -501,55 +3245,202 @@ def check_existence(opts, path):
         get_err_fct(opts)('file exists, cannot continue: {}'.format(path))
 
 
-def read_file(opts, path, stats):
+def readinto(ifp, buf):
+    '''
+    Read from a stream into a preallocated buffer.
+
+    @param ifp  The input stream.
+    @param buf  A writable memoryview.
+    @returns the number of bytes read, 0 at the end.
+    '''
+    fct = getattr(ifp, 'readinto', None)
+    if fct is not None:
+        return fct(buf) or 0
+    data = ifp.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+
+def read_full(ifp, size):
+    '''
+    Read size bytes unless the end is reached first.
+
+    @param ifp   The input stream or its read function.
+    @param size  The number of bytes.
+    @returns the data.
+    '''
+    read = ifp if callable(ifp) else ifp.read
+    parts = []
+    while size > 0:
+        data = read(size)
+        if not data:
+            break
+        parts.append(bytes(data))
+        size -= len(data)
+    return b''.join(parts)
+
+
+def open_input(path, threshold=MMAP_THRESHOLD):
     '''
-    Read the file contents.
+    Open a file for reading.
+
+    Files that are at least threshold bytes are memory mapped so that
+    they can be read directly from the page cache.
+
+    @param path       The file path.
+    @param threshold  The smallest file that is mapped, 0 disables it.
+    @returns the input stream.
     '''
+    ifp = open(path, 'rb')
+    if threshold < 1:
+        return ifp
     try:
-        with open(path, 'rb') as ifp:
-            data = ifp.read()
-            stat_inc(stats, 'read', len(data))
-            return data
-    except IOError as exc:
-        get_err_fct(opts)('failed to read file "{}": {}'.format(path, exc))
-        return None
+        if os.fstat(ifp.fileno()).st_size < threshold:
+            return ifp
+        mfp = MmapFile(ifp)
+    except (EnvironmentError, ValueError):
+        return ifp  # fall back to regular reads
+    ifp.close()  # the mapping does not need the file to stay open
+    return mfp
+
+
+def open_output(path):
+    '''
+    Open a hidden temporary file in the same directory as path for
+    writing. It is renamed to path by close_output() when all of the
+    data has been written.
 
+    @returns the temporary path and the open stream.
+    '''
+    head, tail = os.path.split(path)
+    while True:
+        tmp = os.path.join(head, '.{}.{}.tmp'.format(tail, binascii.hexlify(os.urandom(4)).decode('ascii')))
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+            return tmp, os.fdopen(fd, 'wb')
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+
+def close_output(tmp, path):
+    '''
+    Rename the temporary file to its final name. If the file is being
+    replaced, the permissions of the original are preserved.
+    '''
+    if os.path.exists(path):
+        os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        if os.name != 'posix':
+            os.remove(path)  # rename does not replace on windows
+    os.rename(tmp, path)
+
+
+def get_input_size(ifp):
+    '''
+    Get the size of an input stream from open_input().
+    '''
+    if isinstance(ifp, MmapFile):
+        return len(ifp.m_view)
+    return os.fstat(ifp.fileno()).st_size
 
-def write_file(opts, path, content, stats, width=0):
+
+def pipeline(opts, ifp, ofp, fct):
     '''
-    Write the file.
+    Run fct with the reads and the writes in their own threads so
+    that the disk is busy while the data is encrypted or decrypted
+    and the other way around. Each stage buffers at most --pipeline
+    bytes.
+
+    Memory mapped input is not read ahead because the kernel already
+    does that.
     '''
+    reader = ifp if isinstance(ifp, MmapFile) else ReadAhead(ifp, opts.chunk_size, opts.pipeline)
+    writer = WriteBehind(ofp, opts.pipeline)
     try:
-        with open(path, 'wb') as ofp:
-            if width < 1:
-                ofp.write(content)
-            else:
-                i = 0
-                nl = '\n' if isinstance(content, str) else b'\n'
-                while i < len(content):
-                    ofp.write(content[i:i+width] + nl)
-                    i += width
-            stat_inc(stats, 'written', len(content))
+        result = fct(reader, writer)
+    finally:
+        if reader is not ifp:
+            reader.close()
+        writer.close()
+    return result
+
+
+def transform_file(opts, ipath, opath, fct, stats):
+    '''
+    Stream the contents of ipath through fct to opath.
+
+    The output is written to a temporary file that is renamed when it
+    is complete so a failure never leaves a partially written file
+    behind. It also allows ipath and opath to be the same file.
+
+    @param fct  Function that takes the input and output streams and
+                returns the number of bytes read and written.
+    @returns True if the operation succeeded.
+    '''
+    try:
+        ifp = open_input(ipath, opts.mmap_threshold)
     except IOError as exc:
-        get_err_fct(opts)('failed to write file "{}": {}'.format(path, exc))
+        log_event('failed', ipath, error=str(exc))
+        get_err_fct(opts)('failed to read file "{}": {}'.format(ipath, exc))
+        return False
+
+    tmp = None
+    try:
+        with ifp:
+            tmp, ofp = open_output(opath)
+            with ofp:
+                if opts.pipeline > 0 and get_input_size(ifp) >= 2 * opts.chunk_size:
+                    result = pipeline(opts, ifp, ofp, fct)
+                else:
+                    result = fct(ifp, ofp)
+        if result is None:
+            return False
+        close_output(tmp, opath)
+        tmp = None
+        stat_inc(stats, 'read', result[0])
+        stat_inc(stats, 'written', result[1])
+    except (IOError, OSError) as exc:
+        log_event('failed', ipath, output=opath, error=str(exc))
+        get_err_fct(opts)('failed to write file "{}": {}'.format(opath, exc))
         return False
+    finally:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
     return True
 
 
+def get_cipher(opts):
+    '''
+    Get the cipher object for the selected format.
+    '''
+    if opts.format == 'kdf':
+        return AESCipher(kdf=opts.kdf)
+    if opts.format == 'segmented':
+        return AESCipher(kdf=opts.kdf, segment_size=SEGMENT_SIZE)
+    return AESCipher(openssl=opts.openssl)
+
+
 def lock_file(opts, password, path, stats):
     '''
     Lock a file.
     '''
     out = path + opts.suffix
-    infov2(opts, 'lock "{}" --> "{}"'.format(path, out))
+    infov2(opts, 'lock "{}" --> "{}"', path, out)
     check_existence(opts, out)
-    content = read_file(opts, path, stats)
-    if content is not None:
-        data = AESCipher(openssl=opts.openssl).encrypt(password, content)
-        if data is not None and write_file(opts, out, data, stats, width=opts.wll) is True and th_abort is False:
-            if out != path:
-                os.remove(path)  # remove the input
-            stat_inc(stats, 'locked')
+    cipher = get_cipher(opts)
+
+    def encrypt(ifp, ofp):
+        return cipher.encrypt_stream(password, ifp, ofp, width=opts.wll, chunk_size=opts.chunk_size,
+                                     binary=opts.binary)
+
+    if transform_file(opts, path, out, encrypt, stats) is True and th_abort is False:
+        if out != path and opts.incremental is None:
+            start = timing_clock()
+            os.remove(path)  # remove the input
+            timing_add('remove', start)
+        index_commit(path)
+        log_event('locked', path, output=out)
+        stat_inc(stats, 'locked')
 
 
 def unlock_file(opts, password, path, stats):
@@ -561,21 +3452,68 @@ def unlock_file(opts, password, path, stats):
             out = path[:-len(opts.suffix)]
         else:
             out = path
-        infov2(opts, 'unlock "{}" --> "{}"'.format(path, out))
+        infov2(opts, 'unlock "{}" --> "{}"', path, out)
         check_existence(opts, out)
-        content = read_file(opts, path, stats)
-        if content is not None and th_abort is False:
+        if th_abort is False:
+            cipher = get_cipher(opts)
+
+            def decrypt(ifp, ofp):
+                return cipher.decrypt_stream(password, ifp, ofp, chunk_size=opts.chunk_size)
+
             try:
-                data = AESCipher(openssl=opts.openssl).decrypt(password, content)
-                if write_file(opts, out, data, stats) is True:
+                if transform_file(opts, path, out, decrypt, stats) is True:
                     if out != path:
+                        start = timing_clock()
                         os.remove(path)  # remove the input
-                    stats['unlocked'] += 1
+                        timing_add('remove', start)
+                    log_event('unlocked', path, output=out)
+                    stat_inc(stats, 'unlocked')
             except ValueError as exc:
+                log_event('failed', path, error=str(exc))
                 get_err_fct(opts)('unlock/decrypt operation failed for "{}": {}'.format(path, exc))
     else:
-        infov2(opts, 'skip "{}"'.format(path))
-        stats['skipped'] += 1
+        infov2(opts, 'skip "{}"', path)
+        log_event('skipped', path)
+        stat_inc(stats, 'skipped')
+
+
+def verify_file(opts, password, path, stats):
+    '''
+    Verify a locked file without writing the plaintext.
+
+    The file is decrypted and the plaintext is discarded. Every
+    segment of the segmented format is authenticated so the check
+    stops at the first bad segment. The other formats only have the
+    padding at the end to check.
+    '''
+    if not path.endswith(opts.suffix):
+        infov2(opts, 'skip "{}"', path)
+        log_event('skipped', path)
+        stat_inc(stats, 'skipped')
+        return
+    infov2(opts, 'verify "{}"', path)
+    cipher = get_cipher(opts)
+    try:
+        with open_input(path, opts.mmap_threshold) as ifp:
+            reader = cipher.decrypt_reader(password, ifp, chunk_size=opts.chunk_size)
+            if reader is None:
+                return
+            while len(reader.read_chunk()) > 0:
+                if th_abort is True:
+                    return
+            stat_inc(stats, 'read', reader.m_armor.m_read)
+    except IOError as exc:
+        log_event('failed', path, error=str(exc))
+        stat_inc(stats, 'failed')
+        get_err_fct(opts)('failed to read file "{}": {}'.format(path, exc))
+        return
+    except ValueError as exc:
+        log_event('failed', path, error=str(exc))
+        stat_inc(stats, 'failed')
+        get_err_fct(opts)('verify operation failed for "{}": {}'.format(path, exc))
+        return
+    log_event('verified', path)
+    stat_inc(stats, 'verified')
 
 
 def process_file(opts, password, path, stats):
@@ -586,39 +3524,219 @@ def process_file(opts, password, path, stats):
         stat_inc(stats, 'files')
         if opts.lock is True:
             lock_file(opts, password, path, stats)
+        elif opts.verify is True:
+            verify_file(opts, password, path, stats)
         else:
             unlock_file(opts, password, path, stats)
 
 
-def process_dir(opts, password, path, stats):
+def scan_dir(opts, path, stats):
     '''
-    Process a directory, we always start at the top level.
+    Scan a single directory.
+
+    The file type comes from the directory entry so files are not
+    stat'ed. Hidden files are skipped, unreadable directories are
+    ignored like os.walk() does.
+
+    @returns the DirEntry objects of the files and the paths of the
+             subdirectories, sorted if --sort was specified.
     '''
-    stats['dirs'] += 1
-    if opts.recurse is True:
-        # Recurse to get everything.
-        for root, subdirs, subfiles in os.walk(path):
-            for subfile in sorted(subfiles, key=str.lower):
-                if subfile.startswith('.'):
-                    continue
+    start = time.time()
+    files = []
+    subdirs = []
+    try:
+        for entry in os.scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif not entry.name.startswith('.') and entry.is_file():
+                    files.append(entry)
+            except OSError:
+                pass  # removed while it was scanned
+    except OSError:
+        pass
+    if opts.sort is True:
+        files.sort(key=lambda entry: entry.name.lower())
+        subdirs.sort(key=str.lower)
+    stat_inc(stats, 'walk_time', time.time() - start)
+    return files, subdirs
+
+
+def walk_tree(opts, path, stats):
+    '''
+    Generate the files in a directory tree, top down like os.walk().
+    '''
+    stack = [path]
+    while stack and th_abort is False:
+        files, subdirs = scan_dir(opts, stack.pop(), stats)
+        for entry in files:
+            if th_abort is True:
+                break
+            yield entry
+        stack.extend(reversed(subdirs))
+
+
+def walk_tree_parallel(opts, path, stats):
+    '''
+    Generate the files in a directory tree using --walk-jobs threads
+    that scan different directories at the same time.
+
+    The files are generated in the order that they are found. The
+    queue of found files is bounded so the scan does not get too far
+    ahead of the workers.
+    '''
+    dirs = queue.Queue()
+    found = queue.Queue(maxsize=opts.walk_jobs * 1024)
+    pending = [1]  # directories queued or being scanned
+    stop = [False]
+    lock = Lock()
+
+    def put_found(item):
+        while stop[0] is False and th_abort is False:
+            try:
+                found.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def walker():
+        while True:
+            top = dirs.get()
+            if top is None:
+                return
+            files, subdirs = scan_dir(opts, top, stats) if stop[0] is False else ([], [])
+            for entry in files:
+                put_found(entry)
+            with lock:
+                pending[0] += len(subdirs) - 1
+                done = pending[0] == 0
+            for subdir in subdirs:
+                dirs.put(subdir)
+            if done:
+                put_found(None)
+
+    dirs.put(path)
+    threads = []
+    for _ in range(opts.walk_jobs):
+        th = Thread(target=walker)
+        th.daemon = True
+        th.start()
+        threads.append(th)
+    try:
+        while True:
+            try:
+                entry = found.get(timeout=0.1)  # a timeout keeps aborts responsive
+            except queue.Empty:
                 if th_abort is True:
                     break
-                subpath = os.path.join(root, subfile)
-                th = Thread(target=thread_process_file, args=(opts, password, subpath, stats))
-                th.daemon = True
-                th.start()
-    else:
-        # Use listdir() to get the files in the current directory only.
-        for entry in sorted(os.listdir(path), key=str.lower):
-            if entry.startswith('.'):
                 continue
-            subpath = os.path.join(path, entry)
-            if os.path.isfile(subpath):
-                if th_abort is True:
-                    break
-                th = Thread(target=thread_process_file, args=(opts, password, subpath, stats))
-                th.daemon = True
-                th.start()
+            if entry is None:
+                break
+            yield entry
+    finally:
+        stop[0] = True
+        for _ in threads:
+            dirs.put(None)
+
+
+def walk_dir(opts, path, stats):
+    '''
+    Generate the DirEntry objects of the files in a directory, we
+    always start at the top level.
+    '''
+    stat_inc(stats, 'dirs')
+    if opts.recurse is False:
+        # Only the files in the current directory.
+        files, _ = scan_dir(opts, path, stats)
+        return iter(files)
+    if opts.walk_jobs > 1:
+        return walk_tree_parallel(opts, path, stats)
+    return walk_tree(opts, path, stats)
+
+
+def read_files_from(path, null=False):
+    '''
+    Generate the entries in a --files-from list.
+
+    The list is read a chunk at a time so the memory used does not
+    depend on its length. Empty entries are skipped.
+
+    @param path  The file or - for stdin.
+    @param null  The entries end with a NUL rather than a new line,
+                 like the output of find -print0.
+    '''
+    try:
+        ifp = getattr(sys.stdin, 'buffer', sys.stdin) if path == '-' else open(path, 'rb')
+    except IOError as exc:
+        err('failed to read the file list "{}": {}'.format(path, exc))
+    sep = b'\0' if null is True else b'\n'
+    rest = b''
+    try:
+        while th_abort is False:
+            data = ifp.read(FILES_FROM_CHUNK)
+            if not data:
+                break
+            entries = (rest + data).split(sep)
+            rest = entries.pop()
+            for entry in entries:
+                if null is False and entry.endswith(b'\r'):
+                    entry = entry[:-1]
+                if entry:
+                    yield os.fsdecode(entry)
+        if rest and th_abort is False:
+            yield os.fsdecode(rest.rstrip(b'\r') if null is False else rest)
+    except IOError as exc:
+        err('failed to read the file list "{}": {}'.format(path, exc))
+    finally:
+        if ifp is not getattr(sys.stdin, 'buffer', sys.stdin):
+            ifp.close()
+
+
+def get_files(opts):
+    '''
+    Generate the entries on the command line followed by the entries
+    in the --files-from list.
+    '''
+    for entry in opts.FILES:
+        yield entry
+    if opts.files_from is not None:
+        for entry in read_files_from(opts.files_from, opts.null):
+            yield entry
+
+
+def walk_files(opts, stats):
+    '''
+    Generate the files for the entries on the command line.
+    '''
+    for entry in get_files(opts):
+        if th_abort is True:
+            break
+        try:
+            mode = os.stat(entry).st_mode
+        except OSError:
+            continue
+        if stat.S_ISREG(mode):
+            yield entry
+        elif stat.S_ISDIR(mode):
+            for subentry in walk_dir(opts, entry, stats):
+                yield subentry.path
+
+
+def process_dir(opts, password, path, stats):
+    '''
+    Process a directory, we always start at the top level.
+    '''
+    for entry in walk_dir(opts, path, stats):
+        # The file is only stat'ed when its size or times are needed,
+        # it may have been removed since the directory was scanned.
+        st = None
+        if opts.incremental is not None or opts.progress is True:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+        if opts.incremental is None or index_unchanged(opts, entry.path, stats, st) is False:
+            queue_file(entry.path, stats, 0 if st is None else st.st_size)
 
 
 def process(opts, password, entry, stats):
@@ -630,11 +3748,14 @@ def process(opts, password, entry, stats):
     If it is a directory, recurse if --recurse was specified.
     '''
     if th_abort is False:
-        if os.path.isfile(entry):
-            th = Thread(target=thread_process_file, args=(opts, password, entry, stats))
-            th.daemon = True
-            th.start()
-        elif os.path.isdir(entry):
+        try:
+            st = os.stat(entry)
+        except OSError:
+            return
+        if stat.S_ISREG(st.st_mode):
+            if opts.incremental is None or index_unchanged(opts, entry, stats, st) is False:
+                queue_file(entry, stats, st.st_size)
+        elif stat.S_ISDIR(st.st_mode):
             process_dir(opts, password, entry, stats)
 
 
@@ -642,36 +3763,236 @@ def run(opts, password, stats):
     '''
     Process the entries on the command line.
     They can be either files or directories.
+
+    The --files-from entries are read as the workers take the files
+    from the queue so a long list is never held in memory.
     '''
-    for entry in opts.FILES:
+    for entry in get_files(opts):
+        if th_abort is True:
+            break
         process(opts, password, entry, stats)
 
 
+def get_bundle_name(path):
+    '''
+    Get the name of a file in a bundle.
+
+    Like tar, leading / and ../ components are removed so that the
+    files are always extracted below the current directory.
+    '''
+    parts = os.path.normpath(path).replace(os.sep, '/').split('/')
+    while parts and parts[0] in ('', '.', '..'):
+        parts.pop(0)
+    return '/'.join(parts)
+
+
+def lock_bundle(opts, password, stats):
+    '''
+    Lock all of the files into a single bundle.
+
+    The files are streamed into a tar archive that is encrypted as it
+    is written so the member names and sizes are locked along with
+    the contents. There is a single key and output file so there is
+    no per file overhead apart from reading the file.
+    '''
+    import tarfile
+    out = opts.bundle
+    infov2(opts, 'lock bundle "{}"', out)
+    check_existence(opts, out)
+    cipher = get_cipher(opts)
+    tmp, ofp = open_output(out)
+    try:
+        with ofp:
+            writer = cipher.encrypt_writer(password, ofp, width=opts.wll, binary=opts.binary)
+            if writer is None:
+                return
+            tar = tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT, bufsize=opts.chunk_size)
+            for path in walk_files(opts, stats):
+                if os.path.abspath(path) == os.path.abspath(out):
+                    continue
+                stat_inc(stats, 'files')
+                try:
+                    ifp = open(path, 'rb')
+                except IOError as exc:
+                    get_err_fct(opts)('failed to read file "{}": {}'.format(path, exc))
+                    continue
+                infov2(opts, 'bundle "{}"', path)
+                with ifp:
+                    tarinfo = tar.gettarinfo(arcname=get_bundle_name(path), fileobj=ifp)
+                    tar.addfile(tarinfo, ifp)
+                log_event('locked', path, output=out)
+                stat_inc(stats, 'locked')
+                stat_inc(stats, 'read', tarinfo.size)
+            tar.close()
+            result = writer.close()
+        if th_abort is False:
+            close_output(tmp, out)
+            tmp = None
+            stat_inc(stats, 'written', result[1])
+    except (IOError, OSError) as exc:
+        err('failed to write bundle "{}": {}'.format(out, exc))
+    finally:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def unlock_bundle(opts, password, stats):
+    '''
+    Unlock the files in a bundle.
+
+    All of the files are extracted below the current directory unless
+    the files on the command line select some of them. A name selects
+    the file with that name or all of the files below it.
+    '''
+    import tarfile
+    path = opts.bundle
+    infov2(opts, 'unlock bundle "{}"', path)
+    selected = [get_bundle_name(name) for name in get_files(opts)]
+    cipher = get_cipher(opts)
+    try:
+        with open_input(path, opts.mmap_threshold) as ifp:
+            reader = cipher.decrypt_reader(password, ifp, chunk_size=opts.chunk_size)
+            if reader is None:
+                return
+            tar = tarfile.open(fileobj=reader, mode='r|', bufsize=opts.chunk_size)
+            for member in tar:
+                if th_abort is True:
+                    break
+                stat_inc(stats, 'files')
+                name = get_bundle_name(member.name)
+                if member.isfile() is False or name != member.name or \
+                   (selected and not any(name == sel or name.startswith(sel + '/') for sel in selected)):
+                    infov2(opts, 'skip "{}"', member.name)
+                    log_event('skipped', member.name)
+                    stat_inc(stats, 'skipped')
+                    continue
+                unlock_bundle_member(opts, tar, member, stats)
+            tar.close()
+
+            # Read the rest so that the padding is checked.
+            while len(reader.read_chunk()) > 0:
+                pass
+            stat_inc(stats, 'read', reader.m_armor.m_read)
+    except IOError as exc:
+        get_err_fct(opts)('failed to read file "{}": {}'.format(path, exc))
+    except (ValueError, tarfile.TarError) as exc:
+        get_err_fct(opts)('unlock/decrypt operation failed for "{}": {}'.format(path, exc))
+
+
+def unlock_bundle_member(opts, tar, member, stats):
+    '''
+    Extract a file from a bundle.
+
+    Like transform_file() it is written to a temporary file that is
+    renamed when it is complete.
+    '''
+    out = member.name.replace('/', os.sep)
+    infov2(opts, 'unlock "{}" --> "{}"', member.name, out)
+    check_existence(opts, out)
+    if th_abort is True:
+        return
+    import shutil
+    tmp = None
+    try:
+        head = os.path.dirname(out)
+        if head and not os.path.isdir(head):
+            os.makedirs(head)
+        tmp, ofp = open_output(out)
+        with ofp:
+            shutil.copyfileobj(tar.extractfile(member), ofp, opts.chunk_size)
+        os.chmod(tmp, member.mode & 0o777)
+        os.utime(tmp, (member.mtime, member.mtime))
+        close_output(tmp, out)
+        tmp = None
+        log_event('unlocked', member.name, output=out)
+        stat_inc(stats, 'unlocked')
+        stat_inc(stats, 'written', member.size)
+    except (IOError, OSError) as exc:
+        get_err_fct(opts)('failed to write file "{}": {}'.format(out, exc))
+    finally:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def unlock_range(opts, password, stats):
+    '''
+    Write part of the plaintext of the locked files to stdout.
+
+    Only the segments that cover the range are decrypted for files in
+    the segmented format. The messages go to stderr so that they do
+    not mix with the data.
+    '''
+    start, stop = opts.range
+    cipher = get_cipher(opts)
+    ofp = sys.stdout.buffer
+    for path in walk_files(opts, stats):
+        if not path.endswith(opts.suffix):
+            continue
+        stat_inc(stats, 'files')
+        infov2(opts, 'range "{}" [{}:{}]', path, start, '' if stop is None else stop, ofp=sys.stderr)
+        try:
+            with open(path, 'rb') as ifp:
+                nwritten = cipher.decrypt_range(password, ifp, ofp, start, stop)
+                if nwritten is None:
+                    continue
+                stat_inc(stats, 'read', ifp.tell())
+        except IOError as exc:
+            get_err_fct(opts)('failed to read file "{}": {}'.format(path, exc), ofp=sys.stderr)
+            continue
+        except ValueError as exc:
+            get_err_fct(opts)('unlock/decrypt operation failed for "{}": {}'.format(path, exc), ofp=sys.stderr)
+            continue
+        stat_inc(stats, 'unlocked')
+        stat_inc(stats, 'written', nwritten)
+    ofp.flush()
+
+
 def summary(opts, stats):
     '''
     Print the summary statistics after all threads
     have completed.
     '''
     if opts.verbose:
-        action = 'lock' if opts.lock is True else 'unlock'
         print('')
         print('Setup')
-        print('   action:              {:>12}'.format(action))
+        print('   action:              {:>12}'.format(get_action(opts)))
+        print('   executor:            {:>12}'.format(opts.executor))
+        print('   format:              {:>12}'.format(opts.format))
+        print('   binary:              {:>12}'.format(str(opts.binary)))
+        if opts.bundle is not None:
+            print('   bundle:              {:>12}'.format(opts.bundle))
+        print('   incremental:         {:>12}'.format(str(opts.incremental is not None)))
         print('   inplace:             {:>12}'.format(str(opts.inplace)))
         print('   jobs:                {:>12,}'.format(opts.jobs))
         print('   overwrite:           {:>12}'.format(str(opts.overwrite)))
+        print('   sort:                {:>12}'.format(str(opts.sort)))
         print('   suffix:              {:>12}'.format('"' + opts.suffix + '"'))
         print('')
-        print('Summary')
-        print('   total files:         {:>12,}'.format(stats['files']))
-        if opts.lock:
-            print('   total locked:        {:>12,}'.format(stats['locked']))
-        if opts.unlock:
-            print('   total unlocked:      {:>12,}'.format(stats['unlocked']))
-        print('   total skipped:       {:>12,}'.format(stats['skipped']))
-        print('   total bytes read:    {:>12,}'.format(stats['read']))
-        print('   total bytes written: {:>12,}'.format(stats['written']))
-        print('')
+        summary_counters(opts, stats)
+
+
+def summary_counters(opts, stats):
+    '''
+    Print the counters of the summary that apply to the action.
+
+    @param stats  The Stats or the counters that a --daemon reports.
+    '''
+    print('Summary')
+    print('   total files:         {:>12,}'.format(stats['files']))
+    if opts.lock:
+        print('   total locked:        {:>12,}'.format(stats['locked']))
+    if opts.verify:
+        print('   total verified:      {:>12,}'.format(stats['verified']))
+        print('   total failed:        {:>12,}'.format(stats['failed']))
+    elif opts.unlock:
+        print('   total unlocked:      {:>12,}'.format(stats['unlocked']))
+    print('   total skipped:       {:>12,}'.format(stats['skipped']))
+    if opts.incremental is not None:
+        print('   total unchanged:     {:>12,}'.format(stats['unchanged']))
+    print('   total bytes read:    {:>12,}'.format(stats['read']))
+    print('   total bytes written: {:>12,}'.format(stats['written']))
+    print('   enumeration seconds: {:>12.3f}'.format(stats['walk_time']))
+    print('')
 
 
 def get_password(opts):
@@ -713,6 +4034,7 @@ def get_password(opts):
 
     # User did not specify a password, prompt twice to make sure that
     # the password is specified correctly.
+    import getpass
     password = getpass.getpass('Password: ')
     password2 = getpass.getpass('Re-enter password: ')
     if password != password2:
@@ -720,10 +4042,29 @@ def get_password(opts):
     return password
 
 
-def getopts():
+def get_range(value):
     '''
-    Get the command line options.
+    Parse a --range argument.
+
+    @param value  The START:END argument.
+    @returns the start and stop offsets, stop is None for the end.
+    '''
+    start, sep, stop = value.partition(':')
+    try:
+        if sep != ':':
+            raise ValueError(value)
+        return int(start or 0), (int(stop) if stop else None)
+    except ValueError:
+        import argparse
+        raise argparse.ArgumentTypeError('invalid range "{}", expected START:END'.format(value))
+
+
+def get_parser():
+    '''
+    Get the command line parser.
     '''
+    import argparse
+
     def gettext(s):
         lookup = {
             'usage: ': 'USAGE:',
@@ -807,6 +4148,35 @@ PROJECT:
 
     group1 = parser.add_mutually_exclusive_group()
 
+    parser.add_argument('-b', '--binary',
+                        action='store_true',
+                        help='''Write locked files as binary data.
+Normally locked files are base64 encoded so
+that they are ASCII text. Binary files are
+about 25%% smaller and faster to lock and
+unlock.
+
+Binary files are always written in the kdf
+format. They are recognized when they are
+unlocked, it does not have to be specified.
+ ''')
+
+    parser.add_argument('--bundle',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Lock all of the files into a single locked
+FILE instead of locking each file. The file
+names and contents are stored in a tar
+archive that is encrypted as it is written.
+The original files are not removed.
+
+In unlock mode the files in the bundle FILE
+are extracted below the current directory.
+If any FILES are specified, only those files
+and the files below them are extracted.
+ ''')
+
     parser.add_argument('-c', '--openssl',
                         action='store_true',
                         help='''Enable openssl compatibility.
@@ -825,6 +4195,53 @@ These two decrypt commands are equivalent.
    $ {0} -P PASSWORD -u FILE
  '''.format(base))
 
+    parser.add_argument('--chunk-size',
+                        action='store',
+                        type=int,
+                        default=CHUNK_SIZE,
+                        metavar=('BYTES'),
+                        help='''The number of bytes read at a time.
+Files are locked and unlocked in chunks of
+this size so the memory used does not depend
+on the file size.
+
+Default: %(default)s
+ ''')
+
+    parser.add_argument('--client',
+                        action='store',
+                        type=str,
+                        metavar=('SOCKET'),
+                        help='''Send the files to the --daemon that listens
+on the Unix domain socket SOCKET rather than
+processing them here. --unlock and --verify
+select the action, the format and the other
+options are the ones of the daemon. No
+password is needed.
+
+The exit status is 1 if any of the files
+failed.
+ ''')
+
+    parser.add_argument('--daemon',
+                        action='store',
+                        type=str,
+                        metavar=('SOCKET'),
+                        help='''Run as a daemon that locks, unlocks or
+verifies the files that --client sends to
+the Unix domain socket SOCKET.
+
+The password is read, the master key is
+derived and the workers are started once so
+each request only pays for its files. Only
+the user that started the daemon can use the
+socket. The memory is locked, so that the
+keys are not swapped, if the memory lock
+limit allows it.
+
+Stop it with SIGTERM or ^C.
+ ''')
+
     parser.add_argument('-d', '--decrypt',
                         action='store_true',
                         help='''Unlock/decrypt files.
@@ -837,6 +4254,62 @@ It is the same as --unlock.
                         help='''Lock/encrypt files.
 This option is deprecated.
 This is the same as --lock and is the default.
+ ''')
+
+    parser.add_argument('--executor',
+                        action='store',
+                        choices=['thread', 'process'],
+                        default='thread',
+                        help='''Specify how the --jobs workers are run.
+The thread executor runs them as threads in
+this process. The process executor runs them
+in separate processes which avoids the Global
+Interpreter Lock so many medium sized files
+can be processed on all of the cores.
+
+Default: %(default)s
+ ''')
+
+    parser.add_argument('--files-from',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Process the files and directories listed in
+FILE, one per line, as well as the ones on
+the command line. - reads the list from
+stdin. The list is read as the files are
+processed so it can be arbitrarily long,
+for example the output of find.
+
+Specify -0 if the entries end with a NUL.
+ ''')
+
+    parser.add_argument('--format',
+                        action='store',
+                        choices=['classic', 'openssl', 'kdf', 'segmented'],
+                        default='classic',
+                        help='''The format of locked files.
+   classic  The password is used as the key.
+   openssl  The same as -c.
+   kdf      A master key is derived from the
+            password once per run using the
+            --kdf function and each file is
+            encrypted with its own key derived
+            from the master key and a salt that
+            is stored in the file header.
+   segmented
+            The kdf format keys with the data
+            split into segments that are
+            encrypted with AES-GCM. The segments
+            of a file are encrypted and decrypted
+            by the -j threads in parallel. The
+            locked files are binary.
+
+Files in the kdf and segmented formats are
+recognized when they are unlocked, it does
+not have to be specified.
+
+Default: %(default)s
  ''')
 
     parser.add_argument('-i', '--inplace',
@@ -854,19 +4327,66 @@ behavior of the previous version.
  ''')
 
     #nc = get_num_cores()
+    parser.add_argument('--incremental',
+                        action='store',
+                        type=str,
+                        metavar=('INDEX'),
+                        help='''Only lock files that changed since the last
+run.
+
+The size, modification time and inode of
+every file that is locked are recorded in
+the INDEX file. Files that have not changed
+since they were last locked are skipped.
+
+The original files are kept and the locked
+files are overwritten so that the same
+directories can be locked again later.
+
+It cannot be used with --unlock or --inplace.
+ ''')
+
+    parser.add_argument('--incremental-hash',
+                        action='store_true',
+                        help='''Also record the SHA-256 hash of each file in
+the --incremental index. A file whose
+modification time changed but whose contents
+did not is then skipped.
+ ''')
+
     parser.add_argument('-j', '--jobs',
                         action='store',
-                        type=int,
+                        type=get_jobs,
                         default=1,
                         metavar=('NUM_THREADS'),
-                        help='''Specify the maximum number of active threads.
+                        help='''Specify the number of worker threads.
 
 This can be helpful if there a lot of large
 files to process where large refers to files
 larger than a MB.
 
+Specify auto to use one worker per core that
+this process may use, taking the CPU affinity
+and the cgroup CPU quota of containers into
+account. With the thread executor more
+workers, up to {} per core, are admitted while
+the workers wait for I/O and retired when the
+cores are busy.
+
 Default: %(default)s
- ''')
+ '''.format(AUTO_JOBS_FACTOR))
+
+    parser.add_argument('--kdf',
+                        action='store',
+                        choices=sorted(KDF_PARAMS),
+                        default='scrypt' if hasattr(hashlib, 'scrypt') else 'pbkdf2',
+                        help='''The password key derivation function for
+the kdf format.
+   pbkdf2   PBKDF2-HMAC-SHA256, {:,} iterations.
+   scrypt   scrypt, N={:,}, r={}, p={}.
+
+Default: %(default)s
+ '''.format(KDF_PARAMS['pbkdf2'][1], *KDF_PARAMS['scrypt'][1:]))
 
     parser.add_argument('-l', '--lock',
                         action='store_true',
@@ -874,6 +4394,46 @@ Default: %(default)s
 Files are locked and the ".locked" extension
 is appended unless the --suffix option is
 specified.
+ ''')
+
+    parser.add_argument('--log-json',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Write an event for each file to FILE as a
+line of JSON. Each event has the event name
+(locked, unlocked, verified, skipped,
+unchanged or failed), the path, the time
+and, where there is one, the output file or
+the error.
+
+Like the messages, the events are written
+by a separate thread so the workers do not
+wait for them. If an event cannot be written
+the error is reported at the end and the
+exit status is 1.
+ ''')
+
+    parser.add_argument('--mmap-threshold',
+                        action='store',
+                        type=int,
+                        default=MMAP_THRESHOLD,
+                        metavar=('BYTES'),
+                        help='''Memory map files of at least this size.
+Memory mapped files are read directly from
+the page cache instead of being copied into
+a buffer. Smaller files are read normally.
+Zero disables memory mapping.
+
+Default: %(default)s
+ ''')
+
+    parser.add_argument('-0', '--null',
+                        action='store_true',
+                        help='''The entries in the --files-from list end
+with a NUL rather than a new line, like the
+output of find -print0. It allows any
+character in the file names.
  ''')
 
     parser.add_argument('-o', '--overwrite',
@@ -899,6 +4459,51 @@ password.
                         help='''Specify the password on the command line.
 This is not secure because it is visible in
 the command history.
+ ''')
+
+    parser.add_argument('--pipeline',
+                        action='store',
+                        type=int,
+                        default=PIPELINE_BYTES,
+                        metavar=('BYTES'),
+                        help='''Read and write files in separate threads so
+that the disk I/O overlaps with the
+encryption. BYTES is the most data that is
+buffered by the read and write stages. It is
+only used for files that are at least two
+--chunk-size chunks. Zero disables it.
+
+Default: %(default)s
+ ''')
+
+    parser.add_argument('--progress',
+                        action='store_true',
+                        help='''Report the progress on stderr every second:
+the files and bytes that are done, the files
+per second, the MB per second, the MB that
+remain and the estimated time left. The
+totals are marked with a + until all of the
+files have been found.
+
+It cannot be used with --bundle or --range.
+ ''')
+
+    parser.add_argument('--range',
+                        action='store',
+                        type=get_range,
+                        metavar=('START:END'),
+                        help='''Unlock part of each locked file and write it
+to stdout. The offsets are in the plaintext
+and work like a Python slice: either one can
+be omitted and negative offsets count from
+the end, for example --range 100:200 or
+--range=-100: for the last 100 bytes.
+
+Only the parts of binary files that cover
+the range are read and decrypted. Base64
+encoded files are decrypted from the start.
+
+This option implies --unlock.
  ''')
 
     parser.add_argument('-r', '--recurse',
@@ -913,6 +4518,43 @@ the command history.
                         metavar=('EXTENSION'),
                         help='''Specify the extension used for locked files.
 Default: %(default)s
+ ''')
+
+    parser.add_argument('--sort',
+                        action='store_true',
+                        help='''Process the files in each directory in
+case insensitive name order. By default they
+are processed in the order in which they are
+found which is faster for large directories.
+ ''')
+
+    parser.add_argument('--stats-json',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Write the statistics of the run to FILE as
+JSON. Along with the counters from the -v
+summary it has the seconds spent in each
+stage of the work:
+   queue_wait    workers waiting for files
+   enqueue_wait  waiting for a free worker
+   kdf           password and file keys
+   read          reading the input
+   aes           encryption and decryption
+   base64        base64 encoding and decoding
+   wrap          breaking the output into lines
+   write         writing the output
+   remove        removing the input
+
+The stages are summed over all of the
+workers so they can add up to more than the
+wall clock time.
+ ''')
+
+    parser.add_argument('--stats-per-file',
+                        action='store_true',
+                        help='''Also write the stage times of each file to
+the --stats-json FILE.
  ''')
 
     parser.add_argument('-u', '--unlock',
@@ -936,6 +4578,28 @@ being processed.
  ''')
 
     # Display the version number and exit.
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help='''Verify the locked files without unlocking
+them. Each file is decrypted with the -j
+workers and the plaintext is discarded, the
+locked files are not changed and nothing is
+written.
+
+Files in the segmented format are
+authenticated, so any modification is
+detected and the check stops at the first
+bad segment. The other formats can only be
+checked for a wrong password or a damaged
+end of file.
+
+The exit status is 1 if any file failed.
+Specify -W to report every failure instead
+of stopping at the first one.
+
+This option implies --unlock.
+ ''')
+
     parser.add_argument('-V', '--version',
                         action='version',
                         version='%(prog)s version {0}'.format(VERSION),
@@ -956,6 +4620,21 @@ are inserted.
 Default: %(default)s
 ''')
 
+    parser.add_argument('--walk-jobs',
+                        action='store',
+                        type=int,
+                        default=1,
+                        metavar=('NUM'),
+                        help='''The number of threads that scan directories
+when --recurse is specified. Scanning
+directories in parallel is faster when they
+are on network file systems. The files are
+processed in the order in which they are
+found.
+
+Default: %(default)s
+ ''')
+
     parser.add_argument('-W', '--warn',
                         action='store_true',
                         help='''Warn if a single file lock/unlock fails.
@@ -970,60 +4649,611 @@ so the program continues.
     parser.add_argument('FILES',
                         nargs="*",
                         help='files to process')
+    return parser
 
-    opts = parser.parse_args()
 
+def check_opts(opts):
+    '''
+    Check the options and resolve the ones that imply others.
+    '''
     # Make lock and unlock authoritative.
     if opts.decrypt is True:
         opts.unlock = True
     if opts.encrypt is True:
         opts.lock = True
+    if opts.range is not None:
+        if opts.lock is True:
+            err('You have specified mutually exclusive options: --range and --lock.')
+        opts.unlock = True
+    if opts.verify is True:
+        if opts.lock is True:
+            err('You have specified mutually exclusive options: --verify and --lock.')
+        opts.unlock = True
     if opts.lock is True and opts.unlock is True:
-        error('You have specified mutually exclusive options to lock/encrypt and unlock/decrypt.')
+        err('You have specified mutually exclusive options to lock/encrypt and unlock/decrypt.')
     if opts.lock is False and opts.unlock is False:
         opts.lock = True  # the default
+    if opts.openssl is True:
+        if opts.format not in ('classic', 'openssl'):
+            err('You have specified mutually exclusive formats: -c and --format {}.'.format(opts.format))
+        opts.format = 'openssl'
+    opts.openssl = opts.format == 'openssl'
+    if opts.binary is True:
+        if opts.format == 'openssl':
+            err('You have specified mutually exclusive options: --binary and openssl compatibility.')
+        if opts.format != 'segmented':
+            opts.format = 'kdf'
+    if opts.format == 'segmented':
+        opts.binary = True
+    opts.jobs_auto = opts.jobs == 'auto'
+    if opts.jobs_auto is True:
+        # The workers beyond one per core are only admitted by the
+        # JobTuner when they wait for I/O.
+        opts.jobs = get_num_cores()
+        if opts.executor == 'thread':
+            opts.jobs *= AUTO_JOBS_FACTOR
+    if opts.jobs < 1:
+        err('invalid number of jobs {}, must be greater than 0'.format(opts.jobs))
+    if opts.chunk_size < 1:
+        err('invalid chunk size {}, must be greater than 0'.format(opts.chunk_size))
+    if opts.walk_jobs < 1:
+        err('invalid number of walk jobs {}, must be greater than 0'.format(opts.walk_jobs))
+    if opts.pipeline < 0:
+        err('invalid pipeline size {}, must not be negative'.format(opts.pipeline))
     if opts.inplace:
         opts.suffix = ''
         opts.overwrite = True
     elif opts.overwrite == True and opts.suffix == '':
         opts.inplace = True
+    if opts.incremental is not None:
+        if opts.unlock is True:
+            err('You have specified mutually exclusive options: --incremental and --unlock.')
+        if opts.inplace is True:
+            err('You have specified mutually exclusive options: --incremental and --inplace.')
+        opts.overwrite = True  # the locked files are replaced when they change
+    elif opts.incremental_hash is True:
+        err('--incremental-hash requires --incremental.')
+    if opts.bundle is not None:
+        if opts.incremental is not None:
+            err('You have specified mutually exclusive options: --bundle and --incremental.')
+        if opts.inplace is True:
+            err('You have specified mutually exclusive options: --bundle and --inplace.')
+    if opts.verify is True:
+        if opts.bundle is not None:
+            err('You have specified mutually exclusive options: --verify and --bundle.')
+        if opts.range is not None:
+            err('You have specified mutually exclusive options: --verify and --range.')
+    if opts.range is not None:
+        if opts.bundle is not None:
+            err('You have specified mutually exclusive options: --range and --bundle.')
+        if opts.inplace is True:
+            err('You have specified mutually exclusive options: --range and --inplace.')
+    if opts.progress is True:
+        if opts.bundle is not None:
+            err('You have specified mutually exclusive options: --progress and --bundle.')
+        if opts.range is not None:
+            err('You have specified mutually exclusive options: --progress and --range.')
+    if opts.stats_per_file is True and opts.stats_json is None:
+        err('--stats-per-file requires --stats-json.')
+    if opts.null is True and opts.files_from is None:
+        err('-0 requires --files-from.')
+    for name in ('client', 'daemon'):
+        if getattr(opts, name) is None:
+            continue
+        for option in ('daemon', 'bundle', 'incremental', 'range', 'progress', 'log_json', 'stats_json'):
+            if option != name and getattr(opts, option) not in (None, False):
+                err('You have specified mutually exclusive options: --{} and --{}.'.format(
+                    name, option.replace('_', '-')))
+    if opts.daemon is not None and (opts.FILES or opts.files_from is not None):
+        err('--daemon does not take any files, send them with --client.')
     return opts
 
 
+def get_jobs(value):
+    '''
+    Parse a --jobs argument.
+
+    @param value  The number of workers or auto.
+    @returns the number of workers or auto.
+    '''
+    if value == 'auto':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        import argparse
+        raise argparse.ArgumentTypeError('invalid number of jobs "{}", expected a number or auto'.format(value))
+
+
+def getopts():
+    '''
+    Get the command line options.
+    '''
+    return check_opts(get_parser().parse_args())
+
+
 def main():
     '''
     main
     '''
+    try:
+        _main()
+    except LockFilesError:
+        sys.exit(1)  # err() has already reported it
+
+
+def _main():
+    '''
+    Run the command line tool.
+    '''
+    global th_timing, th_file_times
     opts = getopts()
+    if opts.client is not None:
+        sys.exit(run_client(opts))
     password = get_password(opts)
+    if opts.daemon is not None:
+        run_daemon(opts, password)
+        return
+
+    stats = new_stats()
+
+    if opts.incremental is not None:
+        load_index(opts.incremental)
+    if opts.log_json is not None:
+        open_event_log(opts.log_json)
+
+    if opts.stats_json is not None:
+        th_timing = True
+        if opts.stats_per_file is True:
+            th_file_times = []
+    start = time.time()
+    times = timing_begin()  # the producer and the single stream modes
+
+    if opts.range is not None:
+        # The data is written to stdout in order so there are no
+        # workers and no summary.
+        try:
+            unlock_range(opts, password, stats)
+        except KeyboardInterrupt:
+            abort_threads()
+            errn('^C detected', ofp=sys.stderr)
+        timing_end(None, times)
+        save_stats(opts, stats, time.time() - start)
+        logged = close_event_log(ofp=sys.stderr)
+        log_flush()
+        sys.exit(1 if th_abort is True or logged is False else 0)
+    elif opts.bundle is not None:
+        # A bundle is a single stream so there are no workers.
+        try:
+            if opts.lock is True:
+                lock_bundle(opts, password, stats)
+            else:
+                unlock_bundle(opts, password, stats)
+        except KeyboardInterrupt:
+            abort_threads()
+            _println('', sys.stderr)
+            errn('^C detected\n')
+    else:
+        # Use the mutex for I/O to avoid interspersed output.
+        # Use a fixed pool of workers to limit the number of active threads.
+        start_threads(opts, password, stats)
+        progress = Progress(stats) if opts.progress is True else None
 
-    stats = {
-        'locked': 0,
-        'unlocked': 0,
-        'skipped': 0,
-        'files': 0,
-        'dirs': 0,
-        'read': 0,
-        'written': 0,
-        }
+        try:
+            run(opts, password, stats)
+            if progress is not None:
+                progress.scanned()
+            wait_for_threads()
+        except KeyboardInterrupt:
+            abort_threads()
+            _println('', sys.stderr)
+            errn('^C detected, cleaning up threads, please wait\n')
+            wait_for_threads()
+        if progress is not None:
+            progress.stop()
+
+    timing_end(None, times)
+    if opts.incremental is not None:
+        save_index(opts.incremental)  # the files that were locked before an abort are kept
+    logged = close_event_log()
+    log_flush()  # the messages come before the summary
+    summary(opts, stats)
+    save_stats(opts, stats, time.time() - start)
+    log_flush()
+    if th_abort == True or stats['failed'] > 0 or logged is False:
+        sys.exit(1)
+
+
+# ================================================================
+#
+# Library API.
+#
+# ================================================================
+class LockSession:
+    '''
+    Lock, unlock and verify files or data from another program.
+
+    The options are checked, the password is read and the workers are
+    started once when the session is created, every call reuses them
+    and the master keys that were already derived. The options are
+    the long option names with the dashes replaced by underscores.
+
+        import lock_files
+        with lock_files.LockSession(password='secret', jobs=4, recurse=True) as session:
+            report = session.lock_paths(['file1.txt', 'dir1'])
+            data = session.decrypt_bytes(session.encrypt_bytes(b'text'))
+
+    The workers and the key cache belong to the module so only one
+    session can be open at a time. Errors raise LockFilesError, the
+    messages are discarded unless messages is True.
+    '''
+    UNSUPPORTED = ('bundle', 'client', 'daemon', 'files_from', 'incremental', 'log_json', 'progress', 'range',
+                   'stats_json')  # single run options
+    ACTIONS = ('FILES', 'decrypt', 'encrypt', 'lock', 'unlock', 'verify')  # selected by the call
+
+    def __init__(self, password=None, password_file=None, messages=False, **kwargs):
+        '''
+        Initialize the object.
+
+        @param password       The password.
+        @param password_file  The file that contains the password, like -p.
+        @param messages       Write the messages to stdout and stderr.
+        @param kwargs         The other options, for example format='segmented'.
+                              --warn is the default so that a file that
+                              fails is reported in the results.
+        '''
+        global th_quiet
+        if th_session is not None:
+            raise LockFilesError('there is already an open session')
+        if password is None and password_file is None:
+            raise LockFilesError('a password or a password file is required')
+        opts = get_parser().parse_args([])
+        opts.warn = True
+        for key, value in kwargs.items():
+            if key in self.ACTIONS or not hasattr(opts, key):
+                raise TypeError('unexpected option "{}"'.format(key))
+            if key in self.UNSUPPORTED:
+                raise LockFilesError('--{} is not supported by a session'.format(key.replace('_', '-')))
+            setattr(opts, key, value)
+        opts.password = password
+        opts.password_file = password_file
+        th_quiet = messages is False
+        try:
+            check_opts(opts)
+            password = get_password(opts)
+        except LockFilesError:
+            th_quiet = False
+            raise
+        self._open(opts, password)
+
+    @classmethod
+    def from_opts(cls, opts, password):
+        '''
+        Create a session from the checked command line options, it is
+        used by --daemon.
+        '''
+        if th_session is not None:
+            raise LockFilesError('there is already an open session')
+        session = cls.__new__(cls)
+        session._open(opts, password)  # pylint: disable=protected-access
+        return session
+
+    def _open(self, opts, password):
+        '''
+        Start the workers.
+        '''
+        global th_session, th_abort, th_event_log
+        self.m_opts = opts
+        self.m_password = password
+        self.m_cipher = get_cipher(opts)
+        self.m_mutex = Lock()  # one call at a time uses the workers
+        self.m_stats = new_stats()
+        th_abort = False
+        th_event_log = []  # the results of the files
+        th_session = self
+        start_threads(opts, password, self.m_stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self, action, paths):
+        '''
+        Process the files and directories and wait for the workers.
+
+        @param action  The action: lock, unlock or verify.
+        @param paths   The files and directories.
+        @returns a dict with the counters, the event record of each
+                 file and whether the operation was aborted.
+        '''
+        global th_abort
+        opts = self.m_opts
+        with self.m_mutex:
+            if th_session is not self:
+                raise LockFilesError('the session is closed')
+            th_abort = False
+            opts.lock = action == 'lock'
+            opts.unlock = action != 'lock'
+            opts.verify = action == 'verify'
+            before = self.m_stats.snapshot()
+            del th_event_log[:]
+            for path in paths:
+                process(opts, self.m_password, path, self.m_stats)
+            th_queue.join()
+            log_flush()
+            after = self.m_stats.snapshot()
+            return {
+                'counters': dict((key, value - before.get(key, 0)) for key, value in after.items()),
+                'files': list(th_event_log),
+                'aborted': th_abort,
+            }
+
+    def lock_paths(self, paths):
+        '''
+        Lock files, the directories are processed like the command
+        line does, see recurse.
+
+        @returns a dict with the counters, the --log-json records of
+                 the files and whether the operation was aborted.
+        '''
+        return self._run('lock', paths)
+
+    def unlock_paths(self, paths):
+        '''
+        Unlock files, see lock_paths().
+        '''
+        return self._run('unlock', paths)
+
+    def verify_paths(self, paths):
+        '''
+        Verify locked files, see lock_paths().
+        '''
+        return self._run('verify', paths)
+
+    def encrypt_stream(self, ifp, ofp):
+        '''
+        Lock the data of an input stream in the format of the session.
 
-    # Use the mutex for I/O to avoid interspersed output.
-    # Use the semaphore to limit the number of active threads.
-    global th_semaphore
-    th_semaphore = Semaphore(opts.jobs)
+        @returns the number of bytes read and written.
+        '''
+        opts = self.m_opts
+        return self.m_cipher.encrypt_stream(self.m_password, ifp, ofp, width=opts.wll,
+                                            chunk_size=opts.chunk_size, binary=opts.binary)
+
+    def decrypt_stream(self, ifp, ofp):
+        '''
+        Unlock the data of an input stream, it raises ValueError if the
+        data is not valid.
+
+        @returns the number of bytes read and written.
+        '''
+        return self.m_cipher.decrypt_stream(self.m_password, ifp, ofp, chunk_size=self.m_opts.chunk_size)
+
+    def encrypt_bytes(self, data):
+        '''
+        Lock data, the result is the same as the content of a locked
+        file.
+        '''
+        ofp = io.BytesIO()
+        self.encrypt_stream(io.BytesIO(data), ofp)
+        return ofp.getvalue()
+
+    def decrypt_bytes(self, data):
+        '''
+        Unlock data, see decrypt_stream().
+        '''
+        ofp = io.BytesIO()
+        self.decrypt_stream(io.BytesIO(data), ofp)
+        return ofp.getvalue()
+
+    def close(self):
+        '''
+        Stop the workers and forget the password and the master keys.
+        '''
+        global th_quiet, th_session, th_pool, th_event_log, th_run_salt
+        with self.m_mutex:
+            if th_session is not self:
+                return
+            wait_for_threads()
+            log_flush()
+            with th_kdf_mutex:
+                th_master_keys.clear()
+                th_kdf_locks.clear()
+                th_run_salt = None
+            th_pool = None
+            th_event_log = None
+            th_quiet = False
+            th_session = None
+            self.m_password = None
+
+
+# ================================================================
+#
+# Daemon functions.
+#
+# ================================================================
+def lock_memory():
+    '''
+    Keep the memory of the daemon, which holds the password and the
+    master keys, out of swap and out of core dumps.
+
+    mlockall() is only used on Linux and only if the memory lock
+    limit is unlimited, with a limit MCL_FUTURE would make later
+    allocations fail.
 
+    @returns True if the memory is locked.
+    '''
     try:
-        run(opts, password, stats)
-        wait_for_threads()
-    except KeyboardInterrupt:
-        abort_threads()
-        _println('', sys.stderr)
-        errn('^C detected, cleaning up threads, please wait\n')
-        wait_for_threads()
+        import ctypes
+        import ctypes.util
+        import resource
+    except ImportError:
+        return False
+    try:
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    except (ValueError, OSError):
+        pass
+    if not sys.platform.startswith('linux') or \
+       resource.getrlimit(resource.RLIMIT_MEMLOCK)[0] != resource.RLIM_INFINITY:
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return libc.mlockall(3) == 0  # MCL_CURRENT | MCL_FUTURE
 
-    summary(opts, stats)
-    if th_abort == True:
-        sys.exit(1)
+
+def stop_daemon(signum, frame):  # pylint: disable=unused-argument
+    '''
+    Stop the daemon on SIGTERM like on ^C.
+    '''
+    raise KeyboardInterrupt
+
+
+def run_daemon(opts, password):
+    '''
+    Serve the --client requests until the daemon is stopped.
+
+    The requests are handled one at a time by a LockSession, its
+    workers process the files of each request in parallel.
+    '''
+    import socket
+    path = opts.daemon
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            err('"{}" exists and is not a socket'.format(path))
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.remove(path)  # left behind by a daemon that died
+        else:
+            err('a daemon is already listening on "{}"'.format(path))
+        finally:
+            probe.close()
+    if lock_memory() is False:
+        infov(opts, 'the memory could not be locked, the keys may be swapped')
+
+    session = LockSession.from_opts(opts, password)
+    try:
+        if opts.format in ('kdf', 'segmented'):
+            # Derive the master key for locking before the first request.
+            kdf_id, cost, r, p = KDF_PARAMS[opts.kdf]
+            get_master_key(password, kdf_id, cost, r, p, get_run_salt())
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)  # only the user can connect
+        try:
+            server.bind(path)
+            server.listen(socket.SOMAXCONN)
+        except socket.error as exc:
+            server.close()
+            err('failed to listen on "{}": {}'.format(path, exc))
+        finally:
+            os.umask(umask)
+        signal.signal(signal.SIGTERM, stop_daemon)
+        infov(opts, 'listening on "{}"', path)
+        try:
+            while True:
+                conn, _ = server.accept()
+                try:
+                    daemon_request(opts, session, conn)
+                finally:
+                    conn.close()
+        except KeyboardInterrupt:
+            infov(opts, 'stopped')
+        finally:
+            server.close()
+            if os.path.lexists(path) and stat.S_ISSOCK(os.lstat(path).st_mode):
+                os.remove(path)
+    finally:
+        session.close()
+        log_flush()
+
+
+def daemon_request(opts, session, conn):
+    '''
+    Handle the request of a --client.
+
+    The request is a line of JSON with the action, which is lock,
+    unlock or verify, and the absolute paths of the files. The
+    response is a line of JSON with the counters, the --log-json
+    records of the files and the abort flag, or with the error.
+    '''
+    import json
+    import socket
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        uid = struct.unpack('3i', creds)[1]
+        if uid != os.getuid():
+            warn('rejected a request from user {}', uid)
+            return
+    try:
+        conn.settimeout(DAEMON_TIMEOUT)
+        line = conn.makefile('rb').readline()
+        if not line:
+            return  # a connection without a request, see run_daemon()
+        request = json.loads(line.decode('utf-8'))
+        action = request['action']
+        paths = request['paths']
+        if action not in ('lock', 'unlock', 'verify'):
+            raise ValueError('unknown action "{}"'.format(action))
+        if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+            raise ValueError('the paths must be a list of strings')
+        conn.settimeout(None)
+    except (socket.error, ValueError, KeyError, TypeError) as exc:
+        warn('invalid request: {}', exc)
+        report = {'error': 'invalid request: {}'.format(exc)}
+    else:
+        infov(opts, '{} {:,} files', action, len(paths))
+        try:
+            report = getattr(session, action + '_paths')(paths)
+        except LockFilesError as exc:
+            report = {'error': str(exc)}
+    try:
+        conn.sendall((json.dumps(report) + '\n').encode('utf-8'))
+    except socket.error as exc:
+        warn('failed to send the response: {}', exc)
+
+
+def run_client(opts):
+    '''
+    Send the files to the --daemon and report the result.
+
+    @returns the exit status, 1 if a file failed.
+    '''
+    import json
+    import socket
+    action = get_action(opts)
+    request = {'action': action, 'paths': [os.path.abspath(path) for path in get_files(opts)]}
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(opts.client)
+        conn.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        line = conn.makefile('rb').readline()
+    except socket.error as exc:
+        err('failed to send the request to the daemon "{}": {}'.format(opts.client, exc))
+    finally:
+        conn.close()
+    try:
+        report = json.loads(line.decode('utf-8'))
+    except ValueError:
+        err('invalid response from the daemon "{}"'.format(opts.client))
+    if 'error' in report:
+        err('the daemon failed: {}'.format(report['error']))
+
+    status = 1 if report['aborted'] is True else 0
+    for record in report['files']:
+        if record['event'] == 'failed':
+            errn('{} failed for "{}": {}', action, record['path'], record.get('error'))
+            status = 1
+        else:
+            infov2(opts, '{} "{}"', record['event'], record['path'])
+    if report['aborted'] is True:
+        errn('the daemon aborted the request, see its messages')
+    log_flush()
+    if opts.verbose:
+        print('')
+        summary_counters(opts, report['counters'])
+    return status
 
 
 if __name__ == '__main__':
@@ -7,8 +7,8 @@
 #
 # If, like me, you use different versions of python, you
 # select them as follows:
-#    ./test.sh 'python2.7 ../lock_files.py'
-#    ./test.sh 'python3.6 ../lock_files.py'
+#    ./test.sh 'python3.7 ../lock_files.py'
+#    ./test.sh 'python3.12 ../lock_files.py'
 #
 # Note that file1.txt and file2.txt are copied to intermediate
 # files throughout the tests. This is so that test data is not
@@ -85,6 +85,12 @@ Failed=0
 Total=0
 Prog=${1:-"../lock_files.py"}
 info "Prog=$Prog"
+# The interpreter of $Prog runs the tests that use python directly.
+case "$Prog" in
+    *' '*) Python=${Prog% *} ;;
+    *) Python=python ;;
+esac
+info "Python=$Python"
 rm -f test*.txt*
 
 # Test simple lock.
@@ -115,6 +121,243 @@ Test 'unlock-run' $Prog -P secret --unlock test.txt.locked
 Test 'unlock-exists' '[' -e 'test.txt' ']'
 Test 'diff-test' diff file1.txt test.txt
 
+# Test the segmented format with one and with several threads.
+for jobs in 1 4 ; do
+    Runcmd cp file1.txt test1.txt
+    Runcmd cp file2.txt test2.txt
+    Test "lock-run-segmented-j$jobs" $Prog -P secret --format segmented --kdf pbkdf2 -j $jobs --lock test1.txt test2.txt
+    Test 'lock-binary' "head -c 8 test2.txt.locked | grep -q Locked__"
+    Test "unlock-run-segmented-j$jobs" $Prog -P secret -j $jobs --unlock test1.txt.locked test2.txt.locked
+    Test 'diff-test' diff file1.txt test1.txt
+    Test 'diff-test' diff file2.txt test2.txt
+done
+Runcmd cp file2.txt test2.txt
+Test 'lock-run-segmented' $Prog -P secret --format segmented --kdf pbkdf2 --lock test2.txt
+Test 'unlock-run-segmented-password' '!' $Prog -P wrong --unlock test2.txt.locked
+Test 'unlock-keep' '[' -e 'test2.txt.locked' ']'
+Test 'unlock-run-segmented' $Prog -P secret --unlock test2.txt.locked
+Test 'diff-test' diff file2.txt test2.txt
+Runcmd cp file1.txt test1.txt
+Test 'lock-run-segment-size' $Prog -P secret --format segmented --kdf pbkdf2 --lock test1.txt
+Runcmd "$Python -c 'f = open(\"test1.txt.locked\", \"r+b\"); f.seek(57); f.write(b\"\\xff\" * 4)'"
+Test 'unlock-run-segment-size' '!' $Prog -P secret --unlock test1.txt.locked
+Runcmd rm -f test1.txt.locked
+
+# Test that a wrong password is rejected by the key check value.
+for args in '--format kdf' '-b' '--format segmented' ; do
+    Runcmd cp file2.txt test.txt
+    Test "lock-run-check$args" $Prog -P secret --kdf pbkdf2 $args --lock test.txt
+    Test "unlock-run-check$args" "! $Prog -P wrong --unlock test.txt.locked > check.out"
+    Test 'unlock-check-message' grep -q "'key check value'" check.out
+    Test 'unlock-keep' '[' -e test.txt.locked -a ! -e test.txt ']'
+    Test "unlock-run-check$args" $Prog -P secret --unlock test.txt.locked
+    Test 'diff-test' diff file2.txt test.txt
+done
+Runcmd rm -f check.out
+
+# Test --verify with good, wrong password and modified files.
+Runcmd mkdir -p verify
+Runcmd cp file1.txt verify/test1.txt
+Runcmd "head -c 2500000 /dev/urandom > verify/test2.bin"
+Test 'lock-run-verify' $Prog -P secret --kdf pbkdf2 --lock verify/test1.txt
+Test 'lock-run-verify-segmented' $Prog -P secret --format segmented --kdf pbkdf2 --lock verify/test2.bin
+Test 'verify-run' $Prog -P secret -r -j 2 --verify verify
+Test 'verify-keep' '[' -e verify/test1.txt.locked -a -e verify/test2.bin.locked ']'
+Test 'verify-run-password' '!' $Prog -P wrong -r -W --verify verify
+Runcmd "printf 'x' | dd of=verify/test2.bin.locked bs=1 seek=1500000 conv=notrunc"
+Test 'verify-run-modified' '!' $Prog -P secret -W --verify verify/test2.bin.locked
+Test 'verify-run-modified-proc' '!' $Prog -P secret -r -W -j 2 --executor process --verify verify
+Test 'verify-run-lock' '!' $Prog -P secret --lock --verify verify/test1.txt.locked
+Runcmd rm -rf verify
+
+# Test the --stats-json stage times.
+Runcmd cp file2.txt test.txt
+Test 'lock-run-stats' $Prog -P secret -j 2 --stats-json stats.json --stats-per-file --lock test.txt
+Test 'lock-stats' "grep -q '\"locked\": 1' stats.json"
+Test 'lock-stats-stage' "grep -q '\"base64\"' stats.json"
+Test 'lock-stats-file' "grep -q '\"path\": \"test.txt\"' stats.json"
+Test 'unlock-run-stats' $Prog -P secret -j 2 --executor process --stats-json stats.json --unlock test.txt.locked
+Test 'unlock-stats' "grep -q '\"unlocked\": 1' stats.json"
+Test 'diff-test' diff file2.txt test.txt
+Test 'stats-run-per-file' '!' $Prog -P secret --stats-per-file --lock test.txt
+Runcmd rm -f stats.json
+
+# Test the --progress report.
+Runcmd cp file1.txt test1.txt
+Runcmd cp file2.txt test2.txt
+Test 'lock-run-progress' "$Prog -P secret -j 2 --progress --lock test1.txt test2.txt 2> progress.out"
+Test 'lock-progress' grep -q "'progress: 2/2 files'" progress.out
+Test 'unlock-run-progress' $Prog -P secret -j 2 --progress --unlock test1.txt.locked test2.txt.locked
+Test 'diff-test' diff file2.txt test2.txt
+Test 'progress-run-range' '!' $Prog -P secret --progress --range 0:10 test1.txt
+Runcmd rm -f progress.out
+
+# Test the --log-json event log.
+Runcmd cp file1.txt test1.txt
+Runcmd cp file2.txt test2.txt
+Test 'lock-run-log' $Prog -P secret -j 2 -vv --log-json events.json --lock test1.txt test2.txt
+Test 'lock-log' '[' "$(grep -c '\"event\": \"locked\"' events.json)" -eq 2 ']'
+Runcmd cp file1.txt test3.txt
+Test 'unlock-run-log' $Prog -P secret -j 2 --executor process --log-json events.json --unlock test1.txt.locked test3.txt
+Test 'unlock-log' "grep -q '\"event\": \"unlocked\", \"output\": \"test1.txt\"' events.json"
+Test 'unlock-log-skip' "grep -q '\"event\": \"skipped\", \"path\": \"test3.txt\"' events.json"
+Test 'diff-test' diff file1.txt test1.txt
+Runcmd rm -f events.json test2.txt.locked test3.txt
+if [ -e /dev/full ] ; then
+    Runcmd cp file2.txt test2.txt
+    Test 'lock-run-log-full' '!' $Prog -P secret --log-json /dev/full --lock test2.txt
+    Test 'lock-exists' '[' -e 'test2.txt.locked' ']'
+    Runcmd rm -f test2.txt.locked
+fi
+
+# Test the library API, the locked files are the same as the ones
+# the command line tool writes.
+Test 'import-lazy' "PYTHONPATH=.. $Python -c 'import sys, lock_files; assert not {\"argparse\", \"cryptography\", \"tarfile\"} & set(sys.modules)'"
+Runcmd cp file1.txt test1.txt
+Test 'session-lock' "PYTHONPATH=.. $Python -c 'import lock_files; s = lock_files.LockSession(password=\"secret\"); assert s.lock_paths([\"test1.txt\"])[\"counters\"][\"locked\"] == 1; s.close()'"
+Test 'unlock-run-session' $Prog -P secret --unlock test1.txt.locked
+Test 'diff-test' diff file1.txt test1.txt
+Test 'session-bytes' "PYTHONPATH=.. $Python -c 'import lock_files; s = lock_files.LockSession(password=\"secret\", format=\"segmented\"); assert s.decrypt_bytes(s.encrypt_bytes(b\"text\")) == b\"text\"; s.close()'"
+Test 'session-error' "PYTHONPATH=.. $Python -c 'import lock_files
+try:
+    lock_files.LockSession(password=\"secret\", jobs=0)
+except lock_files.LockFilesError:
+    pass
+else:
+    raise SystemExit(1)'"
+
+# Test reading the files from a list (--files-from).
+Runcmd cp file1.txt test1.txt
+Runcmd cp file2.txt test2.txt
+Test 'lock-run-files-from' "printf 'test1.txt\\ntest2.txt\\n' | $Prog -P secret -j 2 --files-from - --lock"
+Test 'lock-exists' '[' -e test1.txt.locked -a -e test2.txt.locked ']'
+Test 'unlock-run-files-from-0' "printf 'test1.txt.locked\\0' | $Prog -P secret --files-from - -0 --unlock test2.txt.locked"
+Test 'diff-test' diff file1.txt test1.txt
+Test 'diff-test' diff file2.txt test2.txt
+Test 'lock-run-files-from-missing' '!' $Prog -P secret --files-from missing.txt --lock
+Test 'lock-run-null' '!' $Prog -P secret -0 --lock test1.txt
+
+# Test the daemon mode, the files are locked and unlocked by a
+# daemon that the client sends them to.
+Runcmd cp file1.txt test1.txt
+Runcmd cp file2.txt test2.txt
+Runcmd "$Prog -P secret -j 2 --format kdf --daemon daemon.sock > daemon.out 2>&1 &"
+DaemonPid=$!
+Runcmd "for i in \$(seq 100) ; do [ -S daemon.sock ] && break ; sleep 0.1 ; done"
+Test 'daemon-socket' '[' -S daemon.sock ']'
+Test 'daemon-run-exists' '!' $Prog -P secret --daemon daemon.sock
+Test 'lock-run-client' "$Prog --client daemon.sock -v test1.txt test2.txt > client.out"
+Test 'lock-client-summary' "grep -q 'total locked: *2\$' client.out && ! grep -q 'queued' client.out"
+Test 'lock-exists' '[' -e test1.txt.locked -a ! -e test1.txt ']'
+Test 'verify-run-client' $Prog --client daemon.sock --verify test1.txt.locked test2.txt.locked
+Test 'unlock-run-client' $Prog --client daemon.sock --unlock test1.txt.locked test2.txt.locked
+Test 'diff-test' diff file2.txt test2.txt
+Runcmd cp file1.txt test3.txt.locked
+Test 'unlock-run-client-bad' '!' $Prog --client daemon.sock --unlock test3.txt.locked
+Runcmd kill $DaemonPid
+Runcmd wait $DaemonPid
+Test 'daemon-stopped' '!' '[' -e daemon.sock ']'
+Test 'client-run-no-daemon' '!' $Prog --client daemon.sock test1.txt
+Test 'daemon-run-files' '!' $Prog -P secret --daemon daemon.sock test1.txt
+Runcmd cp file1.txt daemon.sock
+Test 'daemon-run-not-socket' '!' $Prog -P secret --daemon daemon.sock
+Test 'diff-test' diff file1.txt daemon.sock
+Runcmd rm -f daemon.sock
+Runcmd rm -f daemon.out client.out test3.txt.locked
+
+# Test partial decryption (--range) across segment boundaries.
+Runcmd "head -c 2500000 /dev/urandom > range.bin"
+Runcmd cp range.bin test3.bin
+Runcmd cp range.bin test4.bin
+Runcmd cp range.bin test5.bin
+Runcmd cp range.bin test6.bin
+Test 'lock-run-range-segmented' $Prog -P secret --format segmented --kdf pbkdf2 --lock test3.bin
+Test 'lock-run-range-kdf' $Prog -P secret --format kdf --kdf pbkdf2 --lock test4.bin
+Test 'lock-run-range-binary' $Prog -P secret -b --kdf pbkdf2 --lock test5.bin
+Test 'lock-run-range-base64' $Prog -P secret --lock test6.bin
+for f in test3.bin.locked test4.bin.locked test5.bin.locked test6.bin.locked ; do
+    Test "range-run-$f" "$Prog -P secret --range 10:20 $f > range.out && cmp range.out <(head -c 20 range.bin | tail -c 10)"
+    Test "range-run-$f" "$Prog -P secret --range 1048000:1049000 $f > range.out && cmp range.out <(head -c 1049000 range.bin | tail -c 1000)"
+    Test "range-run-$f" "$Prog -P secret --range=-100: $f > range.out && cmp range.out <(tail -c 100 range.bin)"
+    Test "range-run-$f" "$Prog -P secret --range : $f | cmp - range.bin"
+    Test "range-run-$f" "$Prog -P secret --range=1000:-1000 $f > range.out && cmp range.out <(head -c 2499000 range.bin | tail -c 2498000)"
+    Test 'range-keep' '[' -e "$f" ']'
+done
+Test 'range-run-password' '!' $Prog -P wrong --range 0:10 test3.bin.locked
+Test 'range-run-lock' '!' $Prog -P secret --lock --range 0:10 test3.bin.locked
+Runcmd rm -f range.bin range.out test3.bin.locked test4.bin.locked test5.bin.locked test6.bin.locked
+
+# Test lock with a small chunk size (--chunk-size set).
+Runcmd cp file2.txt test.txt
+Test 'lock-run' $Prog -P secret --chunk-size 7 --lock test.txt
+Test 'lock-exists' '[' -e 'test.txt.locked' ']'
+Test 'unlock-run' $Prog -P secret --chunk-size 5 --unlock test.txt.locked
+Test 'unlock-exists' '[' -e 'test.txt' ']'
+Test 'diff-test' diff file2.txt test.txt
+
+# Test lock and unlock with memory mapped input (--mmap-threshold set).
+for fmt in classic kdf ; do
+    Runcmd cp file2.txt test.txt
+    Test "lock-run-mmap-$fmt" $Prog -P secret --format $fmt --mmap-threshold 1 --chunk-size 7 --lock test.txt
+    Test 'lock-exists' '[' -e 'test.txt.locked' ']'
+    Test "unlock-run-mmap-$fmt" $Prog -P secret --mmap-threshold 1 --chunk-size 5 --unlock test.txt.locked
+    Test 'unlock-exists' '[' -e 'test.txt' ']'
+    Test 'diff-test' diff file2.txt test.txt
+done
+Runcmd cp file2.txt test.txt
+Test 'lock-run-mmap-binary' $Prog -P secret -b --mmap-threshold 1 --lock test.txt
+Test 'unlock-run-mmap-binary' $Prog -P secret --mmap-threshold 1 --unlock test.txt.locked
+Test 'diff-test' diff file2.txt test.txt
+
+# Test lock and unlock with the pipeline stages and a small buffer.
+for args in '' '-b' '--mmap-threshold 1' ; do
+    Runcmd cp file2.txt test.txt
+    Test "lock-run-pipeline$args" $Prog -P secret $args --pipeline 20 --chunk-size 7 --lock test.txt
+    Test 'lock-exists' '[' -e 'test.txt.locked' ']'
+    Test "unlock-run-pipeline$args" $Prog -P secret $args --pipeline 20 --chunk-size 5 --unlock test.txt.locked
+    Test 'unlock-exists' '[' -e 'test.txt' ']'
+    Test 'diff-test' diff file2.txt test.txt
+done
+
+# Test the kdf format with both password KDFs.
+for kdf in pbkdf2 scrypt ; do
+    Runcmd cp file1.txt test1.txt
+    Runcmd cp file2.txt test2.txt
+    Test "lock-run-$kdf" $Prog -P secret --format kdf --kdf $kdf -j 2 --lock test1.txt test2.txt
+    Test 'lock-exists' '[' -e 'test1.txt.locked' ']'
+    Test 'lock-exists' '[' -e 'test2.txt.locked' ']'
+    Test "unlock-run-$kdf" $Prog -P secret -j 2 --unlock test1.txt.locked test2.txt.locked
+    Test 'diff-test' diff file1.txt test1.txt
+    Test 'diff-test' diff file2.txt test2.txt
+done
+
+# A header that asks for an absurd KDF cost is rejected rather than
+# derived.
+Runcmd cp file1.txt test1.txt
+Test 'lock-run-kdf-cost' $Prog -P secret -b --kdf pbkdf2 --lock test1.txt
+Runcmd "$Python -c 'f = open(\"test1.txt.locked\", \"r+b\"); f.seek(10); f.write(b\"\\xff\" * 4)'"
+Test 'unlock-run-kdf-cost' '!' timeout 60 $Prog -P secret --unlock test1.txt.locked
+Runcmd rm -f test1.txt.locked
+Runcmd cp file1.txt test1.txt
+Test 'lock-run-kdf-scrypt-cost' $Prog -P secret -b --kdf scrypt --lock test1.txt
+Runcmd "$Python -c 'f = open(\"test1.txt.locked\", \"r+b\"); f.seek(10); f.write(b\"\\x00\\x04\\x00\\x00\")'"
+Test 'unlock-run-kdf-scrypt-cost' "$Prog -P secret --unlock test1.txt.locked 2>&1 | grep -q 'invalid key derivation parameters 262144'"
+Runcmd rm -f test1.txt.locked
+
+# Test that comment lines in locked files are ignored.
+Runcmd cp file1.txt test1.txt
+Test 'lock-run' $Prog -P secret --lock test1.txt
+Runcmd "(echo '# locked by test.sh' ; cat test1.txt.locked) > test.tmp && mv test.tmp test1.txt.locked"
+Test 'unlock-run' $Prog -P secret --unlock test1.txt.locked
+Test 'diff-test' diff file1.txt test1.txt
+
+# Test binary locked files (-b, --binary).
+Runcmd cp file1.txt test1.txt
+Test 'lock-run' $Prog -P secret --binary --lock test1.txt
+Test 'lock-binary' '[' "$(head -c 8 test1.txt.locked)" = 'Locked__' ']'
+Test 'unlock-run' $Prog -P secret --unlock test1.txt.locked
+Test 'diff-test' diff file1.txt test1.txt
+
 # Now try file globbing and locking.
 Runcmd cp file1.txt test1.txt
 Runcmd cp file2.txt test2.txt
@@ -257,7 +500,7 @@ info 'test openssl encrypt, lock_files decrypt'
 tid=${LINENO}
 Runcmd rm -f test.txt test.txt.locked
 Runcmd cp file1.txt test.txt
-Test 'openssl-enc' openssl enc -aes-256-cbc -e -a -salt -pass pass:secret -in test.txt -out test.txt.locked
+Test 'openssl-enc' openssl enc -aes-256-cbc -md md5 -e -a -salt -pass pass:secret -in test.txt -out test.txt.locked
 Test 'unlock-run' $Prog -c -W -P secret -u test.txt.locked
 Test 'diff-test' diff file1.txt test1.txt
 
@@ -265,7 +508,7 @@ info 'test lock_files encrypt, openssl decrypt'
 Runcmd rm -f test.txt test.txt.locked
 Runcmd cp file1.txt test.txt
 Test 'lock-run' $Prog -c -W -P secret -l test.txt
-Test 'openssl-dec' openssl enc -aes-256-cbc -d -a -salt -pass pass:secret -in test.txt.locked -out test.txt
+Test 'openssl-dec' openssl enc -aes-256-cbc -md md5 -d -a -salt -pass pass:secret -in test.txt.locked -out test.txt
 Test 'diff-test' diff file1.txt test1.txt
 
 # Test different lengths to verify padding.
@@ -318,13 +561,120 @@ info 'setup done'
 Test 'job-test001-check' '[' -e 'tmp/test001.txt' ']'
 Test 'job-test100-check' '[' -e 'tmp/test100.txt' ']'
 Test 'job-test200-check' '[' -e 'tmp/test200.txt' ']'
+Runcmd cp tmp/test001.txt test1.txt
 Test 'lock-run-200-th10' time $Prog -P secret -v -j 10 --lock tmp
 Test 'unlock-run-200-th10' time $Prog -P secret -v -j 10 --unlock tmp
+Test 'diff-test' diff test1.txt tmp/test001.txt
+
+# Parallel CBC decryption of a large openssl compatible file.
+Test 'lock-run-openssl-big' openssl enc -aes-256-cbc -md md5 -e -a -salt -pass pass:secret -in test1.txt -out test1.txt.locked
+Test 'unlock-run-openssl-big-j4' $Prog -P secret -c -j 4 -o --unlock test1.txt.locked
+Test 'diff-test' diff tmp/test001.txt test1.txt
 
 # performance analysis (1 thread)
 Test 'lock-run-200-th1' time $Prog -P secret -v -j 1 --lock tmp
 Test 'unlock-run-200-th1' time $Prog -P secret -v -j 1 --unlock tmp
 
-Runcmd rm -rf test*.txt* tmp *~
+# performance analysis (--jobs auto)
+Test 'lock-run-200-auto' time $Prog -P secret -v -j auto --lock tmp
+Test 'unlock-run-200-auto' time $Prog -P secret -v -j auto --executor process --unlock tmp
+Test 'diff-test' diff tmp/test001.txt tmp/test200.txt
+Test 'lock-run-jobs-bad' '!' $Prog -P secret -j many --lock tmp
+
+# Test the cgroup CPU quota that limits --jobs auto.
+Runcmd mkdir -p cg/v2/a/b cg/v1/cpu,cpuacct/x/y cg/hybrid/unified/a cg/hybrid/cpu,cpuacct/x
+Runcmd "echo 0::/a/b > cg/v2.proc"
+Runcmd "echo max 100000 > cg/v2/a/b/cpu.max"
+Runcmd "echo 150000 100000 > cg/v2/a/cpu.max"
+Test 'cgroup-v2-parent' "PYTHONPATH=.. $Python -c 'import lock_files; assert lock_files.get_cgroup_cpu_limit(\"cg/v2\", \"cg/v2.proc\") == 1.5'"
+Runcmd "echo max 100000 > cg/v2/a/cpu.max"
+Test 'cgroup-v2-max' "PYTHONPATH=.. $Python -c 'import lock_files; assert lock_files.get_cgroup_cpu_limit(\"cg/v2\", \"cg/v2.proc\") is None'"
+Runcmd "printf '5:memory:/x/y\\n4:cpu,cpuacct:/x/y\\n1:name=systemd:/x/y\\n' > cg/v1.proc"
+Runcmd "echo -1 > cg/v1/cpu,cpuacct/x/y/cpu.cfs_quota_us"
+Runcmd "echo 100000 > cg/v1/cpu,cpuacct/x/y/cpu.cfs_period_us"
+Test 'cgroup-v1-none' "PYTHONPATH=.. $Python -c 'import lock_files; assert lock_files.get_cgroup_cpu_limit(\"cg/v1\", \"cg/v1.proc\") is None'"
+Runcmd "echo 50000 > cg/v1/cpu,cpuacct/x/cpu.cfs_quota_us"
+Runcmd "echo 100000 > cg/v1/cpu,cpuacct/x/cpu.cfs_period_us"
+Test 'cgroup-v1-parent' "PYTHONPATH=.. $Python -c 'import lock_files; assert lock_files.get_cgroup_cpu_limit(\"cg/v1\", \"cg/v1.proc\") == 0.5'"
+Runcmd "printf '4:cpu,cpuacct:/x\\n0::/a\\n' > cg/hybrid.proc"
+Runcmd "echo 200000 100000 > cg/hybrid/unified/a/cpu.max"
+Test 'cgroup-hybrid' "PYTHONPATH=.. $Python -c 'import lock_files; assert lock_files.get_cgroup_cpu_limit(\"cg/hybrid\", \"cg/hybrid.proc\") == 2.0'"
+Test 'cgroup-missing' "PYTHONPATH=.. $Python -c 'import lock_files; assert lock_files.get_cgroup_cpu_limit(\"cg/none\", \"cg/none.proc\") is None'"
+Runcmd rm -rf cg
+
+# performance analysis (4 processes)
+Test 'lock-run-200-proc4' time $Prog -P secret -v -j 4 --executor process --lock tmp
+Test 'unlock-run-200-proc4' time $Prog -P secret -v -j 4 --executor process --unlock tmp
+Test 'diff-test' diff tmp/test001.txt tmp/test200.txt
+Test 'lock-run-200-proc4-kdf' time $Prog -P secret -v -j 4 --executor process --format kdf --lock tmp
+Test 'unlock-run-200-proc4-kdf' time $Prog -P secret -v -j 4 --executor process --unlock tmp
+Test 'diff-test' diff tmp/test001.txt tmp/test200.txt
+Test 'lock-run-200-proc4-segmented' time $Prog -P secret -v -j 4 --executor process --format segmented --lock tmp
+Test 'unlock-run-200-proc4-segmented' time $Prog -P secret -v -j 4 --executor process --unlock tmp
+Test 'diff-test' diff tmp/test001.txt tmp/test200.txt
+
+# Test the parallel directory walk.
+Runcmd mkdir -p tmp/sub1/sub2 tmp/sub3
+Runcmd cp tmp/test001.txt tmp/sub1/sub2/test201.txt
+Runcmd cp tmp/test001.txt tmp/sub3/test202.txt
+Test 'lock-run-walk-jobs' $Prog -P secret -r -j 4 --walk-jobs 4 --lock tmp
+Test 'lock-exists' '[' -e 'tmp/sub1/sub2/test201.txt.locked' ']'
+Test 'lock-count' '[' "$(find tmp -name '*.locked' | wc -l)" -eq 202 ']'
+Test 'unlock-run-walk-jobs' $Prog -P secret -r -j 4 --walk-jobs 4 --sort --unlock tmp
+Test 'unlock-count' '[' "$(find tmp -name '*.locked' | wc -l)" -eq 0 ']'
+Test 'diff-test' diff tmp/test001.txt tmp/sub1/sub2/test201.txt
+Runcmd rm -rf tmp/sub1 tmp/sub3
+
+# Test bundle mode, all of the files are locked into one file.
+# The files are unlocked below the current directory so the
+# program path must not be relative.
+ProgAbs="${Prog/..\/lock_files.py/$(cd .. && pwd)/lock_files.py}"
+Test 'lock-run-bundle' $Prog -P secret -r --bundle test.bundle.locked tmp
+Test 'lock-exists' '[' -e 'test.bundle.locked' ']'
+Test 'lock-keep' '[' -e 'tmp/test200.txt' ']'
+Runcmd mkdir test.out
+Test 'unlock-run-bundle' "(cd test.out && $ProgAbs -P secret --unlock --bundle ../test.bundle.locked)"
+Test 'diff-test' diff -r tmp test.out/tmp
+Runcmd rm -rf test.out
+Runcmd mkdir test.out
+Test 'lock-run-bundle-binary' $Prog -P secret -b --bundle test.bundle.locked -o file1.txt file2.txt
+Test 'unlock-run-bundle-select' "(cd test.out && $ProgAbs -P secret --unlock --bundle ../test.bundle.locked file2.txt)"
+Test 'diff-test' diff file2.txt test.out/file2.txt
+Test 'unlock-select' '!' '[' -e 'test.out/file1.txt' ']'
+Test 'unlock-run-bundle-exists' '!' "(cd test.out && $ProgAbs -P secret --unlock --bundle ../test.bundle.locked)"
+Test 'unlock-run-bundle-password' '!' "(cd test.out && $ProgAbs -P wrong -o --unlock --bundle ../test.bundle.locked)"
+Runcmd rm -rf test.out test.bundle.locked
+
+# Test incremental mode, unchanged files are not locked again.
+Runcmd cp file2.txt tmp/test002.txt
+Test 'lock-run-incr' $Prog -P secret -j 4 --incremental test.idx --incremental-hash --lock tmp
+Test 'lock-exists' '[' -e 'tmp/test002.txt.locked' ']'
+Test 'lock-keep' diff file2.txt tmp/test002.txt
+Runcmd cp tmp/test002.txt.locked test2.txt.locked
+Runcmd cp tmp/test003.txt.locked test3.txt.locked
+Runcmd cat file1.txt '>>' tmp/test002.txt
+Runcmd touch tmp/test003.txt
+Test 'lock-run-incr-2' $Prog -P secret -j 4 --incremental test.idx --incremental-hash --lock tmp
+Test 'lock-changed' '!' cmp -s tmp/test002.txt.locked test2.txt.locked
+Test 'lock-unchanged' cmp tmp/test003.txt.locked test3.txt.locked
+Runcmd touch tmp/test003.txt
+Test 'lock-run-incr-3' $Prog -P secret -j 4 --executor process --incremental test.idx --incremental-hash --lock tmp
+Test 'lock-unchanged' cmp tmp/test003.txt.locked test3.txt.locked
+Runcmd cp tmp/test002.txt.locked test2.txt.locked
+Test 'unlock-run-incr' $Prog -P secret --overwrite --unlock test2.txt.locked
+Test 'diff-test' diff tmp/test002.txt test2.txt
+Test 'lock-run-incr-unlock' '!' $Prog -P secret --incremental test.idx --unlock tmp
+Test 'lock-run-incr-inside' $Prog -P secret --incremental tmp/test.idx --lock tmp
+Test 'lock-run-incr-inside-2' $Prog -P secret --incremental tmp/test.idx --lock tmp
+Test 'lock-index-skip' '!' '[' -e tmp/test.idx.locked ']'
+Test 'lock-index-entry' "grep -q 'test004.txt\"' tmp/test.idx"
+Runcmd rm -f tmp/test004.txt
+Test 'lock-run-incr-prune' $Prog -P secret --incremental tmp/test.idx --lock tmp
+Test 'lock-index-pruned' '!' "grep -q 'test004.txt\"' tmp/test.idx"
+
+# Test that the benchmark suite round trips every format.
+Test 'bench-run-formats' "$Python ../bench/throughput.py -p ${Prog##* } -s tiny -j 1 -f classic,openssl,kdf,binary,segmented > /dev/null"
+
+Runcmd rm -rf test*.txt* test.idx tmp *~
 
 Done